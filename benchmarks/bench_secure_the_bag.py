@@ -0,0 +1,269 @@
+"""
+Benchmarks secure_the_bag on synthetic bags and writes the results as JSON so they can be compared across commits.
+
+Each stage of each bag size is run in a fresh process so peak RSS is measured for that stage alone.
+
+    python -m benchmarks.bench_secure_the_bag -s 1000,100000 -o results.json
+    python -m benchmarks.bench_secure_the_bag -s 1000,100000 -o new.json -c results.json
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+import click
+from chia.util.hash import std_hash
+from chia_rs.sized_bytes import bytes32
+from clvm.casts import int_to_bytes
+
+from cats.progress import BagProgress, peak_rss_bytes
+from cats.secure_the_bag import (
+    BagCoinSpends,
+    batch_the_bag,
+    parent_of_puzzle_hash,
+    read_secure_the_bag_targets,
+    secure_the_bag,
+)
+
+DEFAULT_SIZES = "1000,100000,1000000,10000000"
+
+# Asset id used for bags of CATs, the value makes no difference to the work done
+BENCHMARK_ASSET_ID = bytes32(std_hash(b"benchmark asset id"))
+BENCHMARK_GENESIS_COIN_NAME = bytes32(std_hash(b"benchmark genesis coin"))
+
+# Number of targets walked up to the genesis coin when timing parent_of_puzzle_hash
+PARENT_LOOKUPS = 1000
+
+# Stages of each case, each run in its own process so its peak RSS is measured alone. Securing the bag comes first as
+# the stage being benchmarked.
+STAGES = ["secure", "read", "batch", "unwind"]
+
+# Metrics where a bigger number is better when comparing results
+HIGHER_IS_BETTER = {"hashes_per_second"}
+
+
+def write_targets(path: str, size: int) -> int:
+    """
+    Writes a deterministic targets CSV of size targets, returning the net amount.
+    """
+    net_amount = 0
+
+    with open(path, "w") as targets_file:
+        for index in range(size):
+            amount = index % 1000 + 1
+            net_amount += amount
+            targets_file.write(f"{std_hash(int_to_bytes(index)).hex()},{amount}\n")
+
+    return net_amount
+
+
+def run_case(size: int, cat: bool, leaf_width: int, workers: int, stage: str) -> dict[str, Any]:
+    """
+    Times one stage of securing a synthetic bag of size targets in this process, along with the peak RSS it reached.
+
+    Every stage reads the targets first, and stages that need the secured bag secure it before they are timed.
+    """
+    asset_id = BENCHMARK_ASSET_ID if cat else None
+    result: dict[str, Any] = {"targets": size, "cat": cat}
+
+    with tempfile.TemporaryDirectory() as directory:
+        targets_path = os.path.join(directory, "targets.csv")
+        net_amount = write_targets(targets_path, size)
+
+        start = time.perf_counter()
+        targets = read_secure_the_bag_targets(targets_path, net_amount)
+        read_seconds = time.perf_counter() - start
+
+    if stage == "read":
+        result["read_seconds"] = read_seconds
+    elif stage == "batch":
+        start = time.perf_counter()
+        batch_the_bag(list(targets), leaf_width)
+        result["batch_seconds"] = time.perf_counter() - start
+    elif stage == "secure":
+        # Progress output from securing the bag is not part of the results
+        start = time.perf_counter()
+        _, parent_puzzle_lookup = secure_the_bag(targets, leaf_width, asset_id, workers=workers, progress=BagProgress())
+        result["secure_seconds"] = time.perf_counter() - start
+
+        # Every node is tree hashed once, and bags of CATs hash the outer puzzle of every node too
+        nodes = len(parent_puzzle_lookup) + 1
+        result["hashes"] = nodes * (2 if cat else 1)
+        result["hashes_per_second"] = result["hashes"] / result["secure_seconds"]
+    elif stage == "unwind":
+        _, parent_puzzle_lookup = secure_the_bag(targets, leaf_width, asset_id, workers=workers, progress=BagProgress())
+        keys = list(parent_puzzle_lookup.keys())[:: max(1, size // PARENT_LOOKUPS)][:PARENT_LOOKUPS]
+
+        start = time.perf_counter()
+        for key in keys:
+            parent_of_puzzle_hash(BENCHMARK_GENESIS_COIN_NAME, key, parent_puzzle_lookup)
+        result["parent_of_puzzle_hash_seconds"] = (time.perf_counter() - start) / len(keys)
+
+        start = time.perf_counter()
+        BagCoinSpends(BENCHMARK_GENESIS_COIN_NAME, parent_puzzle_lookup).coin_spends_by_depth()
+        result["coin_spends_seconds"] = time.perf_counter() - start
+    else:
+        raise Exception(f"Unknown benchmark stage {stage}")
+
+    result[f"{stage}_peak_rss_bytes"] = peak_rss_bytes()
+
+    return result
+
+
+def format_rss(rss_bytes: int | None) -> str:
+    return "n/a" if rss_bytes is None else f"{rss_bytes / 2**20:.1f} MiB"
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict[str, Any], baseline: dict[str, Any]) -> None:
+    """
+    Prints the change in every metric between a baseline run and this one.
+    """
+    baseline_cases = {(case["targets"], case["cat"]): case for case in baseline["results"]}
+
+    print(f"Compared to {baseline.get('commit')}:")
+
+    for case in results["results"]:
+        baseline_case = baseline_cases.get((case["targets"], case["cat"]))
+
+        if baseline_case is None:
+            continue
+
+        for metric, value in case.items():
+            baseline_value = baseline_case.get(metric)
+
+            if metric in {"targets", "cat", "hashes"} or not baseline_value:
+                continue
+
+            change = value / baseline_value
+            better = change > 1 if metric in HIGHER_IS_BETTER else change < 1
+
+            print(
+                f"  {case['targets']} targets{' of CATs' if case['cat'] else ''} {metric}: "
+                f"{baseline_value:.6g} -> {value:.6g} ({change:.2f}x, {'better' if better else 'worse'})"
+            )
+
+
+@click.command()
+@click.option(
+    "-s",
+    "--sizes",
+    default=DEFAULT_SIZES,
+    show_default=True,
+    help="Comma separated numbers of targets in each synthetic bag",
+)
+@click.option(
+    "-lw",
+    "--leaf-width",
+    default=100,
+    show_default=True,
+    help="Secure the bag leaf width",
+)
+@click.option(
+    "-w",
+    "--workers",
+    default=1,
+    show_default=True,
+    help="Number of processes used to hash each level of the bag",
+)
+@click.option(
+    "-o",
+    "--output",
+    help="Path to write the results to as JSON",
+)
+@click.option(
+    "-c",
+    "--compare-to",
+    help="Path to results of an earlier run to compare against",
+)
+@click.option(
+    "--run-case",
+    "case",
+    hidden=True,
+    help="Run a single size:cat case in this process and print its result",
+)
+def cli(
+    sizes: str,
+    leaf_width: int,
+    workers: int,
+    output: str | None,
+    compare_to: str | None,
+    case: str | None,
+) -> None:
+    if case is not None:
+        size, cat, stage = case.split(":")
+        print(json.dumps(run_case(int(size), cat == "cat", leaf_width, workers, stage)))
+        return
+
+    results: dict[str, Any] = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "leaf_width": leaf_width,
+        "workers": workers,
+        "results": [],
+    }
+
+    for bag_size in [int(size) for size in sizes.split(",")]:
+        for bag_of_cats in (False, True):
+            result: dict[str, Any] = {}
+
+            for stage in STAGES:
+                # A fresh interpreter per stage keeps peak RSS from leaking between stages and sizes
+                process = subprocess.run(
+                    [
+                        sys.executable,
+                        "-m",
+                        "benchmarks.bench_secure_the_bag",
+                        "--run-case",
+                        f"{bag_size}:{'cat' if bag_of_cats else 'xch'}:{stage}",
+                        "--leaf-width",
+                        str(leaf_width),
+                        "--workers",
+                        str(workers),
+                    ],
+                    capture_output=True,
+                    check=True,
+                    text=True,
+                )
+                result.update(json.loads(process.stdout.splitlines()[-1]))
+
+            results["results"].append(result)
+
+            peak_rss = ", ".join(f"{stage} {format_rss(result[f'{stage}_peak_rss_bytes'])}" for stage in STAGES)
+            print(
+                f"{bag_size} targets{' of CATs' if bag_of_cats else ''}: secured in {result['secure_seconds']:.2f}s "
+                f"at {result['hashes_per_second']:.0f} hashes/s, peak RSS {peak_rss}"
+            )
+
+    if output is not None:
+        with open(output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+        print(f"Results written to {output}")
+
+    if compare_to is not None:
+        with open(compare_to) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+def main() -> None:
+    cli()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+from collections.abc import Sequence
+from hashlib import sha256
+from pathlib import Path
+
+from chia_rs.sized_bytes import bytes32
+
+from cats.secure_the_bag import Target
+
+SCHEMA = [
+    # One row recording the asset id the cached lookup keys were calculated for, and how many builds have used the
+    # cache so far
+    "CREATE TABLE bag_cache(asset_id BLOB, generation INTEGER NOT NULL)",
+    # Every batch secured so far keyed by the sha256 of its targets, see batch_content_hash. Lookup keys are the
+    # concatenated outer puzzle hashes of the targets for bags of CATs and NULL otherwise, as they are the target
+    # puzzle hashes themselves. Generation is the last build that used the batch.
+    (
+        "CREATE TABLE batches(content_hash BLOB PRIMARY KEY, puzzle_hash BLOB NOT NULL, lookup_keys BLOB, "
+        "generation INTEGER NOT NULL) WITHOUT ROWID"
+    ),
+]
+
+
+def batch_content_hash(batch_targets: Sequence[Target]) -> bytes:
+    """
+    Hash identifying a batch by its targets, in order. Batches with the same targets secure to the same puzzle.
+    """
+    return sha256(
+        b"".join(target.puzzle_hash + int(target.amount).to_bytes(8, "big") for target in batch_targets)
+    ).digest()
+
+
+class BagCache:
+    """
+    SQLite backed cache of the puzzle hash and lookup keys of every batch secured so far.
+
+    Batches are keyed by their contents rather than their position, so rebuilding a bag after its targets file
+    changes only rehashes the batches whose targets changed and the ancestors above them. An unchanged batch secures
+    to the same puzzle hash and amount, so its parent batch is unchanged too unless one of its siblings changed.
+    Inserting or removing targets shifts every later batch in its level, so edits and rows appended to the end are
+    the cheapest changes.
+
+    Each build is a new generation and prune drops the batches the latest one didn't use.
+    """
+
+    connection: sqlite3.Connection
+    asset_id: bytes32 | None
+    generation: int
+    hits: int
+    misses: int
+
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        self.connection = connection
+        self.hits = 0
+        self.misses = 0
+
+        row = connection.execute("SELECT asset_id, generation FROM bag_cache").fetchone()
+
+        if row is None:
+            raise Exception("Bag cache does not describe a secured bag")
+
+        self.asset_id = None if row[0] is None else bytes32(row[0])
+        self.generation = row[1] + 1
+
+    @classmethod
+    def open(cls, path: str | Path, asset_id: bytes32 | None) -> BagCache:
+        """
+        Opens the cache at path for a new build, creating it if it doesn't exist yet.
+        """
+        if not os.path.exists(path):
+            connection = sqlite3.connect(path)
+            for statement in SCHEMA:
+                connection.execute(statement)
+            connection.execute("INSERT INTO bag_cache(asset_id, generation) VALUES(?, 0)", (asset_id,))
+            connection.commit()
+        else:
+            connection = sqlite3.connect(path)
+
+        cache = cls(connection)
+
+        if cache.asset_id != asset_id:
+            connection.close()
+            raise Exception(f"Bag cache {path} was built for asset id {cache.asset_id} not {asset_id}")
+
+        connection.execute("UPDATE bag_cache SET generation = ?", (cache.generation,))
+
+        return cache
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def get(
+        self, content_hashes: Sequence[bytes], batches: Sequence[list[Target]]
+    ) -> list[tuple[bytes32, list[bytes32]] | None]:
+        """
+        Puzzle hash and lookup keys of each batch, or None for batches that haven't been secured before.
+        """
+        placeholders = ", ".join("?" * len(content_hashes))
+        rows = {
+            content_hash: (puzzle_hash, lookup_keys)
+            for content_hash, puzzle_hash, lookup_keys in self.connection.execute(
+                f"SELECT content_hash, puzzle_hash, lookup_keys FROM batches WHERE content_hash IN ({placeholders})",
+                content_hashes,
+            )
+        }
+
+        if len(rows) > 0:
+            self.connection.execute(
+                f"UPDATE batches SET generation = ? WHERE content_hash IN ({', '.join('?' * len(rows))})",
+                [self.generation, *rows],
+            )
+
+        cached: list[tuple[bytes32, list[bytes32]] | None] = []
+
+        for batch_targets, content_hash in zip(batches, content_hashes):
+            row = rows.get(content_hash)
+
+            if row is None:
+                self.misses += 1
+                cached.append(None)
+                continue
+
+            self.hits += 1
+            puzzle_hash, lookup_keys = row
+
+            if lookup_keys is None:
+                keys = [target.puzzle_hash for target in batch_targets]
+            else:
+                keys = [bytes32(lookup_keys[index : index + 32]) for index in range(0, len(lookup_keys), 32)]
+
+            cached.append((bytes32(puzzle_hash), keys))
+
+        return cached
+
+    def put(self, content_hashes: Sequence[bytes], secured: Sequence[tuple[bytes32, list[bytes32]]]) -> None:
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO batches(content_hash, puzzle_hash, lookup_keys, generation) VALUES(?, ?, ?, ?)",
+            [
+                (content_hash, puzzle_hash, None if self.asset_id is None else b"".join(lookup_keys), self.generation)
+                for content_hash, (puzzle_hash, lookup_keys) in zip(content_hashes, secured)
+            ],
+        )
+
+    def prune(self) -> int:
+        """
+        Drops every batch the current build hasn't used, returning how many were dropped.
+        """
+        cursor = self.connection.execute("DELETE FROM batches WHERE generation != ?", (self.generation,))
+        self.connection.commit()
+
+        return cursor.rowcount
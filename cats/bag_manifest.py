@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+from collections.abc import Iterator, Mapping, Sequence
+from functools import lru_cache
+from pathlib import Path
+
+from chia.types.blockchain_format.program import Program
+from chia.wallet.cat_wallet.cat_utils import CAT_MOD, construct_cat_puzzle
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint64
+
+from cats.progress import BagProgress
+from cats.secure_the_bag import (
+    PUZZLE_CACHE_SIZE,
+    CATOuterPuzzleHasher,
+    Target,
+    TargetCoin,
+    batch_puzzle,
+    level_width,
+    level_widths,
+    parse_level_widths,
+)
+
+SCHEMA = [
+    # One row describing how the bag was secured
+    # Leaf widths are comma separated from the leaves up, levels above the last width reuse it.
+    "CREATE TABLE bag(level_widths TEXT NOT NULL, asset_id BLOB, height INTEGER)",
+    # Every node in the tree. Level 0 holds the targets and the root is the only node at the top level, so the
+    # depth of a node from the root is `bag.height - level`. Children of the node at (level + 1, parent_position)
+    # are the contiguous positions [parent_position * width, (parent_position + 1) * width) at level, where width
+    # is the leaf width of level.
+    # Amounts are 8 byte big endian as sqlite integers are signed.
+    (
+        "CREATE TABLE nodes("
+        " level INTEGER NOT NULL,"
+        " position INTEGER NOT NULL,"
+        " parent_position INTEGER,"
+        " puzzle_hash BLOB NOT NULL,"
+        " lookup_key BLOB NOT NULL,"
+        " amount BLOB NOT NULL,"
+        " PRIMARY KEY(level, position)"
+        ") WITHOUT ROWID"
+    ),
+    "CREATE INDEX nodes_lookup_key ON nodes(lookup_key)",
+]
+
+
+class BagManifest(Mapping[bytes32, TargetCoin]):
+    """
+    SQLite backed index of every node in a secured bag.
+
+    Written once by secure_the_bag and opened by unwind_the_bag without rehashing the bag. The manifest can be used
+    anywhere a parent puzzle lookup is expected: keys are the (outer) puzzle hash of a node and values are
+    rebuilt from the children of its parent on demand, with the most recently used batch puzzles kept in a bounded
+    cache so walking a level rebuilds each batch once.
+    """
+
+    connection: sqlite3.Connection
+    level_widths: list[int]
+    asset_id: bytes32 | None
+    height: int | None
+
+    def __init__(self, connection: sqlite3.Connection, puzzle_cache_size: int = PUZZLE_CACHE_SIZE) -> None:
+        self.connection = connection
+        self._batch_puzzle = lru_cache(maxsize=puzzle_cache_size)(self._build_batch_puzzle)
+        # Next free position at each level and number of batches recorded at each level while writing
+        self._positions: dict[int, int] = {}
+        self._batches: dict[int, int] = {}
+
+        row = connection.execute("SELECT level_widths, asset_id, height FROM bag").fetchone()
+
+        if row is None:
+            raise Exception("Manifest does not describe a secured bag")
+
+        widths, asset_id, height = row
+        self.level_widths = parse_level_widths(widths)
+        self.asset_id = None if asset_id is None else bytes32(asset_id)
+        self.height = height
+        self._cat_hasher = None if self.asset_id is None else CATOuterPuzzleHasher(self.asset_id)
+
+    @classmethod
+    def create(cls, path: str | Path, leaf_width: int | Sequence[int], asset_id: bytes32 | None) -> BagManifest:
+        """
+        Creates an empty manifest, replacing any existing file at path.
+        """
+        if os.path.exists(path):
+            os.remove(path)
+
+        connection = sqlite3.connect(path)
+        for statement in SCHEMA:
+            connection.execute(statement)
+        widths = ",".join(str(width) for width in level_widths(leaf_width))
+        connection.execute("INSERT INTO bag(level_widths, asset_id) VALUES(?, ?)", (widths, asset_id))
+
+        return cls(connection)
+
+    @classmethod
+    def open(cls, path: str | Path) -> BagManifest:
+        if not os.path.exists(path):
+            raise Exception(f"Manifest {path} does not exist")
+
+        return cls(sqlite3.connect(path))
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def add_batch(self, level: int, batch_targets: list[Target], lookup_keys: list[bytes32]) -> None:
+        """
+        Records a batch of nodes at level which are all created by the next node at level + 1.
+        """
+        position = self._positions.get(level, 0)
+        parent_position = self._batches.get(level, 0)
+
+        self.connection.executemany(
+            "INSERT INTO nodes(level, position, parent_position, puzzle_hash, lookup_key, amount) "
+            "VALUES(?, ?, ?, ?, ?, ?)",
+            [
+                (level, position + index, parent_position, target.puzzle_hash, lookup_key, _amount_bytes(target.amount))
+                for index, (target, lookup_key) in enumerate(zip(batch_targets, lookup_keys))
+            ],
+        )
+
+        self._positions[level] = position + len(batch_targets)
+        self._batches[level] = parent_position + 1
+
+    def add_root(self, level: int, root: Target) -> None:
+        """
+        Records the root of the bag and commits the manifest.
+        """
+        self.connection.execute(
+            "INSERT INTO nodes(level, position, puzzle_hash, lookup_key, amount) VALUES(?, 0, ?, ?, ?)",
+            (level, root.puzzle_hash, self._lookup_key(root.puzzle_hash), _amount_bytes(root.amount)),
+        )
+        self.connection.execute("UPDATE bag SET height = ?", (level,))
+        self.connection.commit()
+
+        self.height = level
+
+    def _lookup_key(self, puzzle_hash: bytes32) -> bytes32:
+        if self._cat_hasher is None:
+            return puzzle_hash
+
+        return self._cat_hasher.outer_puzzle_hash(puzzle_hash)
+
+    def _require_height(self) -> int:
+        if self.height is None:
+            raise Exception("Manifest is incomplete, the bag root was never recorded")
+
+        return self.height
+
+    def root(self) -> Target:
+        row = self.connection.execute(
+            "SELECT puzzle_hash, amount FROM nodes WHERE level = ? AND position = 0", (self._require_height(),)
+        ).fetchone()
+
+        return Target(bytes32(row[0]), _amount_from_bytes(row[1]))
+
+    def node(self, level: int, position: int) -> Target | None:
+        row = self.connection.execute(
+            "SELECT puzzle_hash, amount FROM nodes WHERE level = ? AND position = ?", (level, position)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return Target(bytes32(row[0]), _amount_from_bytes(row[1]))
+
+    def level_size(self, level: int) -> int:
+        count: int = self.connection.execute("SELECT COUNT(*) FROM nodes WHERE level = ?", (level,)).fetchone()[0]
+
+        return count
+
+    def children(self, level: int, position: int) -> list[Target]:
+        """
+        Targets created by spending the node at level and position.
+        """
+        width = level_width(self.level_widths, level - 1)
+        first_child = position * width
+        rows = self.connection.execute(
+            "SELECT puzzle_hash, amount FROM nodes WHERE level = ? AND position >= ? AND position < ? "
+            "ORDER BY position",
+            (level - 1, first_child, first_child + width),
+        ).fetchall()
+
+        return [Target(bytes32(puzzle_hash), _amount_from_bytes(amount)) for puzzle_hash, amount in rows]
+
+    def __getitem__(self, key: bytes32) -> TargetCoin:
+        row = self.connection.execute(
+            "SELECT child.level, child.puzzle_hash, child.amount, parent.position, parent.lookup_key, parent.amount "
+            "FROM nodes AS child "
+            "JOIN nodes AS parent ON parent.level = child.level + 1 AND parent.position = child.parent_position "
+            "WHERE child.lookup_key = ?",
+            (key,),
+        ).fetchone()
+
+        if row is None:
+            raise KeyError(key)
+
+        level, puzzle_hash, amount, parent_position, parent_lookup_key, parent_amount = row
+
+        return TargetCoin(
+            Target(bytes32(puzzle_hash), _amount_from_bytes(amount)),
+            self._batch_puzzle(level + 1, parent_position),
+            _amount_from_bytes(parent_amount),
+            bytes32(parent_lookup_key),
+        )
+
+    def _build_batch_puzzle(self, level: int, position: int) -> Program:
+        puzzle = batch_puzzle(self.children(level, position))
+        if self.asset_id is not None:
+            puzzle = construct_cat_puzzle(CAT_MOD, self.asset_id, puzzle)
+
+        return puzzle
+
+    def __iter__(self) -> Iterator[bytes32]:
+        # Nodes are stored by level and position so siblings come together and share a cached batch puzzle
+        cursor = self.connection.execute("SELECT lookup_key FROM nodes WHERE parent_position IS NOT NULL")
+
+        for (lookup_key,) in cursor:
+            yield bytes32(lookup_key)
+
+    def __len__(self) -> int:
+        count: int = self.connection.execute("SELECT COUNT(*) FROM nodes WHERE parent_position IS NOT NULL").fetchone()[
+            0
+        ]
+
+        return count
+
+
+class ManifestVerifier(BagProgress):
+    """
+    Checks each batch of a bag as it is secured against the node recorded for it in a manifest.
+
+    Levels are secured from the leaves up, so the first batch that differs is the lowest subtree that doesn't match
+    and securing stops there with an exception describing it.
+    """
+
+    manifest: BagManifest
+
+    def __init__(self, manifest: BagManifest) -> None:
+        super().__init__()
+        self.manifest = manifest
+
+    def batch_secured(self, batch_targets: list[Target], puzzle_hash: bytes32) -> None:
+        super().batch_secured(batch_targets, puzzle_hash)
+
+        level = self.height + 1
+        position = self.batches - 1
+        node = self.manifest.node(level, position)
+
+        if node is not None and node.puzzle_hash == puzzle_hash:
+            return
+
+        if node is None:
+            raise Exception(f"Subtree at level {level} position {position} is not in the manifest")
+
+        # Find the first child that differs, or where one batch runs out of children
+        expected_children = self.manifest.children(level, position)
+        index = 0
+        while (
+            index < min(len(batch_targets), len(expected_children))
+            and batch_targets[index].puzzle_hash == expected_children[index].puzzle_hash
+            and batch_targets[index].amount == expected_children[index].amount
+        ):
+            index += 1
+
+        differing_child = position * level_width(self.manifest.level_widths, self.height) + index
+
+        raise Exception(
+            f"Subtree at level {level} position {position} does not match the manifest, expected puzzle hash "
+            f"{node.puzzle_hash} but got {puzzle_hash}. The first differing node is at level {self.height} "
+            f"position {differing_child}"
+        )
+
+    def level_finished(self, coins: int) -> None:
+        expected_coins = self.manifest.level_size(self.height + 1)
+
+        if coins != expected_coins:
+            raise Exception(f"Level {self.height + 1} has {coins} nodes but the manifest has {expected_coins}")
+
+    def finished(self, root_puzzle_hash: bytes32, height: int) -> None:
+        root = self.manifest.root()
+
+        if self.manifest.height != height or root.puzzle_hash != root_puzzle_hash:
+            raise Exception(f"Bag root {root_puzzle_hash} does not match the manifest root {root.puzzle_hash}")
+
+
+def _amount_bytes(amount: int) -> bytes:
+    return amount.to_bytes(8, "big")
+
+
+def _amount_from_bytes(amount: bytes) -> uint64:
+    return uint64(int.from_bytes(amount, "big"))
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+from typing import Any, Protocol
+
+from chia_rs.sized_bytes import bytes32
+
+from cats.unwind_frontier import FRONTIER_CHUNK_SIZE, CoinRecordSource, NodeState, coin_states
+
+# Seconds between checks of the peak height, coins are only looked up again once it changes
+POLL_INTERVAL = 3
+
+# Polls in a row that can fail, for example on a transient RPC error, before every waiter is failed with the error
+MAX_POLL_FAILURES = 10
+
+
+class FullNodeSource(CoinRecordSource, Protocol):
+    """
+    The part of FullNodeRpcClient needed to watch coins.
+    """
+
+    async def get_blockchain_state(self) -> dict[str, Any]: ...
+
+
+class CoinWatcher:
+    """
+    Waits on the state of any number of coins with a single polling task.
+
+    Every watched coin is looked up together with get_coin_records_by_names, and only when the peak height changes or
+    new coins start being watched, so the load on the full node doesn't grow with the number of waiters.
+    """
+
+    full_node_client: FullNodeSource
+    poll_interval: float
+    chunk_size: int
+    max_poll_failures: int
+    # Peak height at the last successful poll
+    peak_height: int | None
+
+    def __init__(
+        self,
+        full_node_client: FullNodeSource,
+        poll_interval: float = POLL_INTERVAL,
+        chunk_size: int = FRONTIER_CHUNK_SIZE,
+        max_poll_failures: int = MAX_POLL_FAILURES,
+    ) -> None:
+        self.full_node_client = full_node_client
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        self.max_poll_failures = max_poll_failures
+        # Coin name -> futures waiting for the coin to reach a state
+        self._waiters: dict[bytes32, list[tuple[NodeState, asyncio.Future[None]]]] = {}
+        self._new_coin_names: set[bytes32] = set()
+        self._wake = asyncio.Event()
+        self.peak_height = None
+        self._task: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+
+        self._task = None
+
+    async def wait_for_unspent(self, coin_name: bytes32) -> None:
+        """
+        Waits until the coin is created. Raises an exception if the coin has already been spent.
+        """
+        await self._wait(coin_name, NodeState.UNSPENT)
+
+    async def wait_for_spend(self, coin_name: bytes32) -> None:
+        """
+        Waits until the coin is spent. This is used to wait for coins to be spent before spending their children.
+        """
+        await self._wait(coin_name, NodeState.SPENT)
+
+    async def _wait(self, coin_name: bytes32, state: NodeState) -> None:
+        self.start()
+
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(coin_name, []).append((state, future))
+        self._new_coin_names.add(coin_name)
+        self._wake.set()
+
+        try:
+            await future
+        finally:
+            waiters = self._waiters.get(coin_name, [])
+            if (state, future) in waiters:
+                waiters.remove((state, future))
+            if len(waiters) == 0:
+                self._waiters.pop(coin_name, None)
+
+    async def _current_peak_height(self) -> int | None:
+        blockchain_state = await self.full_node_client.get_blockchain_state()
+        peak = blockchain_state.get("peak")
+
+        return None if peak is None else int(peak.height)
+
+    async def poll(self) -> None:
+        """
+        Looks up watched coins if the peak height changed since the last poll, or just newly watched coins if not.
+        """
+        peak_height = await self._current_peak_height()
+
+        if peak_height != self.peak_height:
+            coin_names = list(self._waiters)
+        else:
+            coin_names = [coin_name for coin_name in self._new_coin_names if coin_name in self._waiters]
+
+        states: dict[bytes32, NodeState] = {}
+        if len(coin_names) > 0:
+            states, _ = await coin_states(self.full_node_client, coin_names, self.chunk_size)
+
+        # Only recorded once the coins were looked up, so a failed poll looks them up again next time
+        self.peak_height = peak_height
+        self._new_coin_names.difference_update(coin_names)
+
+        for coin_name, coin_state in states.items():
+            for state, future in self._waiters.get(coin_name, []):
+                if future.done():
+                    continue
+
+                if coin_state == state:
+                    future.set_result(None)
+                elif state == NodeState.UNSPENT and coin_state == NodeState.SPENT:
+                    future.set_exception(Exception(f"Coin {coin_name} has already been spent"))
+
+    def _fail_waiters(self, error: Exception) -> None:
+        for waiters in self._waiters.values():
+            for _, future in waiters:
+                if not future.done():
+                    future.set_exception(error)
+
+    async def _run(self) -> None:
+        failures = 0
+
+        while True:
+            self._wake.clear()
+
+            if len(self._waiters) > 0:
+                try:
+                    await self.poll()
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    print(f"Failed to look up watched coins ({failures} of {self.max_poll_failures} attempts): {e}")
+
+                    # Waiters would otherwise hang forever on an error that doesn't go away
+                    if failures >= self.max_poll_failures:
+                        self._fail_waiters(e)
+                        failures = 0
+
+            # New waiters are looked up straight away rather than at the next interval
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+from functools import cache
+
+from chia.consensus.default_constants import DEFAULT_CONSTANTS
+from chia.types.blockchain_format.coin import Coin
+from chia.types.blockchain_format.program import Program
+from chia.types.coin_spend import make_spend
+from chia.types.condition_opcodes import ConditionOpcode
+from chia.util.hash import std_hash
+from chia.wallet.cat_wallet.cat_utils import (
+    CAT_MOD,
+    SpendableCAT,
+    construct_cat_puzzle,
+    match_cat_puzzle,
+    unsigned_spend_bundle_for_spendable_cats,
+)
+from chia.wallet.lineage_proof import LineageProof
+from chia.wallet.puzzles.p2_delegated_puzzle_or_hidden_puzzle import puzzle_for_pk, solution_for_delegated_puzzle
+from chia.wallet.uncurried_puzzle import uncurry_puzzle
+from chia_rs import CoinSpend, G1Element, G2Element, SpendBundle, get_conditions_from_spendbundle
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint64
+from clvm.casts import int_to_bytes
+
+from cats.secure_the_bag import Target, batch_puzzle
+
+# Amount of each target when measuring costs, larger amounts cost slightly more as they take more bytes
+COST_TARGET_AMOUNT = 10**12
+
+# The mempool rejects spend bundles that cost more than half a block
+MAX_SPEND_BUNDLE_COST = DEFAULT_CONSTANTS.MAX_BLOCK_COST_CLVM // 2
+
+
+def max_bundle_cost(max_block_cost_fraction: float) -> int:
+    """
+    Most a spend bundle can cost when each block can be expected to fit max_block_cost_fraction of the maximum block
+    cost, and no more than the mempool accepts.
+    """
+    return min(int(DEFAULT_CONSTANTS.MAX_BLOCK_COST_CLVM * max_block_cost_fraction), MAX_SPEND_BUNDLE_COST)
+
+
+def _spend_bundle_cost(coin_spends: list[CoinSpend]) -> int:
+    conditions = get_conditions_from_spendbundle(
+        SpendBundle(coin_spends, G2Element()),
+        DEFAULT_CONSTANTS.MAX_BLOCK_COST_CLVM,
+        DEFAULT_CONSTANTS,
+        DEFAULT_CONSTANTS.HARD_FORK_HEIGHT,
+    )
+
+    return int(conditions.cost)
+
+
+def _cat_spend_cost(inner_puzzle: Program, amount: uint64, parent_amount: uint64) -> int:
+    asset_id = bytes32(std_hash(b"asset id"))
+
+    # Lineage proof has to be consistent with the parent coin for the CAT to run
+    parent_inner_puzzle = Program.to(1)
+    parent = Coin(
+        bytes32(std_hash(b"grandparent")),
+        construct_cat_puzzle(CAT_MOD, asset_id, parent_inner_puzzle).get_tree_hash(),
+        parent_amount,
+    )
+    coin = Coin(parent.name(), construct_cat_puzzle(CAT_MOD, asset_id, inner_puzzle).get_tree_hash(), amount)
+
+    spend_bundle = unsigned_spend_bundle_for_spendable_cats(
+        CAT_MOD,
+        [
+            SpendableCAT(
+                coin,
+                asset_id,
+                inner_puzzle,
+                Program.to([]),
+                lineage_proof=LineageProof(parent.parent_coin_info, parent_inner_puzzle.get_tree_hash(), parent_amount),
+            )
+        ],
+    )
+
+    return _spend_bundle_cost(spend_bundle.coin_spends)
+
+
+@cache
+def unwind_spend_cost(width: int) -> int:
+    """
+    Cost charged by the mempool to spend one secure the bag CAT that creates width coins.
+
+    Includes the CLVM execution, the conditions and the bytes of a real CAT spend of a `(q . conditions)` batch puzzle.
+    The lineage proof uses the largest possible parent amount, the same bound as cat_unwind_spend_cost, so a planned
+    width is never costed below the spends the scheduler packs.
+    """
+    targets = [Target(bytes32(std_hash(int_to_bytes(i))), uint64(COST_TARGET_AMOUNT)) for i in range(width)]
+
+    return _cat_spend_cost(batch_puzzle(targets), uint64(COST_TARGET_AMOUNT * width), uint64(2**64 - 1))
+
+
+def cat_unwind_spend_cost(coin_spend: CoinSpend) -> int:
+    """
+    Cost charged by the mempool to spend one bag coin, measured on a real CAT spend of the coin's own batch puzzle.
+
+    The lineage proof uses the largest possible parent amount so the cost is never below that of the actual spend.
+    """
+    curried_args = match_cat_puzzle(uncurry_puzzle(coin_spend.puzzle_reveal))
+
+    if curried_args is None:
+        raise Exception("Expected CAT")
+
+    _, _, inner_puzzle = curried_args
+
+    return _cat_spend_cost(inner_puzzle, uint64(coin_spend.coin.amount), uint64(2**64 - 1))
+
+
+@cache
+def fee_spend_cost(cat_spends: int) -> int:
+    """
+    Cost charged by the mempool for the standard wallet spend paying the fee of an unwind spend bundle, which asserts
+    an announcement from each of cat_spends CAT spends and creates change.
+    """
+    # The assertions have to be met for the bundle to be valid, so another coin makes the announcements and its own
+    # cost is taken off
+    messages = [int_to_bytes(i) for i in range(cat_spends)]
+    announcer_puzzle = Program.to((1, [[ConditionOpcode.CREATE_COIN_ANNOUNCEMENT, message] for message in messages]))
+    announcer = Coin(bytes32(std_hash(b"announcer parent")), announcer_puzzle.get_tree_hash(), uint64(0))
+    announcer_spend = make_spend(announcer, announcer_puzzle, Program.to([]))
+
+    conditions = [
+        [ConditionOpcode.CREATE_COIN, std_hash(b"change"), 2**63],
+        [ConditionOpcode.RESERVE_FEE, 2**63 - 1],
+    ]
+    conditions += [
+        [ConditionOpcode.ASSERT_COIN_ANNOUNCEMENT, std_hash(announcer.name() + message)] for message in messages
+    ]
+    puzzle = puzzle_for_pk(G1Element.generator())
+    coin = Coin(bytes32(std_hash(b"fee coin parent")), puzzle.get_tree_hash(), uint64(2**64 - 1))
+    fee_spend = make_spend(coin, puzzle, solution_for_delegated_puzzle(Program.to((1, conditions)), Program.to(0)))
+
+    return _spend_bundle_cost([announcer_spend, fee_spend]) - _spend_bundle_cost([announcer_spend])
+
+
+class FanOutPlan:
+    """
+    Leaf widths for each level of a bag from the leaves up and what it takes to fully unwind it.
+    """
+
+    widths: list[int]
+    spends: list[int]
+    costs: list[int]
+    blocks: list[int]
+    spends_per_bundle: list[int]
+
+    def __init__(self) -> None:
+        self.widths = []
+        self.spends = []
+        self.costs = []
+        self.blocks = []
+        self.spends_per_bundle = []
+
+    def add_level(self, width: int, spends: int, cost: int, blocks: int, spends_per_bundle: int) -> None:
+        self.widths.append(width)
+        self.spends.append(spends)
+        self.costs.append(cost)
+        self.blocks.append(blocks)
+        self.spends_per_bundle.append(spends_per_bundle)
+
+    def total_spends(self) -> int:
+        return sum(self.spends)
+
+    def total_cost(self) -> int:
+        return sum(self.costs)
+
+    def total_blocks(self) -> int:
+        return sum(self.blocks)
+
+    def leaf_width(self) -> str:
+        """
+        Value to pass to --leaf-width to build this plan.
+        """
+        return ",".join(str(width) for width in self.widths)
+
+
+def estimated_unwind_spend_cost(width: int) -> int:
+    """
+    Unwind spend cost extrapolated from two measured spends, each extra coin created adds the same cost.
+    """
+    spend_cost = unwind_spend_cost(1)
+    coin_cost = unwind_spend_cost(2) - spend_cost
+
+    return spend_cost + (width - 1) * coin_cost
+
+
+def max_unwind_width(max_cost: int, max_width: int | None = None) -> int:
+    """
+    Widest batch whose unwind spend costs at most max_cost, checked against the real cost.
+    """
+    spend_cost = unwind_spend_cost(1)
+    coin_cost = unwind_spend_cost(2) - spend_cost
+
+    width = (max_cost - spend_cost) // coin_cost + 1
+    if max_width is not None:
+        width = min(width, max_width)
+
+    while width >= 2 and unwind_spend_cost(width) > max_cost:
+        width -= 1
+
+    if width < 2:
+        raise Exception(f"Not even a leaf width of 2 fits in a spend bundle costing {max_cost}")
+
+    return width
+
+
+def plan_fan_out(
+    target_count: int,
+    max_block_cost_fraction: float = 0.5,
+    max_width: int | None = None,
+    reserved_cost: int = 0,
+) -> FanOutPlan:
+    """
+    Recommends leaf widths for each level of a bag so that fully unwinding it takes as few blocks as possible, and
+    then as few spends, and so fees, as possible.
+
+    Every level has to be unwound in a later block than the level above it, and each block fits whole spends costing
+    up to max_block_cost_fraction of the maximum block cost. A spend must also fit in a single spend bundle alongside
+    reserved_cost, which can be set aside for the fee spend unwind_the_bag adds to each bundle.
+    """
+    if target_count < 2:
+        raise Exception(f"At least 2 targets are needed to plan a bag but got {target_count}")
+
+    block_budget = int(DEFAULT_CONSTANTS.MAX_BLOCK_COST_CLVM * max_block_cost_fraction)
+    bundle_budget = max_bundle_cost(max_block_cost_fraction) - reserved_cost
+    widest = max_unwind_width(bundle_budget, max_width)
+
+    def level(node_count: int, width: int) -> tuple[int, int]:
+        spends = -(-node_count // width)
+        blocks = -(-spends // (block_budget // estimated_unwind_spend_cost(width)))
+
+        return blocks, spends
+
+    # Only the widest width that fits each number of spends in a block is worth considering
+    widths = [widest]
+    while True:
+        spends_per_block = block_budget // estimated_unwind_spend_cost(widths[-1]) + 1
+        width = (block_budget // spends_per_block - unwind_spend_cost(1)) // (
+            unwind_spend_cost(2) - unwind_spend_cost(1)
+        ) + 1
+
+        if width < 2:
+            break
+
+        widths.append(width)
+
+    # Fewest (blocks, spends) and the width to use to reduce node_count nodes down to the root
+    @cache
+    def best(node_count: int) -> tuple[int, int, int]:
+        # Nothing beats a single spend straight to the root
+        if node_count <= widest:
+            return 1, 1, node_count
+
+        options = []
+
+        for width in widths:
+            blocks, spends = level(node_count, width)
+            above_blocks, above_spends, _ = best(spends)
+            options.append((blocks + above_blocks, spends + above_spends, width))
+
+        return min(options)
+
+    plan = FanOutPlan()
+    node_count = target_count
+
+    while node_count > 1:
+        _, _, width = best(node_count)
+        blocks, spends = level(node_count, width)
+
+        full_batches, remainder = divmod(node_count, width)
+        cost = full_batches * estimated_unwind_spend_cost(width)
+        if remainder > 0:
+            cost += estimated_unwind_spend_cost(remainder)
+
+        plan.add_level(width, spends, cost, blocks, bundle_budget // estimated_unwind_spend_cost(width))
+        node_count = spends
+
+    best.cache_clear()
+
+    # The search used estimated costs so make sure the real spends fit
+    for width in plan.widths:
+        if unwind_spend_cost(width) > bundle_budget:
+            raise Exception(f"Unwind spend of width {width} does not fit in a spend bundle")
+
+    return plan
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import asyncio
+
+from chia.util.bech32m import decode_puzzle_hash
+from chia.wallet.util.tx_config import DEFAULT_TX_CONFIG
+from chia.wallet.wallet_request_types import Addition, CreateSignedTransaction, GetNextAddress, PushTX
+from chia.wallet.wallet_rpc_client import WalletRpcClient
+from chia_rs import Coin
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint32, uint64
+
+from cats.coin_watcher import CoinWatcher
+
+
+def fee_coin_amount(total_fees: int, count: int, max_bundle_fee: int) -> int:
+    """
+    Amount of each of count pool coins so that together they pay total_fees, however unevenly bundles draw on them.
+
+    On top of an even share of the fees every coin holds one extra bundle's fee, so the largest coin can always pay
+    the next bundle.
+    """
+    return -(-total_fees // count) + max_bundle_fee
+
+
+class FeeCoinPool:
+    """
+    Wallet coins split off up front to pay the fees of unwind bundles.
+
+    Coins are handed out locally so bundles in flight at the same time never compete for the same coins, and no coin
+    selection or change address lookup is needed for each bundle. Each bundle spends one pool coin and sends its change
+    back to the pool, where it can be used again once the bundle is confirmed.
+    """
+
+    coin_watcher: CoinWatcher
+    puzzle_hash: bytes32
+
+    def __init__(self, coin_watcher: CoinWatcher, puzzle_hash: bytes32, coins: list[Coin]) -> None:
+        self.coin_watcher = coin_watcher
+        self.puzzle_hash = puzzle_hash
+        self._available = list(coins)
+        # Coins that may not have been created yet, such as change from bundles waiting to be confirmed
+        self._pending: list[Coin] = []
+
+    def __len__(self) -> int:
+        return len(self._available) + len(self._pending)
+
+    async def take(self, amount: int) -> Coin:
+        """
+        Removes the largest pool coin to pay a fee of amount, waiting for change from earlier bundles when no coin that
+        has been created can pay it.
+        """
+        while True:
+            if len(self._available) > 0:
+                coin = max(self._available, key=lambda coin: coin.amount)
+
+                if coin.amount >= amount:
+                    self._available.remove(coin)
+                    return coin
+
+            if len(self._pending) == 0:
+                raise Exception(f"No fee coin left in the pool can pay a fee of {amount}")
+
+            await self._wait_for_change()
+
+    def change_coin(self, fee_coin: Coin, fee: int) -> Coin:
+        """
+        Change returned to the pool by a bundle paying fee from fee_coin. A single fee coin creates the change itself.
+        """
+        return Coin(fee_coin.name(), self.puzzle_hash, uint64(fee_coin.amount - fee))
+
+    def add_pending(self, coin: Coin) -> None:
+        """
+        Adds a coin to the pool that can be used once it has been created, such as the change from spending a pool coin.
+        """
+        if coin.amount > 0:
+            self._pending.append(coin)
+
+    async def _wait_for_change(self) -> None:
+        waits = {asyncio.ensure_future(self.coin_watcher.wait_for_unspent(coin.name())): coin for coin in self._pending}
+
+        try:
+            done, _ = await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in waits:
+                task.cancel()
+
+        for task in done:
+            task.result()
+            coin = waits[task]
+            self._pending.remove(coin)
+            self._available.append(coin)
+
+
+async def split_fee_coins(
+    wallet_client: WalletRpcClient,
+    wallet_id: int,
+    coin_watcher: CoinWatcher,
+    count: int,
+    amount: int,
+    fee: int,
+) -> list[Coin]:
+    """
+    Splits wallet funds into count fee coins of at least amount in a single transaction, and waits for them to be
+    created. Every coin shares one puzzle hash.
+    """
+    address = await wallet_client.get_next_address(
+        request=GetNextAddress(wallet_id=uint32(wallet_id), new_address=False)
+    )
+    puzzle_hash = decode_puzzle_hash(address.address)
+
+    # Coins created by the same spend need different amounts or puzzle hashes to have different ids
+    amounts = [amount + i for i in range(count)]
+    split_tx = await wallet_client.create_signed_transactions(
+        CreateSignedTransaction(
+            additions=[Addition(amount=uint64(coin_amount), puzzle_hash=puzzle_hash) for coin_amount in amounts],
+            wallet_id=uint32(wallet_id),
+            fee=uint64(fee),
+        ),
+        tx_config=DEFAULT_TX_CONFIG,
+    )
+    if split_tx.signed_tx.spend_bundle is None:
+        raise Exception("No spend bundle created")
+
+    coins = [
+        coin
+        for coin in split_tx.signed_tx.spend_bundle.additions()
+        if coin.puzzle_hash == puzzle_hash and coin.amount in amounts
+    ]
+    if len(coins) < count:
+        raise Exception(f"Expected the split to create {count} fee coins but it created {len(coins)}")
+
+    await wallet_client.push_tx(PushTX(spend_bundle=split_tx.signed_tx.spend_bundle))
+
+    print(f"Waiting for {count} fee coins of {amount} mojos to be created")
+    await asyncio.gather(*(coin_watcher.wait_for_unspent(coin.name()) for coin in coins))
+
+    return coins
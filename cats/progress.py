@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import json
+import sys
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, TextIO
+
+from chia_rs.sized_bytes import bytes32
+
+if TYPE_CHECKING:
+    from cats.secure_the_bag import Target
+
+# Bytes of every node secured into a batch, its 32 byte puzzle hash and 8 byte amount
+NODE_BYTES = 40
+
+# Minimum number of seconds between redraws of a progress bar
+PROGRESS_BAR_INTERVAL = 0.25
+
+
+def peak_rss_bytes() -> int | None:
+    """
+    Peak resident memory of this process, or None where it can't be measured.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes and macOS reports bytes
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+class BagProgress:
+    """
+    Hooks called by secure_the_bag as each level of a bag is secured, which do nothing by default.
+
+    Timings and counts for the level being secured are kept here so subclasses only have to report them. Hooks are
+    called once per batch, so subclasses should keep batch_secured cheap and throttle any output.
+    """
+
+    height: int
+    batches: int
+    nodes: int
+    level_start: float
+
+    def __init__(self) -> None:
+        self.height = 0
+        self.batches = 0
+        self.nodes = 0
+        self.level_start = time.perf_counter()
+
+    def level_started(self, height: int, total_nodes: int | None) -> None:
+        """
+        Called before the first batch of a level, with the number of nodes in the level when it's known.
+        """
+        self.height = height
+        self.batches = 0
+        self.nodes = 0
+        self.level_start = time.perf_counter()
+
+    def batch_secured(self, batch_targets: list[Target], puzzle_hash: bytes32) -> None:
+        """
+        Called with the targets of each batch and the (inner) puzzle hash of the coin that creates them.
+        """
+        self.batches += 1
+        self.nodes += len(batch_targets)
+
+    def level_finished(self, coins: int) -> None:
+        """
+        Called once every batch in a level is secured into coins.
+        """
+
+    def finished(self, root_puzzle_hash: bytes32, height: int) -> None:
+        """
+        Called once the bag has collapsed to its root.
+        """
+
+    def level_metrics(self, coins: int) -> dict[str, Any]:
+        seconds = time.perf_counter() - self.level_start
+
+        return {
+            "level": self.height,
+            "nodes": self.nodes,
+            "batches": self.batches,
+            "coins": coins,
+            "seconds": seconds,
+            "batches_per_second": self.batches / seconds if seconds > 0 else None,
+            "bytes_secured": self.nodes * NODE_BYTES,
+            "peak_rss_bytes": peak_rss_bytes(),
+        }
+
+
+class PrintProgress(BagProgress):
+    """
+    Prints a line as each level is secured.
+    """
+
+    def level_finished(self, coins: int) -> None:
+        print(f"Secured level {self.height} of the bag into {coins} coins")
+
+
+class ProgressBar(BagProgress):
+    """
+    Redraws a single line with the progress of the level being secured, at most every PROGRESS_BAR_INTERVAL seconds.
+    """
+
+    def __init__(self, output: TextIO = sys.stderr) -> None:
+        super().__init__()
+        self.output = output
+        self.total_nodes: int | None = None
+        self._last_draw = 0.0
+
+    def level_started(self, height: int, total_nodes: int | None) -> None:
+        super().level_started(height, total_nodes)
+        self.total_nodes = total_nodes
+
+    def batch_secured(self, batch_targets: list[Target], puzzle_hash: bytes32) -> None:
+        super().batch_secured(batch_targets, puzzle_hash)
+
+        now = time.perf_counter()
+        if now - self._last_draw >= PROGRESS_BAR_INTERVAL:
+            self._last_draw = now
+            self.draw(now)
+
+    def draw(self, now: float, end: str = "") -> None:
+        seconds = now - self.level_start
+        rate = self.batches / seconds if seconds > 0 else 0
+
+        if self.total_nodes is None:
+            bar = f"{self.nodes} nodes"
+        else:
+            done = self.nodes / self.total_nodes if self.total_nodes > 0 else 1
+            filled = int(done * 30)
+            bar = f"[{'#' * filled}{'.' * (30 - filled)}] {done:6.1%}"
+
+        self.output.write(f"\rLevel {self.height}: {bar} {self.batches} batches {rate:.0f} batches/s{end}")
+        self.output.flush()
+
+    def level_finished(self, coins: int) -> None:
+        self.draw(time.perf_counter(), f" -> {coins} coins\n")
+
+
+class JsonLinesProgress(BagProgress):
+    """
+    Appends the metrics of every level, and then of the whole bag, to a JSON lines file.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        super().__init__()
+        self.path = path
+        self.start = time.perf_counter()
+
+    def write(self, record: dict[str, Any]) -> None:
+        with open(self.path, "a") as metrics_file:
+            metrics_file.write(json.dumps(record) + "\n")
+
+    def level_finished(self, coins: int) -> None:
+        self.write(self.level_metrics(coins))
+
+    def finished(self, root_puzzle_hash: bytes32, height: int) -> None:
+        self.write(
+            {
+                "root_puzzle_hash": root_puzzle_hash.hex(),
+                "height": height,
+                "seconds": time.perf_counter() - self.start,
+                "peak_rss_bytes": peak_rss_bytes(),
+            }
+        )
+
+
+class CombinedProgress(BagProgress):
+    """
+    Passes every hook on to several progress hooks, e.g. a progress bar and a metrics file.
+    """
+
+    def __init__(self, *progresses: BagProgress) -> None:
+        super().__init__()
+        self.progresses = progresses
+
+    def level_started(self, height: int, total_nodes: int | None) -> None:
+        for progress in self.progresses:
+            progress.level_started(height, total_nodes)
+
+    def batch_secured(self, batch_targets: list[Target], puzzle_hash: bytes32) -> None:
+        for progress in self.progresses:
+            progress.batch_secured(batch_targets, puzzle_hash)
+
+    def level_finished(self, coins: int) -> None:
+        for progress in self.progresses:
+            progress.level_finished(coins)
+
+    def finished(self, root_puzzle_hash: bytes32, height: int) -> None:
+        for progress in self.progresses:
+            progress.finished(root_puzzle_hash, height)
+
+
+def progress_from_options(progress_bar: bool, metrics_path: str | None) -> BagProgress:
+    """
+    Progress hooks for the --progress and --metrics-path command line options.
+    """
+    progress: BagProgress = ProgressBar() if progress_bar else PrintProgress()
+
+    if metrics_path is None:
+        return progress
+
+    return CombinedProgress(progress, JsonLinesProgress(metrics_path))
@@ -1,28 +1,61 @@
 from __future__ import annotations
 
+import contextlib
 import csv
+import multiprocessing
+import os
 import re
-from collections.abc import Iterable
-from typing import Any
+from array import array
+from bisect import bisect_right
+from collections.abc import Iterable, Iterator, Mapping, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from hashlib import sha256
+from itertools import chain, islice, repeat
+from typing import TYPE_CHECKING, Any, overload
 
 import click
 from chia.types.blockchain_format.coin import Coin
 from chia.types.blockchain_format.program import Program
 from chia.types.coin_spend import make_spend
 from chia.types.condition_opcodes import ConditionOpcode
-from chia.util.bech32m import encode_puzzle_hash
+from chia.util.bech32m import decode_puzzle_hash, encode_puzzle_hash
 from chia.util.byte_types import hexstr_to_bytes
-from chia.wallet.cat_wallet.cat_utils import CAT_MOD, construct_cat_puzzle
+from chia.wallet.cat_wallet.cat_utils import CAT_MOD, CAT_MOD_HASH, CAT_MOD_HASH_HASH, construct_cat_puzzle
+from chia.wallet.util.curry_and_treehash import (
+    A_KW_TREEHASH,
+    C_KW_TREEHASH,
+    NIL_TREEHASH,
+    ONE_TREEHASH,
+    Q_KW_TREEHASH,
+    shatree_atom,
+    shatree_pair,
+)
 from chia_rs import CoinSpend
 from chia_rs.sized_bytes import bytes32
 from chia_rs.sized_ints import uint64
+from clvm.casts import int_to_bytes
 from clvm_tools.binutils import assemble
 from clvm_tools.clvmc import compile_clvm_text
 
+if TYPE_CHECKING:
+    from cats.bag_cache import BagCache
+    from cats.bag_manifest import BagManifest
+    from cats.progress import BagProgress
+
 # Fees spend asserts this. Message not required as inner puzzle contains hardcoded coin spends
 # and doesn't accept a solution.
 EMPTY_COIN_ANNOUNCEMENT = [ConditionOpcode.CREATE_COIN_ANNOUNCEMENT, b"$"]
 
+# Number of recently spent batch puzzles a parent puzzle lookup keeps built, enough for every ancestor of a batch
+PUZZLE_CACHE_SIZE = 1024
+
+# Slots in the node index of an empty ParentPuzzleLookup, always a power of two
+INDEX_MIN_SLOTS = 16
+
+# Batches looked up in a bag cache at once when securing without a process pool
+CACHE_WINDOW_SIZE = 1024
+
 
 # The clvm loaders in this library automatically search for includable files in the directory './include'
 def append_include(search_paths: Iterable[str]) -> list[str]:
@@ -60,6 +93,8 @@ def parse_program(program: str | Program, include: Iterable[str] = []) -> Progra
 
 
 class Target:
+    __slots__ = ("amount", "puzzle_hash")
+
     puzzle_hash: bytes32
     amount: uint64
 
@@ -77,138 +112,830 @@ class Target:
 
 
 class TargetCoin:
+    __slots__ = ("amount", "puzzle", "puzzle_hash", "target")
+
     target: Target
     puzzle: Program
     puzzle_hash: bytes32
     amount: uint64
 
-    def __init__(self, target: Target, puzzle: Program, amount: uint64) -> None:
+    def __init__(self, target: Target, puzzle: Program, amount: uint64, puzzle_hash: bytes32 | None = None) -> None:
         self.target = target
         self.puzzle = puzzle
-        self.puzzle_hash = puzzle.get_tree_hash()
+        # Callers that already know the tree hash can pass it in to skip rehashing the puzzle
+        self.puzzle_hash = puzzle.get_tree_hash() if puzzle_hash is None else puzzle_hash
         self.amount = amount
 
 
-def batch_the_bag(targets: list[Target], leaf_width: int) -> list[list[Target]]:
+class PackedTargets(Sequence[Target]):
     """
-    Batches the bag by leaf width.
+    Targets stored as contiguous 32 byte puzzle hashes and 64 bit amounts instead of an object per target.
+
+    Indexing and iterating create short lived Target views so large bags fit comfortably in memory.
+    """
+
+    __slots__ = ("amounts", "puzzle_hashes")
+
+    puzzle_hashes: bytearray
+    amounts: array[int]
+
+    def __init__(self, targets: Iterable[Target] = ()) -> None:
+        self.puzzle_hashes = bytearray()
+        self.amounts = array("Q")
+
+        for target in targets:
+            self.append(target.puzzle_hash, target.amount)
+
+    def append(self, puzzle_hash: bytes32, amount: int) -> None:
+        self.puzzle_hashes += puzzle_hash
+        self.amounts.append(amount)
+
+    def extend(self, targets: PackedTargets) -> None:
+        self.puzzle_hashes += targets.puzzle_hashes
+        self.amounts.extend(targets.amounts)
+
+    def puzzle_hash(self, index: int) -> bytes32:
+        return bytes32(self.puzzle_hashes[index * 32 : (index + 1) * 32])
+
+    def amount(self, index: int) -> uint64:
+        return uint64(self.amounts[index])
+
+    def total_amount(self) -> int:
+        return sum(self.amounts)
+
+    def __len__(self) -> int:
+        return len(self.amounts)
+
+    @overload
+    def __getitem__(self, index: int) -> Target: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> PackedTargets: ...
+
+    def __getitem__(self, index: int | slice) -> Target | PackedTargets:
+        if isinstance(index, slice):
+            return PackedTargets(self[i] for i in range(*index.indices(len(self))))
+
+        if index < 0:
+            index += len(self)
+
+        if index < 0 or index >= len(self):
+            raise IndexError("target index out of range")
+
+        return Target(self.puzzle_hash(index), self.amount(index))
+
+    def __iter__(self) -> Iterator[Target]:
+        for index in range(len(self)):
+            yield Target(self.puzzle_hash(index), self.amount(index))
+
+
+class ParentPuzzleLookup(Mapping[bytes32, TargetCoin]):
+    """
+    Lookup from the (outer) puzzle hash of every node in a bag to the coin that creates it.
+
+    Nodes are stored in packed arrays in the order they were added. The targets of a batch are contiguous, so a batch
+    is just the index of its first node alongside its puzzle hash and amount. Batch puzzles are rebuilt from their
+    targets when a TargetCoin is looked up, with the most recently used kept in a bounded cache.
+
+    Nodes are indexed as they are added in a packed open addressing table of node numbers, at most half full and probed
+    from the first bytes of each key. Keys are tree hashes so those bytes are evenly spread, and the index costs a few
+    bytes per node rather than a dictionary of objects or a sort of every key once the bag is built.
+    """
+
+    __slots__ = (
+        "_batch_puzzle",
+        "_index",
+        "_index_mask",
+        "_lookup_keys",
+        "asset_id",
+        "batch_amounts",
+        "batch_puzzle_hashes",
+        "batch_starts",
+        "targets",
+    )
+
+    asset_id: bytes32 | None
+    targets: PackedTargets
+    batch_starts: array[int]
+    batch_puzzle_hashes: bytearray
+    batch_amounts: array[int]
+
+    def __init__(self, asset_id: bytes32 | None = None, puzzle_cache_size: int = PUZZLE_CACHE_SIZE) -> None:
+        self._lookup_keys = bytearray()
+        # Node number + 1 in each slot and 0 for an empty slot, four bytes is plenty for any bag that fits in memory
+        self._index = array("I", bytes(4 * INDEX_MIN_SLOTS))
+        self._index_mask = INDEX_MIN_SLOTS - 1
+        self._batch_puzzle = lru_cache(maxsize=puzzle_cache_size)(self._build_batch_puzzle)
+        self.asset_id = asset_id
+        self.targets = PackedTargets()
+        self.batch_starts = array("Q")
+        self.batch_puzzle_hashes = bytearray()
+        self.batch_amounts = array("Q")
+
+    def add_batch(
+        self,
+        batch_targets: list[Target],
+        lookup_keys: list[bytes32],
+        puzzle_hash: bytes32,
+        amount: uint64,
+    ) -> None:
+        """
+        Records a batch of targets created by spending the (outer) puzzle hash.
+        """
+        self.batch_starts.append(len(self))
+
+        if 2 * (len(self) + len(batch_targets)) > len(self._index):
+            self._grow_index(len(self) + len(batch_targets))
+
+        for target, lookup_key in zip(batch_targets, lookup_keys):
+            self._index_node(len(self), lookup_key)
+            self._lookup_keys += lookup_key
+            self.targets.append(target.puzzle_hash, target.amount)
+
+        self.batch_puzzle_hashes += puzzle_hash
+        self.batch_amounts.append(amount)
+
+    def _lookup_key(self, node: int) -> bytes:
+        return bytes(self._lookup_keys[node * 32 : (node + 1) * 32])
+
+    def _index_node(self, node: int, key: bytes) -> None:
+        index = self._index
+        slot = int.from_bytes(key[:8], "little") & self._index_mask
+
+        while index[slot] != 0:
+            slot = (slot + 1) & self._index_mask
+
+        index[slot] = node + 1
+
+    def _grow_index(self, count: int) -> None:
+        """
+        Replaces the index with one that keeps count nodes at most half full, reindexing every node added so far.
+        """
+        slots = len(self._index)
+        while 2 * count > slots:
+            slots *= 2
+
+        self._index = array("I", bytes(4 * slots))
+        self._index_mask = slots - 1
+
+        for node in range(len(self)):
+            self._index_node(node, bytes(self._lookup_keys[node * 32 : node * 32 + 8]))
+
+    def _find(self, key: bytes) -> int | None:
+        index = self._index
+        slot = int.from_bytes(key[:8], "little") & self._index_mask
+
+        while index[slot] != 0:
+            node = index[slot] - 1
+
+            if self._lookup_keys[node * 32 : (node + 1) * 32] == key:
+                return node
+
+            slot = (slot + 1) & self._index_mask
+
+        return None
+
+    def _build_batch_puzzle(self, batch_index: int) -> Program:
+        start = self.batch_starts[batch_index]
+        end = self.batch_starts[batch_index + 1] if batch_index + 1 < len(self.batch_starts) else len(self)
+
+        puzzle = batch_puzzle(self.targets[node] for node in range(start, end))
+        if self.asset_id is not None:
+            puzzle = construct_cat_puzzle(CAT_MOD, self.asset_id, puzzle)
+
+        return puzzle
+
+    def batch_puzzle(self, batch_index: int) -> Program:
+        """
+        (Outer) puzzle spent to create the batch, rebuilt from its targets unless it was used recently.
+        """
+        return self._batch_puzzle(batch_index)
+
+    def target_coin(self, node: int) -> TargetCoin:
+        batch_index = bisect_right(self.batch_starts, node) - 1
+
+        return TargetCoin(
+            self.targets[node],
+            self.batch_puzzle(batch_index),
+            uint64(self.batch_amounts[batch_index]),
+            bytes32(self.batch_puzzle_hashes[batch_index * 32 : (batch_index + 1) * 32]),
+        )
+
+    def __getitem__(self, key: bytes32) -> TargetCoin:
+        node = self._find(key)
+
+        if node is None:
+            raise KeyError(key)
+
+        return self.target_coin(node)
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, bytes) and self._find(key) is not None
+
+    def __iter__(self) -> Iterator[bytes32]:
+        for node in range(len(self)):
+            yield bytes32(self._lookup_key(node))
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+
+class CATOuterPuzzleHasher:
+    """
+    Calculates CAT outer puzzle hashes from inner puzzle hashes for a single asset id.
+
+    The curried CAT puzzle is `(a (q . CAT_MOD) (c (q . CAT_MOD_HASH) (c (q . asset_id) (c (q . inner) 1))))`.
+    Only the innermost curried argument changes between targets so every other subtree hash is calculated once
+    and each outer puzzle hash costs a handful of sha256 calls instead of building and hashing a program.
+    """
+
+    asset_id: bytes32
+
+    def __init__(self, asset_id: bytes32) -> None:
+        self.asset_id = asset_id
+        self._one_nil = shatree_pair(ONE_TREEHASH, NIL_TREEHASH)
+        self._quoted_asset_id = shatree_pair(Q_KW_TREEHASH, shatree_atom(asset_id))
+        self._quoted_mod_hash_hash = shatree_pair(Q_KW_TREEHASH, CAT_MOD_HASH_HASH)
+        self._quoted_mod_hash = shatree_pair(Q_KW_TREEHASH, CAT_MOD_HASH)
+
+    def outer_puzzle_hash(self, inner_puzzle_hash: bytes32) -> bytes32:
+        two = b"\x02"
+
+        # (c (q . inner) 1)
+        env = sha256(two + Q_KW_TREEHASH + inner_puzzle_hash).digest()
+        env = sha256(two + env + self._one_nil).digest()
+        env = sha256(two + C_KW_TREEHASH + env).digest()
+
+        # (c (q . asset_id) ...)
+        env = sha256(two + env + NIL_TREEHASH).digest()
+        env = sha256(two + self._quoted_asset_id + env).digest()
+        env = sha256(two + C_KW_TREEHASH + env).digest()
+
+        # (c (q . CAT_MOD_HASH) ...)
+        env = sha256(two + env + NIL_TREEHASH).digest()
+        env = sha256(two + self._quoted_mod_hash_hash + env).digest()
+        env = sha256(two + C_KW_TREEHASH + env).digest()
+
+        # (a (q . CAT_MOD) ...)
+        env = sha256(two + env + NIL_TREEHASH).digest()
+        env = sha256(two + self._quoted_mod_hash + env).digest()
+        return bytes32(sha256(two + A_KW_TREEHASH + env).digest())
+
+
+def level_widths(leaf_width: int | Sequence[int]) -> list[int]:
+    """
+    Widths of each level of the bag from the leaves up, levels above the last width given reuse it.
+    """
+    widths = [leaf_width] if isinstance(leaf_width, int) else list(leaf_width)
+
+    if len(widths) == 0:
+        raise Exception("At least one leaf width is required")
+
+    for width in widths:
+        if width < 2:
+            raise Exception(f"Leaf width must be at least 2 but got {width}")
+
+    return widths
+
+
+def level_width(widths: Sequence[int], level: int) -> int:
+    return widths[min(level, len(widths) - 1)]
+
+
+def parse_level_widths(value: str) -> list[int]:
+    """
+    Parses a leaf width or comma separated widths for each level from the leaves up, e.g. `100` or `100,50,20`.
+    """
+    try:
+        return level_widths([int(width) for width in value.split(",")])
+    except ValueError:
+        raise Exception(f"Invalid leaf width {value!r}, expected a number or comma separated numbers")
+
+
+def iter_batches(targets: Iterable[Target], leaf_width: int) -> Iterator[list[Target]]:
+    """
+    Lazily batches targets by leaf width without materialising the whole bag.
     """
-    results = []
-    current_batch = []
+    current_batch: list[Target] = []
 
-    for index, target in enumerate(targets):
+    for target in targets:
         current_batch.append(target)
 
-        if len(current_batch) == leaf_width or index == len(targets) - 1:
-            results.append(current_batch)
+        if len(current_batch) == leaf_width:
+            yield current_batch
             current_batch = []
 
-    return results
+    if len(current_batch) > 0:
+        yield current_batch
 
 
-def secure_the_bag(
-    targets: list[Target],
+def batch_the_bag(targets: list[Target], leaf_width: int) -> list[list[Target]]:
+    """
+    Batches the bag by leaf width.
+    """
+    return list(iter_batches(targets, leaf_width))
+
+
+def _serialized_atom(atom: bytes) -> bytes:
+    # Atoms in a batch puzzle are at most 32 bytes so their size always fits in a single prefix byte
+    if len(atom) == 1 and atom[0] <= 0x7F:
+        return atom
+
+    return bytes([0x80 | len(atom)]) + atom
+
+
+_SERIALIZED_EMPTY_COIN_ANNOUNCEMENT = bytes(Program.to(EMPTY_COIN_ANNOUNCEMENT))
+
+
+def batch_puzzle(batch_targets: Iterable[Target]) -> Program:
+    """
+    Creates the (inner) puzzle spent to create a batch of targets.
+
+    The puzzle is serialized directly and parsed once, which is far quicker than converting nested lists to a program.
+    """
+    # (q . ((CREATE_COIN_ANNOUNCEMENT "$") (CREATE_COIN ph amount (ph)) ...))
+    serialized = bytearray(b"\xff\x01\xff" + _SERIALIZED_EMPTY_COIN_ANNOUNCEMENT)
+
+    for target in batch_targets:
+        puzzle_hash = _serialized_atom(target.puzzle_hash)
+        serialized += b"\xff\xff" + _serialized_atom(ConditionOpcode.CREATE_COIN) + b"\xff" + puzzle_hash
+        serialized += b"\xff" + _serialized_atom(int_to_bytes(target.amount)) + b"\xff\xff" + puzzle_hash + b"\x80\x80"
+
+    serialized += b"\x80"
+
+    return Program.from_bytes(bytes(serialized))
+
+
+def _atom_hash(atom: bytes) -> bytes:
+    return sha256(b"\x01" + atom).digest()
+
+
+def _pair_hash(left: bytes, right: bytes) -> bytes:
+    return sha256(b"\x02" + left + right).digest()
+
+
+_CREATE_COIN_HASH = _atom_hash(ConditionOpcode.CREATE_COIN)
+_EMPTY_COIN_ANNOUNCEMENT_HASH = Program.to(EMPTY_COIN_ANNOUNCEMENT).get_tree_hash()
+
+
+def batch_puzzle_hash(batch_targets: Sequence[Target]) -> bytes32:
+    """
+    Tree hash of batch_puzzle(batch_targets) calculated straight from the puzzle hashes and amounts.
+
+    The puzzle is `(q . ((CREATE_COIN_ANNOUNCEMENT "$") (CREATE_COIN ph amount (ph)) ...))` so the list of
+    conditions is hashed from its last element back to the first without building the program.
+    """
+    conditions: bytes = NIL_TREEHASH
+
+    for target in reversed(batch_targets):
+        puzzle_hash = _atom_hash(target.puzzle_hash)
+        # (ph amount (ph))
+        condition = _pair_hash(_pair_hash(puzzle_hash, NIL_TREEHASH), NIL_TREEHASH)
+        condition = _pair_hash(_atom_hash(int_to_bytes(target.amount)), condition)
+        condition = _pair_hash(puzzle_hash, condition)
+        conditions = _pair_hash(_pair_hash(_CREATE_COIN_HASH, condition), conditions)
+
+    conditions = _pair_hash(_EMPTY_COIN_ANNOUNCEMENT_HASH, conditions)
+
+    return bytes32(_pair_hash(ONE_TREEHASH, conditions))
+
+
+def secure_batch(batch_targets: list[Target], cat_hasher: CATOuterPuzzleHasher | None) -> tuple[bytes32, list[bytes32]]:
+    """
+    Calculates the puzzle hash of the puzzle spent to create a batch of targets and the lookup keys of the targets it
+    creates.
+
+    Lookup keys are the outer puzzle hashes of the targets when securing a bag of CATs.
+    """
+    if cat_hasher is not None:
+        lookup_keys = [cat_hasher.outer_puzzle_hash(target.puzzle_hash) for target in batch_targets]
+    else:
+        lookup_keys = [target.puzzle_hash for target in batch_targets]
+
+    return batch_puzzle_hash(batch_targets), lookup_keys
+
+
+def _secure_batches(
+    level: Iterable[Target],
     leaf_width: int,
+    cat_hasher: CATOuterPuzzleHasher | None,
+    executor: ProcessPoolExecutor | None,
+    workers: int,
+    cache: BagCache | None,
+) -> Iterator[tuple[list[Target], bytes32, list[bytes32]]]:
+    """
+    Secures every batch of a level in order, optionally spreading the work across a process pool.
+
+    Batches are taken a window at a time. Batches of the window found in the optional cache are not hashed again, and
+    the ones that had to be are added to it.
+    """
+    if executor is None and cache is None:
+        for batch_targets in iter_batches(level, leaf_width):
+            yield batch_targets, *secure_batch(batch_targets, cat_hasher)
+
+        return
+
+    # Hand batches to the pool, and look them up in the cache, a window at a time so the whole level is never queued
+    # at once
+    chunk_size = 16
+    window_size = workers * chunk_size * 4 if executor is not None else CACHE_WINDOW_SIZE
+    batches = iter_batches(level, leaf_width)
+
+    while True:
+        window = list(islice(batches, window_size))
+
+        if len(window) == 0:
+            return
+
+        content_hashes: list[bytes] = []
+        cached: list[tuple[bytes32, list[bytes32]] | None] = [None] * len(window)
+        if cache is not None:
+            from cats.bag_cache import batch_content_hash
+
+            content_hashes = [batch_content_hash(batch_targets) for batch_targets in window]
+            cached = cache.get(content_hashes, window)
+
+        misses = [batch_targets for batch_targets, secured in zip(window, cached) if secured is None]
+
+        if executor is None:
+            results = [secure_batch(batch_targets, cat_hasher) for batch_targets in misses]
+        else:
+            results = list(executor.map(secure_batch, misses, repeat(cat_hasher), chunksize=chunk_size))
+
+        if cache is not None:
+            cache.put(
+                [content_hash for content_hash, secured in zip(content_hashes, cached) if secured is None], results
+            )
+
+        secured_misses = iter(results)
+
+        for batch_targets, secured in zip(window, cached):
+            yield batch_targets, *(next(secured_misses) if secured is None else secured)
+
+
+def secure_the_bag(
+    targets: Iterable[Target],
+    leaf_width: int | Sequence[int],
     asset_id: bytes32 | None = None,
-    parent_puzzle_lookup: dict[str, TargetCoin] = {},
-) -> tuple[bytes32, dict[str, TargetCoin]]:
+    parent_puzzle_lookup: ParentPuzzleLookup | None = None,
+    workers: int = 1,
+    manifest: BagManifest | None = None,
+    cache: BagCache | None = None,
+    progress: BagProgress | None = None,
+) -> tuple[bytes32, ParentPuzzleLookup]:
     """
     Calculates secure the bag root puzzle hash and provides parent puzzle reveal lookup table for spending.
 
     Secures bag of CATs if optional asset id is passed.
+
+    The tree is built one level at a time from the leaves up. Targets are consumed lazily so only the
+    frontier of the level currently being built is held in memory alongside the lookup table.
+
+    Batches within a level are independent of each other so passing more than one worker hashes them in a
+    process pool. Results are merged in batch order so the tree is identical to a single process build.
+
+    Every node is also recorded in the optional manifest so the bag can later be unwound without rebuilding it.
+
+    Batches already secured in the optional cache, by this or an earlier build, are reused instead of rehashed.
+
+    Progress hooks are called for every level and batch, by default a line is printed as each level is secured.
+
+    leaf_width is either the width of every level or a list of widths for each level from the leaves up.
     """
+    widths = level_widths(leaf_width)
 
-    if len(targets) == 1:
-        return targets[0].puzzle_hash, parent_puzzle_lookup
+    if workers < 1:
+        raise Exception(f"Workers must be at least 1 but got {workers}")
 
-    results: list[Target] = []
+    if manifest is not None and manifest.asset_id != asset_id:
+        raise Exception("Manifest asset id does not match the asset id of the bag")
 
-    batched_targets = batch_the_bag(targets, leaf_width)
-    batch_count = len(batched_targets)
+    if manifest is not None and manifest.level_widths != widths:
+        raise Exception("Manifest leaf widths do not match the leaf widths of the bag")
 
-    print(f"Batched the bag into {batch_count} batches")
+    if cache is not None and cache.asset_id != asset_id:
+        raise Exception("Bag cache asset id does not match the asset id of the bag")
 
-    processed = 0
+    if parent_puzzle_lookup is None:
+        parent_puzzle_lookup = ParentPuzzleLookup(asset_id)
 
-    for batch_targets in batched_targets:
-        print(f"{round((processed / batch_count) * 100, 2)}% of the way through batches")
+    if parent_puzzle_lookup.asset_id != asset_id:
+        raise Exception("Parent puzzle lookup asset id does not match the asset id of the bag")
 
-        list_of_conditions = [EMPTY_COIN_ANNOUNCEMENT]
-        total_amount = 0
+    if progress is None:
+        from cats.progress import PrintProgress
 
-        print(f"Creating coin with {len(batch_targets)} targets")
+        progress = PrintProgress()
 
-        for target in batch_targets:
-            list_of_conditions.append(target.create_coin_condition())
-            total_amount += target.amount
+    cat_hasher = CATOuterPuzzleHasher(asset_id) if asset_id is not None else None
 
-        puzzle = Program.to((1, list_of_conditions))
-        puzzle_hash = puzzle.get_tree_hash()
-        amount = total_amount
+    with contextlib.ExitStack() as exit_stack:
+        executor: ProcessPoolExecutor | None = None
+        if workers > 1:
+            executor = exit_stack.enter_context(
+                ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            )
 
-        results.append(Target(puzzle_hash, uint64(amount)))
+        level: Iterable[Target] = targets
+        height = 0
 
-        if asset_id is not None:
-            outer_puzzle = construct_cat_puzzle(CAT_MOD, asset_id, puzzle)
+        while True:
+            frontier = PackedTargets()
+            progress.level_started(height, len(level) if isinstance(level, Sequence) else None)
 
-        for target in batch_targets:
-            if asset_id is not None:
-                target_outer_puzzle_hash = construct_cat_puzzle(
-                    CAT_MOD, asset_id, Program.to(target.puzzle_hash)
-                ).get_tree_hash_precalc(target.puzzle_hash)
-                parent_puzzle_lookup[target_outer_puzzle_hash.hex()] = TargetCoin(target, outer_puzzle, uint64(amount))
-            else:
-                parent_puzzle_lookup[target.puzzle_hash.hex()] = TargetCoin(target, puzzle, uint64(amount))
+            for batch_targets, puzzle_hash, lookup_keys in _secure_batches(
+                level, level_width(widths, height), cat_hasher, executor, workers, cache
+            ):
+                # A lone node in the first batch means the level has collapsed to the root
+                if len(batch_targets) == 1 and len(frontier) == 0:
+                    if manifest is not None:
+                        manifest.add_root(height, batch_targets[0])
+
+                    if cache is not None:
+                        cache.commit()
+
+                    progress.finished(batch_targets[0].puzzle_hash, height)
+
+                    return batch_targets[0].puzzle_hash, parent_puzzle_lookup
+
+                amount = uint64(sum(target.amount for target in batch_targets))
+
+                frontier.append(puzzle_hash, amount)
+                progress.batch_secured(batch_targets, puzzle_hash)
+
+                if manifest is not None:
+                    manifest.add_batch(height, batch_targets, lookup_keys)
+
+                if cat_hasher is not None:
+                    puzzle_hash = cat_hasher.outer_puzzle_hash(puzzle_hash)
+
+                parent_puzzle_lookup.add_batch(batch_targets, lookup_keys, puzzle_hash, amount)
+
+            if len(frontier) == 0:
+                raise Exception("Cannot secure an empty bag")
+
+            progress.level_finished(len(frontier))
+
+            level = frontier
+            height += 1
+
+
+class BagCoinSpends:
+    """
+    Coins and coin spends of a secured bag calculated from the genesis coin down.
+
+    The name of the coin that creates each node is memoized, so walking from any number of nodes up to the genesis
+    coin hashes each ancestor once rather than once per walk.
+    """
+
+    genesis_coin_name: bytes32
+    parent_puzzle_lookup: Mapping[bytes32, TargetCoin]
+
+    def __init__(self, genesis_coin_name: bytes32, parent_puzzle_lookup: Mapping[bytes32, TargetCoin]) -> None:
+        self.genesis_coin_name = genesis_coin_name
+        self.parent_puzzle_lookup = parent_puzzle_lookup
+        # Node puzzle hash -> name of the coin whose spend creates the node
+        self._parent_coin_names: dict[bytes32, bytes32] = {}
+
+    def _parent_coin_name(self, puzzle_hash: bytes32) -> bytes32:
+        path: list[tuple[bytes32, TargetCoin]] = []
+        current_puzzle_hash = puzzle_hash
+
+        # Walk up until we reach a node we already know about or the root
+        while current_puzzle_hash not in self._parent_coin_names:
+            parent = self.parent_puzzle_lookup.get(current_puzzle_hash)
+
+            if parent is None:
+                self._parent_coin_names[current_puzzle_hash] = self.genesis_coin_name
+                break
+
+            path.append((current_puzzle_hash, parent))
+            current_puzzle_hash = parent.puzzle_hash
+
+        for node_puzzle_hash, parent in reversed(path):
+            parent_coin = Coin(self._parent_coin_names[parent.puzzle_hash], parent.puzzle_hash, parent.amount)
+            self._parent_coin_names[node_puzzle_hash] = parent_coin.name()
+
+        return self._parent_coin_names[puzzle_hash]
+
+    def parent_of_puzzle_hash(self, puzzle_hash: bytes32) -> tuple[CoinSpend | None, bytes32]:
+        """
+        Spend of the coin that creates puzzle hash and its coin name, or the genesis coin name for the root.
+        """
+        parent: TargetCoin | None = self.parent_puzzle_lookup.get(puzzle_hash)
+
+        if parent is None:
+            return None, self.genesis_coin_name
+
+        coin = Coin(self._parent_coin_name(parent.puzzle_hash), parent.puzzle_hash, parent.amount)
 
-        processed += 1
+        return make_spend(coin, parent.puzzle, Program.to([])), coin.name()
 
-    return secure_the_bag(results, leaf_width, asset_id, parent_puzzle_lookup)
+    def coin_spends_by_depth(self) -> list[list[CoinSpend]]:
+        """
+        Every coin spend needed to fully unwind the bag, grouped by depth from the root in batch order.
+
+        Makes a single breadth first pass from the genesis coin so the cost is linear in the size of the bag.
+        """
+        children: dict[bytes32, list[tuple[bytes32, TargetCoin]]] = {}
+
+        for key, target_coin in self.parent_puzzle_lookup.items():
+            children.setdefault(target_coin.puzzle_hash, []).append((key, target_coin))
+
+        if len(children) == 0:
+            return []
+
+        # The root is the only parent that isn't created by another node
+        root_puzzle_hash = next(iter(children))
+        while root_puzzle_hash in self.parent_puzzle_lookup:
+            root_puzzle_hash = self.parent_puzzle_lookup[root_puzzle_hash].puzzle_hash
+
+        coin_spends_by_depth: list[list[CoinSpend]] = []
+        frontier = [(root_puzzle_hash, self.genesis_coin_name)]
+
+        while len(frontier) > 0:
+            coin_spends: list[CoinSpend] = []
+            next_frontier: list[tuple[bytes32, bytes32]] = []
+
+            for puzzle_hash, parent_coin_name in frontier:
+                self._parent_coin_names[puzzle_hash] = parent_coin_name
+                node_children = children.get(puzzle_hash)
+
+                # Targets are spent by their owners
+                if node_children is None:
+                    continue
+
+                _, node = node_children[0]
+                coin = Coin(parent_coin_name, puzzle_hash, node.amount)
+                coin_spends.append(make_spend(coin, node.puzzle, Program.to([])))
+
+                coin_name = coin.name()
+                next_frontier.extend((child_puzzle_hash, coin_name) for child_puzzle_hash, _ in node_children)
+
+            if len(coin_spends) > 0:
+                coin_spends_by_depth.append(coin_spends)
+
+            frontier = next_frontier
+
+        return coin_spends_by_depth
 
 
 def parent_of_puzzle_hash(
     genesis_coin_name: bytes32,
     puzzle_hash: bytes32,
-    parent_puzzle_lookup: dict[str, TargetCoin],
+    parent_puzzle_lookup: Mapping[bytes32, TargetCoin],
 ) -> tuple[CoinSpend | None, bytes32]:
-    parent: TargetCoin | None = parent_puzzle_lookup.get(puzzle_hash.hex())
+    return BagCoinSpends(genesis_coin_name, parent_puzzle_lookup).parent_of_puzzle_hash(puzzle_hash)
+
 
-    if parent is None:
-        return None, genesis_coin_name
+def _read_target_rows(secure_the_bag_targets_path: str) -> Iterator[tuple[int, bytes32, uint64]]:
+    """
+    Parses and validates each row of a targets file, reporting malformed rows by line number.
+    """
+    with open(secure_the_bag_targets_path, newline="") as csvfile:
+        reader = csv.reader(csvfile)
 
-    # We need the parent of the parent in order to calculate the coin name
-    _, parent_coin_info = parent_of_puzzle_hash(genesis_coin_name, parent.puzzle_hash, parent_puzzle_lookup)
+        for row in reader:
+            # Tolerate blank lines such as a trailing newline
+            if len(row) == 0:
+                continue
 
-    coin = Coin(parent_coin_info, parent.puzzle_hash, parent.amount)
+            if len(row) != 2:
+                raise Exception(
+                    f"Invalid target on line {reader.line_num} of {secure_the_bag_targets_path}: "
+                    f"expected puzzle hash and amount but got {len(row)} columns"
+                )
 
-    return make_spend(coin, parent.puzzle, Program.to([])), coin.name()
+            ph, amount = row
 
+            try:
+                puzzle_hash = bytes32.fromhex(ph.strip())
+            except ValueError:
+                raise Exception(
+                    f"Invalid target on line {reader.line_num} of {secure_the_bag_targets_path}: "
+                    f"puzzle hash {ph!r} is not 32 bytes of hex"
+                )
 
-def read_secure_the_bag_targets(secure_the_bag_targets_path: str, target_amount: int | None) -> list[Target]:
+            try:
+                parsed_amount = uint64(int(amount.strip()))
+            except ValueError:
+                raise Exception(
+                    f"Invalid target on line {reader.line_num} of {secure_the_bag_targets_path}: "
+                    f"amount {amount!r} is not a valid number of mojos"
+                )
+
+            yield reader.line_num, puzzle_hash, parsed_amount
+
+
+def iter_secure_the_bag_targets(
+    secure_the_bag_targets_path: str,
+    target_amount: int | None = None,
+    chunk_size: int = 100000,
+    merge_duplicates: bool = False,
+) -> Iterator[PackedTargets]:
     """
-    Reads secure the bag targets file. Validates the net amount sent to targets is equal to the target amount.
+    Streams validated secure the bag targets in chunks so the file is never held in memory at once.
+
+    Duplicate puzzle hashes would overwrite each other in the parent puzzle lookup, so they are rejected unless
+    merge_duplicates is set. Merging makes an extra pass over the file and sends the combined amount to the first
+    occurrence of each puzzle hash. A running total is checked against the optional target amount.
     """
-    targets: list[Target] = []
+    # Only the puzzle hashes seen so far are kept, the rows themselves are discarded once yielded
+    seen: set[bytes32] = set()
+    merged_amounts: dict[bytes32, int] = {}
 
-    with open(secure_the_bag_targets_path, newline="") as csvfile:
-        reader = csv.reader(csvfile)
-        for [ph, amount] in list(reader):
-            targets.append(Target(bytes32.fromhex(ph), uint64(amount)))
+    if merge_duplicates:
+        for _, puzzle_hash, amount in _read_target_rows(secure_the_bag_targets_path):
+            if puzzle_hash in seen:
+                merged_amounts[puzzle_hash] = merged_amounts.get(puzzle_hash, 0) + amount
+            else:
+                seen.add(puzzle_hash)
+
+        seen = set()
+
+    net_amount = 0
+    chunk = PackedTargets()
+
+    for line_number, puzzle_hash, amount in _read_target_rows(secure_the_bag_targets_path):
+        if puzzle_hash in seen:
+            if merge_duplicates:
+                continue
+
+            raise Exception(
+                f"Duplicate target on line {line_number} of {secure_the_bag_targets_path}: "
+                f"puzzle hash {puzzle_hash} appears more than once"
+            )
+
+        seen.add(puzzle_hash)
+
+        if puzzle_hash in merged_amounts:
+            amount = uint64(amount + merged_amounts[puzzle_hash])
+
+        net_amount += amount
+
+        if target_amount and net_amount > target_amount:
+            raise Exception(
+                f"Net amount of targets exceeds expected amount of {target_amount} by line {line_number} "
+                f"of {secure_the_bag_targets_path}"
+            )
 
-    net_amount = sum([target.amount for target in targets])
+        chunk.append(puzzle_hash, amount)
+
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = PackedTargets()
 
     if target_amount:
         if net_amount != target_amount:
             raise Exception(f"Net amount of targets not expected amount. Expected {target_amount} but got {net_amount}")
 
+    if len(chunk) > 0:
+        yield chunk
+
+
+def read_secure_the_bag_targets(
+    secure_the_bag_targets_path: str, target_amount: int | None, merge_duplicates: bool = False
+) -> PackedTargets:
+    """
+    Reads secure the bag targets file. Validates the net amount sent to targets is equal to the target amount.
+    """
+    targets = PackedTargets()
+
+    for chunk in iter_secure_the_bag_targets(
+        secure_the_bag_targets_path, target_amount, merge_duplicates=merge_duplicates
+    ):
+        targets.extend(chunk)
+
     return targets
 
 
-@click.command()
+@contextlib.contextmanager
+def _cli_targets(
+    secure_the_bag_targets_path: str, amount: int, merge_duplicates: bool, verify_checksum: bool = False
+) -> Iterator[Iterable[Target]]:
+    """
+    Targets of a binary targets file, or of a CSV streamed straight into the first level of the tree.
+    """
+    from cats.target_file import is_target_file, open_secure_the_bag_targets
+
+    if is_target_file(secure_the_bag_targets_path):
+        with open_secure_the_bag_targets(
+            secure_the_bag_targets_path, amount, verify_checksum=verify_checksum
+        ) as targets:
+            yield targets
+
+        return
+
+    yield chain.from_iterable(
+        iter_secure_the_bag_targets(secure_the_bag_targets_path, amount, merge_duplicates=merge_duplicates)
+    )
+
+
+@click.group(invoke_without_command=True)
 @click.pass_context
 @click.option(
     "-l",
     "--tail",
-    required=True,
     help="The TAIL program to launch this CAT with",
 )
 @click.option(
@@ -220,22 +947,70 @@ def read_secure_the_bag_targets(secure_the_bag_targets_path: str, target_amount:
 @click.option(
     "-a",
     "--amount",
-    required=True,
     type=int,
     help="The amount to issue in mojos (regular XCH will be used to fund this)",
 )
 @click.option(
     "-stbtp",
     "--secure-the-bag-targets-path",
-    help="Path to CSV file containing targets of secure the bag (inner puzzle hash + amount)",
+    help="Path to CSV or binary file containing targets of secure the bag (inner puzzle hash + amount)",
+)
+@click.option(
+    "-md",
+    "--merge-duplicates",
+    is_flag=True,
+    default=False,
+    help="Combine the amounts of targets that share a puzzle hash instead of rejecting the targets file",
 )
 @click.option(
     "-lw",
     "--leaf-width",
     required=True,
-    default=100,
+    default="100",
+    show_default=True,
+    help="Secure the bag leaf width, or comma separated widths for each level from the leaves up",
+)
+@click.option(
+    "-w",
+    "--workers",
+    required=True,
+    default=1,
+    show_default=True,
+    help="Number of processes used to hash each level of the bag",
+)
+@click.option(
+    "-mp",
+    "--manifest-path",
+    help="Optional path to write a manifest of every node in the bag to, for use by unwind_the_bag",
+)
+@click.option(
+    "-cp",
+    "--cache-path",
+    help="Optional path to a cache of secured batches, rebuilding after the targets change only rehashes what changed",
+)
+@click.option(
+    "-pg",
+    "--progress",
+    is_flag=True,
+    default=False,
+    help="Show a progress bar for each level of the bag instead of a line once it is secured",
+)
+@click.option(
+    "-mtp",
+    "--metrics-path",
+    help="Optional path of a JSON lines file to append timings and memory use of each level of the bag to",
+)
+@click.option(
+    "-pp",
+    "--proofs-path",
+    help="Optional directory to export a proof for every target to, so each target can be unwound on its own",
+)
+@click.option(
+    "-ppl",
+    "--proof-prefix-length",
+    default=2,
     show_default=True,
-    help="Secure the bag leaf width",
+    help="Number of hex characters of the target puzzle hash used to shard the exported proofs",
 )
 @click.option(
     "-pr",
@@ -247,15 +1022,30 @@ def read_secure_the_bag_targets(secure_the_bag_targets_path: str, target_amount:
 )
 def cli(
     ctx: click.Context,
-    tail: str,
+    tail: str | None,
     curry: tuple[str],
-    amount: int,
-    secure_the_bag_targets_path: str,
-    leaf_width: int,
+    amount: int | None,
+    secure_the_bag_targets_path: str | None,
+    merge_duplicates: bool,
+    leaf_width: str,
+    workers: int,
+    manifest_path: str | None,
+    cache_path: str | None,
+    progress: bool,
+    metrics_path: str | None,
+    proofs_path: str | None,
+    proof_prefix_length: int,
     prefix: str,
 ) -> None:
     ctx.ensure_object(dict)
 
+    # Subcommands such as convert run on their own
+    if ctx.invoked_subcommand is not None:
+        return
+
+    if tail is None or amount is None or secure_the_bag_targets_path is None:
+        raise click.UsageError("Must specify --tail, --amount and --secure-the-bag-targets-path")
+
     parsed_tail: Program = parse_program(tail)
     curried_args = [assemble(arg) for arg in curry]
 
@@ -265,11 +1055,60 @@ def cli(
     else:
         curried_tail = parsed_tail
 
-    targets = read_secure_the_bag_targets(secure_the_bag_targets_path, amount)
-    root_puzzle_hash, _ = secure_the_bag(targets, leaf_width, None)
-    outer_root_puzzle_hash = construct_cat_puzzle(
-        CAT_MOD, curried_tail.get_tree_hash(), Program.to(root_puzzle_hash)
-    ).get_tree_hash_precalc(root_puzzle_hash)
+    tail_hash = curried_tail.get_tree_hash()
+    widths = parse_level_widths(leaf_width)
+
+    # Only the manifest and proofs need the CAT outer puzzle hashes of the bag, the root is wrapped separately
+    asset_id = tail_hash if manifest_path is not None or proofs_path is not None else None
+
+    manifest = None
+    if manifest_path is not None:
+        from cats.bag_manifest import BagManifest
+
+        manifest = BagManifest.create(manifest_path, widths, tail_hash)
+
+    cache = None
+    if cache_path is not None:
+        from cats.bag_cache import BagCache
+
+        cache = BagCache.open(cache_path, asset_id)
+
+    from cats.progress import progress_from_options
+
+    with contextlib.ExitStack() as exit_stack:
+        targets = exit_stack.enter_context(_cli_targets(secure_the_bag_targets_path, amount, merge_duplicates))
+        root_puzzle_hash, parent_puzzle_lookup = secure_the_bag(
+            targets,
+            widths,
+            asset_id,
+            workers=workers,
+            manifest=manifest,
+            cache=cache,
+            progress=progress_from_options(progress, metrics_path),
+        )
+        outer_root_puzzle_hash = CATOuterPuzzleHasher(tail_hash).outer_puzzle_hash(root_puzzle_hash)
+
+        if manifest is not None:
+            manifest.close()
+            print(f"Secure the bag manifest written to {manifest_path}")
+
+        if cache is not None:
+            pruned = cache.prune()
+            cache.close()
+            print(
+                f"Reused {cache.hits} of {cache.hits + cache.misses} batches from the bag cache at {cache_path}, "
+                f"dropping {pruned} no longer in the bag"
+            )
+
+        if proofs_path is not None:
+            from cats.unwind_proof import export_unwind_proofs
+
+            # Streamed CSV targets have been consumed so they are read again
+            if not isinstance(targets, Sequence):
+                targets = exit_stack.enter_context(_cli_targets(secure_the_bag_targets_path, amount, merge_duplicates))
+
+            count = export_unwind_proofs(proofs_path, targets, parent_puzzle_lookup, tail_hash, proof_prefix_length)
+            print(f"Unwind proofs for {count} targets written to {proofs_path}")
 
     print(f"Secure the bag root puzzle hash: {outer_root_puzzle_hash}")
 
@@ -278,6 +1117,252 @@ def cli(
     print(f"Secure the bag root address: {address}")
 
 
+@cli.command("convert", help="Convert a CSV targets file into a binary targets file")
+@click.option(
+    "-stbtp",
+    "--secure-the-bag-targets-path",
+    required=True,
+    help="Path to CSV file containing targets of secure the bag (inner puzzle hash + amount)",
+)
+@click.option(
+    "-o",
+    "--output-path",
+    required=True,
+    help="Path to write the binary targets file to",
+)
+@click.option(
+    "-a",
+    "--amount",
+    type=int,
+    help="Optional amount in mojos the targets must add up to",
+)
+@click.option(
+    "-md",
+    "--merge-duplicates",
+    is_flag=True,
+    default=False,
+    help="Combine the amounts of targets that share a puzzle hash instead of rejecting the targets file",
+)
+def convert(
+    secure_the_bag_targets_path: str,
+    output_path: str,
+    amount: int | None,
+    merge_duplicates: bool,
+) -> None:
+    from cats.target_file import write_target_file
+
+    targets = chain.from_iterable(
+        iter_secure_the_bag_targets(secure_the_bag_targets_path, amount, merge_duplicates=merge_duplicates)
+    )
+    count, total_amount = write_target_file(output_path, targets)
+
+    print(f"Converted {count} targets with a net amount of {total_amount} to {output_path}")
+
+
+@cli.command("verify", help="Independently rebuild a bag across every core and check it matches a root or manifest")
+@click.pass_context
+@click.option(
+    "-stbtp",
+    "--secure-the-bag-targets-path",
+    required=True,
+    help="Path to CSV or binary file containing targets of secure the bag (inner puzzle hash + amount)",
+)
+@click.option(
+    "-a",
+    "--amount",
+    required=True,
+    type=int,
+    help="The amount in mojos the targets must add up to",
+)
+@click.option(
+    "-md",
+    "--merge-duplicates",
+    is_flag=True,
+    default=False,
+    help="Combine the amounts of targets that share a puzzle hash, as when the bag was secured",
+)
+@click.option(
+    "-th",
+    "--tail-hash",
+    required=True,
+    help="TAIL hash / Asset ID of the CAT the bag was secured for",
+)
+@click.option(
+    "-lw",
+    "--leaf-width",
+    default="100",
+    show_default=True,
+    help="Secure the bag leaf width, or comma separated widths for each level from the leaves up",
+)
+@click.option(
+    "-r",
+    "--root",
+    help="Expected root puzzle hash or root address printed by secure_the_bag",
+)
+@click.option(
+    "-mp",
+    "--manifest-path",
+    help="Manifest written by secure_the_bag to check every node against, reporting the first subtree that differs",
+)
+@click.option(
+    "-w",
+    "--workers",
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help="Number of processes used to hash each level of the bag",
+)
+@click.option(
+    "-pg",
+    "--progress",
+    is_flag=True,
+    default=False,
+    help="Show a progress bar for each level of the bag instead of a line once it is secured",
+)
+def verify(
+    ctx: click.Context,
+    secure_the_bag_targets_path: str,
+    amount: int,
+    merge_duplicates: bool,
+    tail_hash: str,
+    leaf_width: str,
+    root: str | None,
+    manifest_path: str | None,
+    workers: int,
+    progress: bool,
+) -> None:
+    from cats.bag_manifest import BagManifest, ManifestVerifier
+    from cats.progress import CombinedProgress, progress_from_options
+
+    if root is None and manifest_path is None:
+        raise click.UsageError("Must specify at least one of --root or --manifest-path")
+
+    # The root puzzle hash printed is of the outer CAT puzzle while the address is of the inner puzzle
+    expected_outer_root_puzzle_hash: bytes32 | None = None
+    expected_root_puzzle_hash: bytes32 | None = None
+
+    try:
+        if root is not None and (root.startswith("0x") or len(root) == 64):
+            expected_outer_root_puzzle_hash = bytes32(hexstr_to_bytes(root))
+        elif root is not None:
+            expected_root_puzzle_hash = decode_puzzle_hash(root)
+    except ValueError:
+        raise click.BadParameter(f"{root} is not a 32 byte hex root puzzle hash or a root address", param_hint="--root")
+
+    asset_id = bytes32.fromhex(tail_hash)
+    widths = parse_level_widths(leaf_width)
+    bag_progress = progress_from_options(progress, None)
+
+    manifest = None
+    if manifest_path is not None:
+        manifest = BagManifest.open(manifest_path)
+
+        if manifest.asset_id != asset_id or manifest.level_widths != widths:
+            print(f"Verification failed: manifest {manifest_path} was secured with a different asset id or leaf width")
+            manifest.close()
+            ctx.exit(1)
+
+        bag_progress = CombinedProgress(bag_progress, ManifestVerifier(manifest))
+
+    try:
+        # Binary targets files are checksummed here as the bag is rebuilt independently of how they were written
+        with _cli_targets(secure_the_bag_targets_path, amount, merge_duplicates, verify_checksum=True) as targets:
+            root_puzzle_hash, _ = secure_the_bag(targets, widths, asset_id, workers=workers, progress=bag_progress)
+    except Exception as e:
+        print(f"Verification failed: {e}")
+        ctx.exit(1)
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+    outer_root_puzzle_hash = CATOuterPuzzleHasher(asset_id).outer_puzzle_hash(root_puzzle_hash)
+
+    if root is not None:
+        if expected_outer_root_puzzle_hash is not None:
+            matches = expected_outer_root_puzzle_hash == outer_root_puzzle_hash
+        else:
+            matches = expected_root_puzzle_hash == root_puzzle_hash
+
+        if not matches:
+            print(f"Verification failed: bag root puzzle hash {outer_root_puzzle_hash} does not match {root}")
+            ctx.exit(1)
+
+    print(f"Verified targets with a net amount of {amount} secure to root puzzle hash {outer_root_puzzle_hash}")
+
+
+@cli.command("plan", help="Recommend leaf widths for each level of the bag from the real cost of unwinding it")
+@click.option(
+    "-tc",
+    "--target-count",
+    type=int,
+    help="Number of targets in the bag",
+)
+@click.option(
+    "-stbtp",
+    "--secure-the-bag-targets-path",
+    help="Path to CSV or binary file of targets to count instead of passing --target-count",
+)
+@click.option(
+    "-mbcf",
+    "--max-block-cost-fraction",
+    type=float,
+    default=0.5,
+    show_default=True,
+    help="Fraction of the maximum block cost the unwind can expect to use in each block",
+)
+@click.option(
+    "-mw",
+    "--max-width",
+    type=int,
+    help="Optional limit on the leaf width of every level",
+)
+@click.option(
+    "-uf",
+    "--unwind-fee",
+    default=500000,
+    show_default=True,
+    help="Fee paid for each unwind spend",
+)
+def plan(
+    target_count: int | None,
+    secure_the_bag_targets_path: str | None,
+    max_block_cost_fraction: float,
+    max_width: int | None,
+    unwind_fee: int,
+) -> None:
+    from cats.fan_out import fee_spend_cost, plan_fan_out
+    from cats.target_file import MappedTargets, is_target_file
+
+    if (target_count is None) == (secure_the_bag_targets_path is None):
+        raise click.UsageError("Must specify exactly one of --target-count or --secure-the-bag-targets-path")
+
+    if secure_the_bag_targets_path is not None:
+        if is_target_file(secure_the_bag_targets_path):
+            with MappedTargets.open(secure_the_bag_targets_path) as mapped_targets:
+                target_count = len(mapped_targets)
+        else:
+            target_count = sum(len(chunk) for chunk in iter_secure_the_bag_targets(secure_the_bag_targets_path))
+
+    assert target_count is not None
+    # unwind_the_bag adds a fee spend to every bundle that pays a fee, so even a lone spend of the widest node has to
+    # leave room for one
+    reserved_cost = fee_spend_cost(1) if unwind_fee > 0 else 0
+    fan_out_plan = plan_fan_out(target_count, max_block_cost_fraction, max_width, reserved_cost)
+
+    for level, width in enumerate(fan_out_plan.widths):
+        print(
+            f"Level {level}: leaf width {width}, {fan_out_plan.spends[level]} spends costing "
+            f"{fan_out_plan.costs[level]} over {fan_out_plan.blocks[level]} blocks, "
+            f"up to {fan_out_plan.spends_per_bundle[level]} spends per spend bundle"
+        )
+
+    print(
+        f"Unwinding {target_count} targets takes {fan_out_plan.total_spends()} spends costing "
+        f"{fan_out_plan.total_cost()} over {fan_out_plan.total_blocks()} blocks with "
+        f"{fan_out_plan.total_spends() * unwind_fee} fees"
+    )
+    print(f"Secure the bag with --leaf-width {fan_out_plan.leaf_width()}")
+
+
 def main() -> None:
     cli()
 
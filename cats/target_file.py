@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import contextlib
+import mmap
+import os
+import struct
+import tempfile
+from collections.abc import Iterable, Iterator, Sequence
+from hashlib import sha256
+from pathlib import Path
+from types import TracebackType
+from typing import IO, overload
+
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint64
+
+from cats.secure_the_bag import PackedTargets, Target, read_secure_the_bag_targets
+
+# Binary targets file layout, all integers big endian:
+#   header: magic (8 bytes) | record count (8 bytes) | total amount (8 bytes) | sha256 of the records (32 bytes)
+#   records: puzzle hash (32 bytes) | amount (8 bytes)
+TARGET_FILE_MAGIC = b"STBTGT\x00\x01"
+TARGET_FILE_HEADER = struct.Struct(">8sQQ32s")
+TARGET_RECORD = struct.Struct(">32sQ")
+
+# Number of records buffered before writing them out
+TARGET_FILE_WRITE_CHUNK_SIZE = 10000
+
+
+def is_target_file(path: str | Path) -> bool:
+    """
+    Whether path is a binary targets file rather than a CSV.
+    """
+    with open(path, "rb") as file:
+        return file.read(len(TARGET_FILE_MAGIC)) == TARGET_FILE_MAGIC
+
+
+def _write_records(file: IO[bytes], targets: Iterable[Target]) -> tuple[int, int]:
+    count = 0
+    total_amount = 0
+    checksum = sha256()
+
+    # Header is filled in once the records are known
+    file.write(bytes(TARGET_FILE_HEADER.size))
+
+    records = bytearray()
+    for target in targets:
+        records += TARGET_RECORD.pack(target.puzzle_hash, target.amount)
+        count += 1
+        total_amount += target.amount
+
+        if count % TARGET_FILE_WRITE_CHUNK_SIZE == 0:
+            checksum.update(records)
+            file.write(records)
+            records = bytearray()
+
+    checksum.update(records)
+    file.write(records)
+
+    if total_amount > uint64.MAXIMUM:
+        raise Exception(f"Total amount of targets {total_amount} does not fit in a single coin")
+
+    file.seek(0)
+    file.write(TARGET_FILE_HEADER.pack(TARGET_FILE_MAGIC, count, total_amount, checksum.digest()))
+
+    return count, total_amount
+
+
+def write_target_file(path: str | Path, targets: Iterable[Target]) -> tuple[int, int]:
+    """
+    Writes targets to a binary targets file, returning the number of records and their total amount.
+
+    The file is written next to path and moved over it once complete, so a failed write never leaves a partial file.
+    """
+    file = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), prefix=".targets-", delete=False)
+
+    try:
+        with file:
+            count, total_amount = _write_records(file, targets)
+
+        os.replace(file.name, path)
+    except BaseException:
+        os.unlink(file.name)
+        raise
+
+    return count, total_amount
+
+
+class MappedTargets(Sequence[Target]):
+    """
+    Targets read straight out of a memory mapped binary targets file.
+
+    Nothing is parsed up front, records are decoded as they are indexed or iterated.
+    """
+
+    _file: mmap.mmap
+    _records: memoryview
+    total_amount: int
+
+    def __init__(self, file: mmap.mmap) -> None:
+        if len(file) < TARGET_FILE_HEADER.size:
+            raise Exception("Targets file is too short to contain a header")
+
+        magic, count, total_amount, checksum = TARGET_FILE_HEADER.unpack_from(file)
+
+        if magic != TARGET_FILE_MAGIC:
+            raise Exception("Targets file is not a binary targets file")
+
+        if len(file) != TARGET_FILE_HEADER.size + count * TARGET_RECORD.size:
+            raise Exception(f"Targets file is truncated or corrupt, expected {count} records")
+
+        self._file = file
+        self._records = memoryview(file)[TARGET_FILE_HEADER.size :]
+        self._checksum = checksum
+        self.total_amount = total_amount
+
+    @classmethod
+    def open(cls, path: str | Path, verify_checksum: bool = False) -> MappedTargets:
+        """
+        Maps the targets file at path. Checking the checksum reads every record so it is left to callers that need it.
+        """
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                raise Exception("Targets file is too short to contain a header")
+
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        targets = cls(mapped)
+
+        if verify_checksum:
+            targets.verify_checksum()
+
+        return targets
+
+    def verify_checksum(self) -> None:
+        if sha256(self._records).digest() != self._checksum:
+            raise Exception("Targets file checksum does not match its records")
+
+    def close(self) -> None:
+        self._records.release()
+        self._file.close()
+
+    def __enter__(self) -> MappedTargets:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def puzzle_hash(self, index: int) -> bytes32:
+        offset = index * TARGET_RECORD.size
+        return bytes32(self._records[offset : offset + 32])
+
+    def amount(self, index: int) -> uint64:
+        offset = index * TARGET_RECORD.size + 32
+        return uint64(int.from_bytes(self._records[offset : offset + 8], "big"))
+
+    def __len__(self) -> int:
+        return len(self._records) // TARGET_RECORD.size
+
+    @overload
+    def __getitem__(self, index: int) -> Target: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> PackedTargets: ...
+
+    def __getitem__(self, index: int | slice) -> Target | PackedTargets:
+        if isinstance(index, slice):
+            return PackedTargets(self[i] for i in range(*index.indices(len(self))))
+
+        if index < 0:
+            index += len(self)
+
+        if index < 0 or index >= len(self):
+            raise IndexError("target index out of range")
+
+        return Target(self.puzzle_hash(index), self.amount(index))
+
+    def __iter__(self) -> Iterator[Target]:
+        for puzzle_hash, amount in TARGET_RECORD.iter_unpack(self._records):
+            yield Target(bytes32(puzzle_hash), uint64(amount))
+
+
+@contextlib.contextmanager
+def open_secure_the_bag_targets(
+    secure_the_bag_targets_path: str,
+    target_amount: int | None,
+    merge_duplicates: bool = False,
+    verify_checksum: bool = False,
+) -> Iterator[Sequence[Target]]:
+    """
+    Opens a binary targets file, or reads a CSV targets file into memory, for the duration of the context.
+    """
+    if not is_target_file(secure_the_bag_targets_path):
+        yield read_secure_the_bag_targets(secure_the_bag_targets_path, target_amount, merge_duplicates)
+        return
+
+    with MappedTargets.open(secure_the_bag_targets_path, verify_checksum) as targets:
+        # Records are only checked against the checksum when asked to, the header total is checked on every open
+        if target_amount and targets.total_amount != target_amount:
+            raise Exception(
+                f"Net amount of targets not expected amount. Expected {target_amount} but got {targets.total_amount}"
+            )
+
+        yield targets
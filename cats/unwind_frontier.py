@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from enum import Enum
+from typing import Protocol
+
+from chia_rs import CoinRecord, CoinSpend
+from chia_rs.sized_bytes import bytes32
+
+# Number of coin names looked up in each get_coin_records_by_names call
+FRONTIER_CHUNK_SIZE = 1000
+
+
+class CoinRecordSource(Protocol):
+    """
+    The part of FullNodeRpcClient needed to scan a bag.
+    """
+
+    async def get_coin_records_by_names(
+        self,
+        names: list[bytes32],
+        include_spent_coins: bool = True,
+        start_height: int | None = None,
+        end_height: int | None = None,
+    ) -> list[CoinRecord]: ...
+
+
+class NodeState(Enum):
+    NONEXISTENT = "nonexistent"
+    UNSPENT = "unspent"
+    SPENT = "spent"
+
+
+class BagFrontier:
+    """
+    State of every coin in a secured bag, and the spends still needed to unwind it.
+
+    Remaining spends are grouped into rounds. Round 0 holds the coins that exist and are unspent, which can all be
+    spent straight away, and each later round holds the coins created by spending the round before it.
+    """
+
+    states: dict[bytes32, NodeState]
+    rounds: list[list[CoinSpend]]
+    queries: int
+
+    def __init__(self) -> None:
+        self.states = {}
+        self.rounds = []
+        self.queries = 0
+
+    def add_remaining(self, round_index: int, coin_spend: CoinSpend) -> None:
+        while len(self.rounds) <= round_index:
+            self.rounds.append([])
+
+        self.rounds[round_index].append(coin_spend)
+
+    def count(self, state: NodeState) -> int:
+        return sum(1 for node_state in self.states.values() if node_state == state)
+
+    def remaining_spends(self) -> int:
+        return sum(len(coin_spends) for coin_spends in self.rounds)
+
+
+async def coin_states(
+    full_node_client: CoinRecordSource, coin_names: Sequence[bytes32], chunk_size: int = FRONTIER_CHUNK_SIZE
+) -> tuple[dict[bytes32, NodeState], int]:
+    """
+    States of the named coins looked up chunk_size names at a time, along with the number of calls made.
+    """
+    states = {coin_name: NodeState.NONEXISTENT for coin_name in coin_names}
+    queries = 0
+
+    for start in range(0, len(coin_names), chunk_size):
+        coin_records = await full_node_client.get_coin_records_by_names(
+            list(coin_names[start : start + chunk_size]), include_spent_coins=True
+        )
+        queries += 1
+
+        for coin_record in coin_records:
+            states[coin_record.coin.name()] = (
+                NodeState.SPENT if coin_record.spent_block_index > 0 else NodeState.UNSPENT
+            )
+
+    return states, queries
+
+
+async def scan_frontier(
+    full_node_client: CoinRecordSource,
+    coin_spends_by_depth: Sequence[Sequence[CoinSpend]],
+    chunk_size: int = FRONTIER_CHUNK_SIZE,
+) -> BagFrontier:
+    """
+    Classifies every coin of a bag from the root down, with one batched lookup per chunk of each level.
+
+    Only the children of spent coins are looked up. Children of coins that are unspent or don't exist yet can't
+    exist themselves, so a partially unwound bag only costs lookups down to its frontier.
+    """
+    frontier = BagFrontier()
+    # Coin name -> round it will be spent in, for coins still to be spent
+    rounds: dict[bytes32, int] = {}
+
+    for depth, coin_spends in enumerate(coin_spends_by_depth):
+        # The root is created by the genesis coin spend so it is always looked up
+        to_look_up = [
+            coin_spend.coin.name()
+            for coin_spend in coin_spends
+            if depth == 0 or frontier.states.get(coin_spend.coin.parent_coin_info) == NodeState.SPENT
+        ]
+
+        states, queries = await coin_states(full_node_client, to_look_up, chunk_size)
+        frontier.queries += queries
+
+        for coin_spend in coin_spends:
+            coin_name = coin_spend.coin.name()
+            state = states.get(coin_name, NodeState.NONEXISTENT)
+            frontier.states[coin_name] = state
+
+            if state == NodeState.SPENT:
+                continue
+
+            # Unspent coins can be spent now, the rest wait for the coin that creates them
+            parent_round = rounds.get(coin_spend.coin.parent_coin_info)
+            round_index = 0 if state == NodeState.UNSPENT or parent_round is None else parent_round + 1
+
+            rounds[coin_name] = round_index
+            frontier.add_remaining(round_index, coin_spend)
+
+    return frontier
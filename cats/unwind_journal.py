@@ -0,0 +1,258 @@
+from __future__ import annotations
+
+import sqlite3
+from collections.abc import Sequence
+from pathlib import Path
+
+from chia_rs import Coin, CoinSpend
+from chia_rs.sized_bytes import bytes32
+
+from cats.coin_watcher import CoinWatcher
+from cats.fee_pool import FeeCoinPool
+from cats.unwind_frontier import BagFrontier, NodeState
+
+SCHEMA = [
+    # One row naming the bag being unwound, written once it has first been scanned
+    "CREATE TABLE unwind(genesis_coin_id BLOB NOT NULL, asset_id BLOB NOT NULL)",
+    # Coins the first scan found already spent, by an unwind without a journal or by somebody else
+    "CREATE TABLE spent_before(coin_id BLOB PRIMARY KEY) WITHOUT ROWID",
+    # Coins split off to pay unwind fees, serialized
+    "CREATE TABLE fee_coins(coin BLOB NOT NULL)",
+    # Every bundle in the order it was planned, before it is pushed. Coin ids are concatenated, fee and change coins
+    # are serialized and NULL when no fee is paid.
+    "CREATE TABLE bundles(bundle_id INTEGER PRIMARY KEY, coin_ids BLOB NOT NULL, fee_coin BLOB, change_coin BLOB)",
+    "CREATE TABLE pushes(bundle_id INTEGER PRIMARY KEY, spend_bundle_id BLOB NOT NULL)",
+    # Peak height when each bundle was seen to be confirmed, at or just after the block that spent it
+    "CREATE TABLE confirmations(bundle_id INTEGER PRIMARY KEY, height INTEGER)",
+]
+
+
+class JournalBundle:
+    """
+    A bundle recorded in the journal, and how far it got before the unwind stopped.
+    """
+
+    bundle_id: int
+    coin_ids: list[bytes32]
+    fee_coin: Coin | None
+    change_coin: Coin | None
+    spend_bundle_id: bytes32 | None
+    confirmed: bool
+    height: int | None
+
+    def __init__(
+        self,
+        bundle_id: int,
+        coin_ids: list[bytes32],
+        fee_coin: Coin | None = None,
+        change_coin: Coin | None = None,
+        spend_bundle_id: bytes32 | None = None,
+        confirmed: bool = False,
+        height: int | None = None,
+    ) -> None:
+        self.bundle_id = bundle_id
+        self.coin_ids = coin_ids
+        self.fee_coin = fee_coin
+        self.change_coin = change_coin
+        self.spend_bundle_id = spend_bundle_id
+        self.confirmed = confirmed
+        self.height = height
+
+
+class UnwindJournal:
+    """
+    SQLite backed, append only record of unwinding an entire bag.
+
+    Each bundle is recorded when it is planned, pushed and confirmed. Rows are only ever inserted and committed one at a
+    time, so an unwind killed at any point leaves a journal it can resume from: bundles confirmed before are skipped
+    without looking anything up on chain, and bundles that were in flight are waited on again.
+    """
+
+    connection: sqlite3.Connection
+    genesis_coin_id: bytes32
+    asset_id: bytes32
+    started: bool
+
+    def __init__(self, connection: sqlite3.Connection, genesis_coin_id: bytes32, asset_id: bytes32) -> None:
+        self.connection = connection
+        self.genesis_coin_id = genesis_coin_id
+        self.asset_id = asset_id
+
+        row = connection.execute("SELECT genesis_coin_id, asset_id FROM unwind").fetchone()
+        self.started = row is not None
+
+        if row is not None and (bytes32(row[0]) != genesis_coin_id or bytes32(row[1]) != asset_id):
+            raise Exception(
+                f"Journal is for the bag created by {bytes32(row[0])} with asset id {bytes32(row[1])}, "
+                f"not {genesis_coin_id} with asset id {asset_id}"
+            )
+
+    @classmethod
+    def open(cls, path: str | Path, genesis_coin_id: bytes32, asset_id: bytes32) -> UnwindJournal:
+        """
+        Opens the journal at path, creating it if it doesn't exist yet.
+        """
+        connection = sqlite3.connect(path)
+
+        if connection.execute("SELECT name FROM sqlite_master WHERE name = 'unwind'").fetchone() is None:
+            for statement in SCHEMA:
+                connection.execute(statement)
+            connection.commit()
+
+        try:
+            return cls(connection, genesis_coin_id, asset_id)
+        except Exception:
+            connection.close()
+            raise
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def start(self, frontier: BagFrontier) -> None:
+        """
+        Records the bag and the coins a scan of it found already spent.
+        """
+        self.connection.executemany(
+            "INSERT INTO spent_before(coin_id) VALUES(?)",
+            [(coin_id,) for coin_id, state in frontier.states.items() if state == NodeState.SPENT],
+        )
+        self.connection.execute(
+            "INSERT INTO unwind(genesis_coin_id, asset_id) VALUES(?, ?)", (self.genesis_coin_id, self.asset_id)
+        )
+        self.connection.commit()
+
+        self.started = True
+
+    def fee_coins_split(self, coins: list[Coin]) -> None:
+        self.connection.executemany("INSERT INTO fee_coins(coin) VALUES(?)", [(bytes(coin),) for coin in coins])
+        self.connection.commit()
+
+    def bundle_planned(self, coin_spends: list[CoinSpend], fee_coin: Coin | None, change_coin: Coin | None) -> int:
+        """
+        Records a bundle about to be pushed, returning its id.
+        """
+        cursor = self.connection.execute(
+            "INSERT INTO bundles(coin_ids, fee_coin, change_coin) VALUES(?, ?, ?)",
+            (
+                b"".join(coin_spend.coin.name() for coin_spend in coin_spends),
+                None if fee_coin is None else bytes(fee_coin),
+                None if change_coin is None else bytes(change_coin),
+            ),
+        )
+        self.connection.commit()
+
+        if cursor.lastrowid is None:
+            raise Exception("Bundle was not recorded")
+
+        return cursor.lastrowid
+
+    def bundle_pushed(self, bundle_id: int, spend_bundle_id: bytes32) -> None:
+        # A bundle pushed again when resuming keeps the id it was first pushed with
+        self.connection.execute(
+            "INSERT OR IGNORE INTO pushes(bundle_id, spend_bundle_id) VALUES(?, ?)", (bundle_id, spend_bundle_id)
+        )
+        self.connection.commit()
+
+    def bundle_confirmed(self, bundle_id: int, height: int | None) -> None:
+        self.connection.execute("INSERT INTO confirmations(bundle_id, height) VALUES(?, ?)", (bundle_id, height))
+        self.connection.commit()
+
+    def bundles(self) -> list[JournalBundle]:
+        rows = self.connection.execute(
+            "SELECT bundles.bundle_id, coin_ids, fee_coin, change_coin, spend_bundle_id, height, "
+            "confirmations.bundle_id IS NOT NULL "
+            "FROM bundles "
+            "LEFT JOIN pushes ON pushes.bundle_id = bundles.bundle_id "
+            "LEFT JOIN confirmations ON confirmations.bundle_id = bundles.bundle_id "
+            "ORDER BY bundles.bundle_id"
+        ).fetchall()
+
+        return [
+            JournalBundle(
+                bundle_id,
+                [bytes32(coin_ids[index : index + 32]) for index in range(0, len(coin_ids), 32)],
+                None if fee_coin is None else Coin.from_bytes(fee_coin),
+                None if change_coin is None else Coin.from_bytes(change_coin),
+                None if spend_bundle_id is None else bytes32(spend_bundle_id),
+                bool(confirmed),
+                height,
+            )
+            for bundle_id, coin_ids, fee_coin, change_coin, spend_bundle_id, height, confirmed in rows
+        ]
+
+    def resume(
+        self, coin_spends_by_depth: Sequence[Sequence[CoinSpend]]
+    ) -> tuple[BagFrontier, list[tuple[JournalBundle, list[CoinSpend]]]]:
+        """
+        The frontier of the bag as the journal left it, without any lookups, along with the bundles that were still
+        waiting to be confirmed and their spends. Those bundles are left out of the frontier.
+        """
+        spent = {bytes32(coin_id) for (coin_id,) in self.connection.execute("SELECT coin_id FROM spent_before")}
+        in_flight: list[JournalBundle] = []
+
+        for bundle in self.bundles():
+            if bundle.confirmed:
+                spent.update(bundle.coin_ids)
+            else:
+                in_flight.append(bundle)
+
+        in_flight_coin_ids = {coin_id for bundle in in_flight for coin_id in bundle.coin_ids}
+        in_flight_spends: dict[bytes32, CoinSpend] = {}
+        frontier = BagFrontier()
+        # Coin name -> round it will be spent in, for coins still to be spent
+        rounds: dict[bytes32, int] = {}
+
+        for depth, coin_spends in enumerate(coin_spends_by_depth):
+            for coin_spend in coin_spends:
+                coin_name = coin_spend.coin.name()
+                parent_coin_name = coin_spend.coin.parent_coin_info
+
+                # The root is taken to exist, spending it waits for the bag to be launched if it hasn't been
+                if coin_name in spent:
+                    state = NodeState.SPENT
+                elif depth == 0 or parent_coin_name in spent:
+                    state = NodeState.UNSPENT
+                else:
+                    state = NodeState.NONEXISTENT
+                frontier.states[coin_name] = state
+
+                if state == NodeState.SPENT:
+                    continue
+
+                # Coins created by a bundle in flight are spent once it confirms, as they would have been
+                if coin_name in in_flight_coin_ids:
+                    in_flight_spends[coin_name] = coin_spend
+                    rounds[coin_name] = 0
+                    continue
+
+                parent_round = rounds.get(parent_coin_name)
+                round_index = 0 if state == NodeState.UNSPENT or parent_round is None else parent_round + 1
+
+                rounds[coin_name] = round_index
+                frontier.add_remaining(round_index, coin_spend)
+
+        if len(in_flight_spends) != len(in_flight_coin_ids):
+            raise Exception("Journal has bundles spending coins that are not in the bag")
+
+        return frontier, [(bundle, [in_flight_spends[coin_id] for coin_id in bundle.coin_ids]) for bundle in in_flight]
+
+    def fee_pool(self, coin_watcher: CoinWatcher) -> FeeCoinPool | None:
+        """
+        Fee coins left from the coins split off by an earlier run, or None if none were. Coins are added as pending,
+        so change from bundles that were in flight is only used once they confirm.
+        """
+        split_coins = [Coin.from_bytes(coin) for (coin,) in self.connection.execute("SELECT coin FROM fee_coins")]
+
+        if len(split_coins) == 0:
+            return None
+
+        bundles = self.bundles()
+        used = {bundle.fee_coin for bundle in bundles if bundle.fee_coin is not None}
+        change_coins = [bundle.change_coin for bundle in bundles if bundle.change_coin is not None]
+        fee_pool = FeeCoinPool(coin_watcher, split_coins[0].puzzle_hash, [])
+
+        for coin in split_coins + change_coins:
+            if coin not in used:
+                fee_pool.add_pending(coin)
+
+        return fee_pool
@@ -0,0 +1,285 @@
+from __future__ import annotations
+
+import json
+import os
+from collections.abc import Iterable, Mapping
+from pathlib import Path
+from typing import Any, BinaryIO
+
+from chia.types.blockchain_format.program import Program
+from chia.types.condition_opcodes import ConditionOpcode
+from chia.wallet.cat_wallet.cat_utils import CAT_MOD, construct_cat_puzzle, match_cat_puzzle
+from chia.wallet.uncurried_puzzle import uncurry_puzzle
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint64
+
+from cats.secure_the_bag import CATOuterPuzzleHasher, Target, TargetCoin
+
+# Number of hex characters of the target puzzle hash used to pick the shard a proof is written to
+PROOF_PREFIX_LENGTH = 2
+
+# Number of proofs buffered across all shards before they are appended to their files
+PROOF_WRITE_CHUNK_SIZE = 10000
+
+# Directory of the proofs holding the shards of batches shared by every proof
+BATCHES_DIRECTORY = "batches"
+
+# File in the proofs directory recording the prefix length its shards were written with
+PROOFS_METADATA = "proofs.json"
+
+
+def proof_shard_path(proofs_path: str | Path, puzzle_hash: bytes32, prefix_length: int = PROOF_PREFIX_LENGTH) -> Path:
+    return Path(proofs_path) / f"{puzzle_hash.hex()[:prefix_length]}.jsonl"
+
+
+def _inner_puzzle_hex(puzzle: Program, asset_id: bytes32 | None) -> str:
+    if asset_id is None:
+        return bytes(puzzle).hex()
+
+    curried_args = match_cat_puzzle(uncurry_puzzle(puzzle))
+
+    if curried_args is None:
+        raise Exception("Expected CAT")
+
+    _, _, inner_puzzle = curried_args
+
+    return bytes(inner_puzzle).hex()
+
+
+def export_unwind_proofs(
+    proofs_path: str | Path,
+    targets: Iterable[Target],
+    parent_puzzle_lookup: Mapping[bytes32, TargetCoin],
+    asset_id: bytes32 | None,
+    prefix_length: int = PROOF_PREFIX_LENGTH,
+) -> int:
+    """
+    Writes a proof for every target as JSON lines, sharded into one file per puzzle hash prefix.
+
+    Each target line only names the lookup key of the coin that creates it. Every batch of the bag is written once to
+    the batch shards, keyed by the lookup key of its coin and naming the coin that creates it in turn, so proofs share
+    their ancestors rather than repeating them. Existing shards in proofs_path are replaced.
+
+    Every shard is sorted once written so a proof can be found by binary search, and the prefix length is recorded in
+    the proofs directory for reading them back.
+    """
+    batches_path = Path(proofs_path) / BATCHES_DIRECTORY
+    os.makedirs(batches_path, exist_ok=True)
+
+    for shard in [*Path(proofs_path).glob("*.jsonl"), *batches_path.glob("*.jsonl")]:
+        os.remove(shard)
+
+    with open(Path(proofs_path) / PROOFS_METADATA, "w") as metadata:
+        json.dump({"prefix_length": prefix_length}, metadata)
+
+    cat_hasher = None if asset_id is None else CATOuterPuzzleHasher(asset_id)
+    asset_id_json = json.dumps(None if asset_id is None else asset_id.hex())
+
+    count = 0
+    shards: dict[Path, list[str]] = {}
+    # Lookup keys of the batches written so far
+    written: set[bytes32] = set()
+
+    def flush() -> None:
+        for shard_path, lines in shards.items():
+            with open(shard_path, "a") as shard:
+                shard.writelines(lines)
+
+        shards.clear()
+
+    for target in targets:
+        key = target.puzzle_hash if cat_hasher is None else cat_hasher.outer_puzzle_hash(target.puzzle_hash)
+        parent = parent_puzzle_lookup.get(key)
+
+        if parent is None:
+            raise Exception(f"{target.puzzle_hash} is not in the secured bag")
+
+        line = (
+            f'{{"puzzle_hash": "{target.puzzle_hash.hex()}", "amount": {target.amount}, '
+            f'"parent": "{parent.puzzle_hash.hex()}"}}\n'
+        )
+        shards.setdefault(proof_shard_path(proofs_path, target.puzzle_hash, prefix_length), []).append(line)
+        count += 1
+
+        # Walk up until reaching a batch that has already been written along with all of its ancestors
+        while parent is not None and parent.puzzle_hash not in written:
+            written.add(parent.puzzle_hash)
+            grandparent = parent_puzzle_lookup.get(parent.puzzle_hash)
+            grandparent_json = "null" if grandparent is None else f'"{grandparent.puzzle_hash.hex()}"'
+
+            line = (
+                f'{{"key": "{parent.puzzle_hash.hex()}", "puzzle": "{_inner_puzzle_hex(parent.puzzle, asset_id)}", '
+                f'"amount": {parent.amount}, "asset_id": {asset_id_json}, "parent": {grandparent_json}}}\n'
+            )
+            shards.setdefault(proof_shard_path(batches_path, parent.puzzle_hash, prefix_length), []).append(line)
+
+            parent = grandparent
+
+        if count % PROOF_WRITE_CHUNK_SIZE == 0:
+            flush()
+
+    flush()
+
+    # Lines of a shard share their layout up to the key so sorting them sorts by key
+    for shard_path in [*Path(proofs_path).glob("*.jsonl"), *batches_path.glob("*.jsonl")]:
+        shard_path.write_bytes(b"".join(sorted(shard_path.read_bytes().splitlines(keepends=True))))
+
+    return count
+
+
+def _prefix_length(proofs_path: Path) -> int:
+    metadata_path = proofs_path / PROOFS_METADATA
+
+    if not metadata_path.exists():
+        raise Exception(f"{proofs_path} does not hold unwind proofs, {PROOFS_METADATA} is missing")
+
+    with open(metadata_path) as metadata:
+        prefix_length: int = json.load(metadata)["prefix_length"]
+
+    return prefix_length
+
+
+def _line_at(shard: BinaryIO, offset: int) -> bytes:
+    # First line starting at or after offset
+    shard.seek(max(offset - 1, 0))
+
+    if offset > 0:
+        shard.readline()
+
+    return shard.readline()
+
+
+def _find_line(shard_path: Path, field: str, puzzle_hash: bytes32) -> dict[str, Any] | None:
+    """
+    Binary search of a sorted shard for the line with field set to puzzle_hash, only reading the lines it visits.
+    """
+    prefix = f'{{"{field}": "{puzzle_hash.hex()}"'.encode()
+
+    with open(shard_path, "rb") as shard:
+        low = 0
+        high = os.fstat(shard.fileno()).st_size
+
+        # Lowest offset whose next line doesn't sort before the one being looked for
+        while low < high:
+            middle = (low + high) // 2
+            line = _line_at(shard, middle)
+
+            if line != b"" and line[: len(prefix)] < prefix:
+                low = middle + 1
+            else:
+                high = middle
+
+        line = _line_at(shard, low)
+
+    if not line.startswith(prefix):
+        return None
+
+    record: dict[str, Any] = json.loads(line)
+
+    return record
+
+
+def read_unwind_proof(proof_path: str | Path, puzzle_hash: bytes32) -> dict[str, Any]:
+    """
+    Reads the proof for a target from shards written by export_unwind_proofs.
+
+    Ancestors are listed from the coin that creates the target up to the root of the bag. Each ancestor is the inner
+    batch puzzle and amount of that coin, CAT puzzles are wrapped back around them when the proof is loaded.
+
+    proof_path is either a target shard file or the directory of shards.
+    """
+    proofs_path = Path(proof_path) if os.path.isdir(proof_path) else Path(proof_path).parent
+    prefix_length = _prefix_length(proofs_path)
+    batches_path = proofs_path / BATCHES_DIRECTORY
+
+    if os.path.isdir(proof_path):
+        shard_path = proof_shard_path(proofs_path, puzzle_hash, prefix_length)
+    else:
+        shard_path = Path(proof_path)
+
+    target = None if not shard_path.exists() else _find_line(shard_path, "puzzle_hash", puzzle_hash)
+
+    if target is None:
+        raise Exception(f"No unwind proof for {puzzle_hash} in {proof_path}")
+
+    ancestors: list[dict[str, Any]] = []
+    asset_id = None
+    parent_key = target["parent"]
+    seen: set[bytes32] = set()
+
+    while parent_key is not None:
+        key = bytes32.fromhex(parent_key)
+        batch_shard_path = proof_shard_path(batches_path, key, prefix_length)
+        batch = None if not batch_shard_path.exists() else _find_line(batch_shard_path, "key", key)
+
+        # A batch seen twice means the shards are corrupt and would never reach the root
+        if batch is None or key in seen:
+            raise Exception(f"Unwind proof for {puzzle_hash} is missing the batch {key}")
+
+        seen.add(key)
+
+        ancestors.append({"puzzle": batch["puzzle"], "amount": batch["amount"]})
+        asset_id = batch["asset_id"]
+        parent_key = batch["parent"]
+
+    return {
+        "puzzle_hash": target["puzzle_hash"],
+        "amount": target["amount"],
+        "asset_id": asset_id,
+        "ancestors": ancestors,
+    }
+
+
+def load_unwind_proof(
+    proof_path: str | Path, puzzle_hash: bytes32, asset_id: bytes32 | None
+) -> dict[bytes32, TargetCoin]:
+    """
+    Reads the proof for a target into a parent puzzle lookup holding just the coins between it and the root.
+
+    proof_path is either a shard file or a directory of shards written by export_unwind_proofs.
+    """
+    return parent_puzzle_lookup_from_proof(read_unwind_proof(proof_path, puzzle_hash), asset_id)
+
+
+def parent_puzzle_lookup_from_proof(proof: dict[str, Any], asset_id: bytes32 | None) -> dict[bytes32, TargetCoin]:
+    """
+    Rebuilds the parent puzzle lookup entries along the path of a proof, checking each coin creates the next.
+    """
+    proof_asset_id = None if proof["asset_id"] is None else bytes32.fromhex(proof["asset_id"])
+
+    if proof_asset_id != asset_id:
+        raise Exception(f"Unwind proof was not secured with asset id {asset_id}")
+
+    cat_hasher = None if asset_id is None else CATOuterPuzzleHasher(asset_id)
+    target = Target(bytes32.fromhex(proof["puzzle_hash"]), uint64(proof["amount"]))
+    parent_puzzle_lookup: dict[bytes32, TargetCoin] = {}
+
+    for ancestor in proof["ancestors"]:
+        inner_puzzle = Program.from_bytes(bytes.fromhex(ancestor["puzzle"]))
+        amount = uint64(ancestor["amount"])
+
+        # Batch puzzles are `(q . conditions)`, the target must be one of the coins created
+        created_coins = [
+            (bytes32(condition.at("rf").as_atom()), condition.at("rrf").as_int())
+            for condition in inner_puzzle.rest().as_iter()
+            if condition.first().as_int() == ConditionOpcode.CREATE_COIN[0]
+        ]
+
+        if (target.puzzle_hash, target.amount) not in created_coins:
+            raise Exception(f"Unwind proof is invalid, {target.puzzle_hash} is not created by its parent")
+
+        if sum(created_amount for _, created_amount in created_coins) != amount:
+            raise Exception("Unwind proof is invalid, parent amount does not match its children")
+
+        if asset_id is None:
+            puzzle = inner_puzzle
+        else:
+            puzzle = construct_cat_puzzle(CAT_MOD, asset_id, inner_puzzle)
+
+        key = target.puzzle_hash if cat_hasher is None else cat_hasher.outer_puzzle_hash(target.puzzle_hash)
+
+        parent_puzzle_lookup[key] = TargetCoin(target, puzzle, amount)
+
+        target = Target(inner_puzzle.get_tree_hash(), amount)
+
+    return parent_puzzle_lookup
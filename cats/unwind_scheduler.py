@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from collections.abc import Awaitable, Callable, Sequence
+
+from chia_rs import CoinSpend
+from chia_rs.sized_bytes import bytes32
+
+from cats.fan_out import cat_unwind_spend_cost, max_bundle_cost
+from cats.unwind_frontier import BagFrontier
+
+# Number of spend bundles that can be waiting to be confirmed at once
+BUNDLE_WINDOW = 4
+# Fraction of the maximum block cost each spend bundle can use
+BUNDLE_COST_FRACTION = 0.5
+MAX_BUNDLE_COST = max_bundle_cost(BUNDLE_COST_FRACTION)
+
+
+class UnwindScheduler:
+    """
+    Unwinds a bag as a DAG of spends rather than one level at a time.
+
+    Each coin spend becomes ready as soon as the spend of its own parent is confirmed, and up to window bundles of
+    ready spends are in flight at once, so unwinding takes about a block per level of the bag rather than a block per
+    bundle.
+
+    Bundles are packed by the real cost of each spend rather than a fixed number of spends, so many narrow spends or a
+    few wide ones share a bundle. fee_spend_cost gives the cost of the fee spend for a number of CAT spends, when one
+    is added to each bundle.
+    """
+
+    window: int
+    max_bundle_cost: int
+    levels: int
+    spend_cost: Callable[[CoinSpend], int]
+    fee_spend_cost: Callable[[int], int] | None
+    ready: deque[CoinSpend]
+    # Parent coin name -> spends of the coins it creates that are still to be made
+    children: dict[bytes32, list[CoinSpend]]
+    # Coin name -> cost of its spend, for spends looked at but not yet taken into a bundle
+    spend_costs: dict[bytes32, int]
+    bundles_pushed: int
+    max_in_flight: int
+
+    def __init__(
+        self,
+        frontier: BagFrontier,
+        window: int = BUNDLE_WINDOW,
+        max_bundle_cost: int = MAX_BUNDLE_COST,
+        levels: int = 1,
+        spend_cost: Callable[[CoinSpend], int] = cat_unwind_spend_cost,
+        fee_spend_cost: Callable[[int], int] | None = None,
+    ) -> None:
+        if window < 1:
+            raise Exception("Bundle window must be at least 1")
+        if levels < 1:
+            raise Exception("Bundle levels must be at least 1")
+
+        self.window = window
+        self.max_bundle_cost = max_bundle_cost
+        self.levels = levels
+        self.spend_cost = spend_cost
+        self.fee_spend_cost = fee_spend_cost
+        self.ready = deque(frontier.rounds[0] if len(frontier.rounds) > 0 else [])
+        self.children = {}
+        self.spend_costs = {}
+        self.bundles_pushed = 0
+        self.max_in_flight = 0
+
+        for coin_spends in frontier.rounds[1:]:
+            for coin_spend in coin_spends:
+                self.children.setdefault(coin_spend.coin.parent_coin_info, []).append(coin_spend)
+
+    def next_bundle(self) -> list[CoinSpend]:
+        bundle: list[CoinSpend] = []
+        cost = 0
+
+        while len(self.ready) > 0:
+            coin_spend = self.ready[0]
+            spend_cost = self._spend_cost(coin_spend)
+
+            if not self._fits(len(bundle) + 1, cost + spend_cost):
+                if len(bundle) == 0:
+                    raise Exception(
+                        f"Spend of {coin_spend.coin.name().hex()} costs {spend_cost} which does not fit in a spend "
+                        f"bundle costing {self.max_bundle_cost}"
+                    )
+
+                break
+
+            self.ready.popleft()
+            self.spend_costs.pop(coin_spend.coin.name(), None)
+            bundle.append(coin_spend)
+            cost += spend_cost
+            parents = [coin_spend]
+
+            # Descendants of the coin are ephemeral, created and spent by the same bundle
+            for _ in range(self.levels - 1):
+                children: list[CoinSpend] = []
+
+                for parent in parents:
+                    taken, cost = self._take_children(parent.coin.name(), len(bundle), cost)
+                    bundle += taken
+                    children += taken
+
+                parents = children
+
+        return bundle
+
+    def _spend_cost(self, coin_spend: CoinSpend) -> int:
+        """
+        Cost of a spend, only run once for a spend that doesn't fit and is looked at again for a later bundle.
+        """
+        coin_name = coin_spend.coin.name()
+        spend_cost = self.spend_costs.get(coin_name)
+
+        if spend_cost is None:
+            spend_cost = self.spend_cost(coin_spend)
+            self.spend_costs[coin_name] = spend_cost
+
+        return spend_cost
+
+    def _fits(self, spend_count: int, cost: int) -> bool:
+        """
+        Whether spend_count CAT spends costing cost, and their fee spend, fit in a spend bundle.
+        """
+        if self.fee_spend_cost is not None:
+            cost += self.fee_spend_cost(spend_count)
+
+        return cost <= self.max_bundle_cost
+
+    def _take_children(self, coin_name: bytes32, spend_count: int, cost: int) -> tuple[list[CoinSpend], int]:
+        """
+        Removes spends of coins created by coin_name while they fit in a bundle of spend_count spends costing cost,
+        leaving the rest to become ready once it confirms. Returns the spends taken and the new cost.
+        """
+        children = self.children.get(coin_name, [])
+        taken: list[CoinSpend] = []
+
+        for child in children:
+            child_cost = self._spend_cost(child)
+
+            if not self._fits(spend_count + len(taken) + 1, cost + child_cost):
+                break
+
+            self.spend_costs.pop(child.coin.name(), None)
+            taken.append(child)
+            cost += child_cost
+
+        if len(taken) < len(children):
+            self.children[coin_name] = children[len(taken) :]
+        else:
+            self.children.pop(coin_name, None)
+
+        return taken, cost
+
+    def created_by(self, bundle: list[CoinSpend]) -> list[CoinSpend]:
+        """
+        Spends still to be made of the coins created by a bundle.
+        """
+        return [child for coin_spend in bundle for child in self.children.get(coin_spend.coin.name(), [])]
+
+    def confirmed(self, bundle: list[CoinSpend]) -> None:
+        """
+        Marks the spends of a bundle as confirmed, making the coins they created ready to spend.
+        """
+        for coin_spend in bundle:
+            self.ready.extend(self.children.pop(coin_spend.coin.name(), []))
+
+    async def run(
+        self,
+        push_bundle: Callable[[list[CoinSpend]], Awaitable[None]],
+        wait_for_spend: Callable[[bytes32], Awaitable[None]],
+        bundle_confirmed: Callable[[list[CoinSpend]], None] | None = None,
+        pushed: Sequence[list[CoinSpend]] = (),
+    ) -> None:
+        """
+        Pushes bundles of ready spends with push_bundle until the bag is unwound, waiting on each spend with
+        wait_for_spend to know when its children can be spent. bundle_confirmed is called as each bundle confirms.
+
+        Bundles in pushed were pushed before the scheduler started, such as by an unwind that was interrupted, and
+        start out in flight. Their spends must not be in the frontier.
+        """
+        in_flight = {asyncio.create_task(self._confirm(bundle, wait_for_spend)) for bundle in pushed}
+
+        try:
+            await self._unwind(in_flight, push_bundle, wait_for_spend, bundle_confirmed)
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+        if len(self.children) > 0:
+            raise Exception(f"{len(self.children)} coins were never created by their parent spends")
+
+    async def _unwind(
+        self,
+        in_flight: set[asyncio.Task[list[CoinSpend]]],
+        push_bundle: Callable[[list[CoinSpend]], Awaitable[None]],
+        wait_for_spend: Callable[[bytes32], Awaitable[None]],
+        bundle_confirmed: Callable[[list[CoinSpend]], None] | None,
+    ) -> None:
+        while len(self.ready) > 0 or len(in_flight) > 0:
+            await self._fill_window(in_flight, push_bundle, wait_for_spend)
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            in_flight -= done
+
+            for task in done:
+                bundle = task.result()
+                self.confirmed(bundle)
+
+                if bundle_confirmed is not None:
+                    bundle_confirmed(bundle)
+
+    async def _fill_window(
+        self,
+        in_flight: set[asyncio.Task[list[CoinSpend]]],
+        push_bundle: Callable[[list[CoinSpend]], Awaitable[None]],
+        wait_for_spend: Callable[[bytes32], Awaitable[None]],
+    ) -> None:
+        while len(self.ready) > 0 and len(in_flight) < self.window:
+            bundle = self.next_bundle()
+            await push_bundle(bundle)
+            self.bundles_pushed += 1
+            in_flight.add(asyncio.create_task(self._confirm(bundle, wait_for_spend)))
+            self.max_in_flight = max(self.max_in_flight, len(in_flight))
+
+    async def _confirm(
+        self, bundle: list[CoinSpend], wait_for_spend: Callable[[bytes32], Awaitable[None]]
+    ) -> list[CoinSpend]:
+        await asyncio.gather(*(wait_for_spend(coin_spend.coin.name()) for coin_spend in bundle))
+        return bundle
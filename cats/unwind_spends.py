@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Protocol
+
+from chia.consensus.default_constants import DEFAULT_CONSTANTS
+from chia.types.blockchain_format.program import Program
+from chia.wallet.cat_wallet.cat_utils import (
+    CAT_MOD,
+    SpendableCAT,
+    match_cat_puzzle,
+    unsigned_spend_bundle_for_spendable_cats,
+)
+from chia.wallet.lineage_proof import LineageProof
+from chia.wallet.uncurried_puzzle import uncurry_puzzle
+from chia_rs import CoinRecord, CoinSpend, G2Element, SpendBundle, get_conditions_from_spendbundle
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint32, uint64
+
+from cats.coin_watcher import CoinWatcher, FullNodeSource
+from cats.secure_the_bag import BagCoinSpends
+
+
+def lineage_proof(parent_coin_spend: CoinSpend) -> LineageProof:
+    """
+    Lineage proof for spending a CAT created by parent_coin_spend.
+    """
+    parent_curried_args = match_cat_puzzle(uncurry_puzzle(parent_coin_spend.puzzle_reveal))
+
+    if parent_curried_args is None:
+        raise Exception("Expected parent to be CAT")
+
+    _, _, parent_inner_puzzle = parent_curried_args
+
+    return LineageProof(
+        parent_coin_spend.coin.parent_coin_info,
+        parent_inner_puzzle.get_tree_hash(),
+        uint64(parent_coin_spend.coin.amount),
+    )
+
+
+class EveSource(FullNodeSource, Protocol):
+    """
+    The part of FullNodeRpcClient needed to look up the eve spend.
+    """
+
+    async def get_coin_record_by_name(self, coin_id: bytes32) -> CoinRecord | None: ...
+
+    async def get_puzzle_and_solution(self, coin_id: bytes32, height: uint32) -> CoinSpend | None: ...
+
+
+class BagLineage:
+    """
+    Spends of the parents of bag coins, needed for their lineage proofs.
+
+    The parent of every coin but the root is another coin of the bag, so its spend is known from the tree without any
+    lookups and before it has even been confirmed. The root is created by the eve spend, which is fetched from the
+    chain once.
+    """
+
+    full_node_client: EveSource
+    coin_watcher: CoinWatcher
+    bag_coin_spends: BagCoinSpends
+
+    def __init__(self, full_node_client: EveSource, coin_watcher: CoinWatcher, bag_coin_spends: BagCoinSpends) -> None:
+        self.full_node_client = full_node_client
+        self.coin_watcher = coin_watcher
+        self.bag_coin_spends = bag_coin_spends
+        self._eve_coin_spend: CoinSpend | None = None
+
+    def known_parent_coin_spend(self, coin_spend: CoinSpend) -> CoinSpend | None:
+        """
+        Spend of the parent of a coin if it is known without going to the chain, which is for every coin but the root.
+        """
+        parent_coin_spend, _ = self.bag_coin_spends.parent_of_puzzle_hash(coin_spend.coin.puzzle_hash)
+
+        return parent_coin_spend
+
+    async def parent_coin_spend(self, coin_spend: CoinSpend) -> CoinSpend:
+        parent_coin_spend = self.known_parent_coin_spend(coin_spend)
+
+        if parent_coin_spend is not None:
+            return parent_coin_spend
+
+        if self._eve_coin_spend is None:
+            self._eve_coin_spend = await self._fetch_eve_coin_spend(coin_spend)
+
+        return self._eve_coin_spend
+
+    async def _fetch_eve_coin_spend(self, root_coin_spend: CoinSpend) -> CoinSpend:
+        # The eve coin is only spent once the bag has been launched
+        print(f"Waiting for unspent coin {root_coin_spend.coin.name().hex()}")
+        await self.coin_watcher.wait_for_unspent(root_coin_spend.coin.name())
+
+        eve_r = await self.full_node_client.get_coin_record_by_name(root_coin_spend.coin.parent_coin_info)
+        if eve_r is None:
+            raise Exception("Eve coin does not exist")
+        eve_coin_spend = await self.full_node_client.get_puzzle_and_solution(
+            root_coin_spend.coin.parent_coin_info, eve_r.spent_block_index
+        )
+        if eve_coin_spend is None:
+            raise Exception("Eve coin does not exist")
+
+        return eve_coin_spend
+
+
+def build_unwind_spend(tail_hash_bytes: bytes32, coin_spend: CoinSpend, parent_coin_spend: CoinSpend) -> CoinSpend:
+    """
+    Unsigned CAT spend of a bag coin created by parent_coin_spend.
+    """
+    curried_args = match_cat_puzzle(uncurry_puzzle(coin_spend.puzzle_reveal))
+
+    if curried_args is None:
+        raise Exception("Expected CAT")
+
+    _, _, inner_puzzle = curried_args
+
+    spendable_cat = SpendableCAT(
+        coin_spend.coin,
+        tail_hash_bytes,
+        inner_puzzle,
+        Program.to([]),
+        lineage_proof=lineage_proof(parent_coin_spend),
+    )
+
+    return unsigned_spend_bundle_for_spendable_cats(CAT_MOD, [spendable_cat]).coin_spends[0]
+
+
+def validate_unwind_spends(coin_spends: list[CoinSpend], max_cost: int) -> int:
+    """
+    Runs every spend of an unwind bundle together, checking their conditions and total cost the way the mempool does
+    so an invalid bundle is never pushed. Returns the cost of the spends.
+    """
+    try:
+        conditions = get_conditions_from_spendbundle(
+            SpendBundle(coin_spends, G2Element()),
+            max_cost,
+            DEFAULT_CONSTANTS,
+            DEFAULT_CONSTANTS.HARD_FORK_HEIGHT,
+        )
+    except ValueError as e:
+        raise Exception(f"Unwind spends are invalid: {e}")
+
+    return int(conditions.cost)
+
+
+def _build_unwind_spend(tail_hash_bytes: bytes32, coin_spend: bytes, parent_coin_spend: bytes) -> bytes:
+    # Coin spends can't be pickled so they cross the process boundary serialized
+    return bytes(
+        build_unwind_spend(tail_hash_bytes, CoinSpend.from_bytes(coin_spend), CoinSpend.from_bytes(parent_coin_spend))
+    )
+
+
+def _validate_unwind_spends(spend_bundle: bytes, max_cost: int) -> int:
+    return validate_unwind_spends(list(SpendBundle.from_bytes(spend_bundle).coin_spends), max_cost)
+
+
+class UnwindSpendBuilder:
+    """
+    Builds and validates unwind spends, in a process pool when there is more than one worker.
+
+    With a pool, spends can be built ahead of the bundles that need them. Building the spends of the coins a bundle
+    creates while it waits to be confirmed means the next bundles are ready as soon as their parents are, and the
+    event loop is left to handle I/O.
+    """
+
+    tail_hash_bytes: bytes32
+    bag_lineage: BagLineage
+    workers: int
+
+    def __init__(self, tail_hash_bytes: bytes32, bag_lineage: BagLineage, workers: int = 1) -> None:
+        if workers < 1:
+            raise Exception(f"Workers must be at least 1 but got {workers}")
+
+        self.tail_hash_bytes = tail_hash_bytes
+        self.bag_lineage = bag_lineage
+        self.workers = workers
+        self._executor: ProcessPoolExecutor | None = None
+        # Coin name -> spend being built ahead of its bundle
+        self._building: dict[bytes32, Future[bytes]] = {}
+
+        if workers > 1:
+            self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+        self._building = {}
+
+    def build_ahead(self, coin_spends: list[CoinSpend]) -> None:
+        """
+        Starts building spends of coins that will be spent by later bundles. Does nothing without a pool.
+        """
+        if self._executor is None:
+            return
+
+        for coin_spend in coin_spends:
+            coin_name = coin_spend.coin.name()
+            parent_coin_spend = self.bag_lineage.known_parent_coin_spend(coin_spend)
+
+            if coin_name in self._building or parent_coin_spend is None:
+                continue
+
+            self._building[coin_name] = self._executor.submit(
+                _build_unwind_spend, self.tail_hash_bytes, bytes(coin_spend), bytes(parent_coin_spend)
+            )
+
+    async def build(self, bundle: list[CoinSpend], max_cost: int) -> list[CoinSpend]:
+        """
+        Unsigned CAT spends of a bundle of bag coins, validated together against max_cost.
+        """
+        self.build_ahead(bundle)
+        cat_spends: list[CoinSpend] = []
+
+        for coin_spend in bundle:
+            future = self._building.pop(coin_spend.coin.name(), None)
+
+            if future is not None:
+                cat_spends.append(CoinSpend.from_bytes(await asyncio.wrap_future(future)))
+            else:
+                parent_coin_spend = await self.bag_lineage.parent_coin_spend(coin_spend)
+                cat_spends.append(build_unwind_spend(self.tail_hash_bytes, coin_spend, parent_coin_spend))
+
+        # Throw an error before pushing to full node if any spend is invalid
+        if self._executor is None:
+            validate_unwind_spends(cat_spends, max_cost)
+        else:
+            await asyncio.wrap_future(
+                self._executor.submit(_validate_unwind_spends, bytes(SpendBundle(cat_spends, G2Element())), max_cost)
+            )
+
+        return cat_spends
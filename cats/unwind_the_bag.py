@@ -2,27 +2,16 @@ from __future__ import annotations
 
 import asyncio
 import os
-from collections import defaultdict
-from collections.abc import Coroutine
+from collections.abc import Mapping
 from pathlib import Path
 from typing import Any
 
 import click
 from chia.cmds.cmds_util import get_wallet
 from chia.full_node.full_node_rpc_client import FullNodeRpcClient
-from chia.types.blockchain_format.program import Program, run_with_cost
 from chia.util.bech32m import decode_puzzle_hash
 from chia.util.config import load_config
-from chia.wallet.cat_wallet.cat_utils import (
-    CAT_MOD,
-    SpendableCAT,
-    construct_cat_puzzle,
-    match_cat_puzzle,
-    unsigned_spend_bundle_for_spendable_cats,
-)
-from chia.wallet.conditions import AssertAnnouncement
-from chia.wallet.lineage_proof import LineageProof
-from chia.wallet.uncurried_puzzle import uncurry_puzzle
+from chia.wallet.conditions import AssertCoinAnnouncement
 from chia.wallet.util.tx_config import DEFAULT_COIN_SELECTION_CONFIG, DEFAULT_TX_CONFIG
 from chia.wallet.wallet_request_types import (
     Addition,
@@ -34,114 +23,63 @@ from chia.wallet.wallet_request_types import (
 )
 from chia.wallet.wallet_rpc_client import WalletRpcClient
 from chia.wallet.wallet_spend_bundle import WalletSpendBundle
-from chia_rs import CoinSpend, G2Element
+from chia_rs import Coin, CoinSpend, G2Element
 from chia_rs.sized_bytes import bytes32
 from chia_rs.sized_ints import uint32, uint64
 
+from cats.bag_manifest import BagManifest
+from cats.coin_watcher import CoinWatcher
+from cats.fan_out import MAX_SPEND_BUNDLE_COST, fee_spend_cost, max_bundle_cost, unwind_spend_cost
+from cats.fee_pool import FeeCoinPool, fee_coin_amount, split_fee_coins
+from cats.progress import BagProgress, progress_from_options
 from cats.secure_the_bag import (
+    BagCoinSpends,
+    CATOuterPuzzleHasher,
     TargetCoin,
-    batch_the_bag,
-    parent_of_puzzle_hash,
-    read_secure_the_bag_targets,
+    parse_level_widths,
     secure_the_bag,
 )
+from cats.target_file import open_secure_the_bag_targets
+from cats.unwind_frontier import NodeState, coin_states, scan_frontier
+from cats.unwind_journal import JournalBundle, UnwindJournal
+from cats.unwind_proof import load_unwind_proof
+from cats.unwind_scheduler import BUNDLE_COST_FRACTION, BUNDLE_WINDOW, UnwindScheduler
+from cats.unwind_spends import BagLineage, UnwindSpendBuilder
 
 NULL_SIGNATURE = G2Element()
 
 
-async def unspent_coin_exists(full_node_client: FullNodeRpcClient, coin_name: bytes32) -> bool:
-    """
-    Checks if an unspent coin exists.
-
-    Raises an exception if coin has already been spent.
-    """
-    coin_record = await full_node_client.get_coin_record_by_name(coin_name)
-
-    if coin_record is None:
-        return False
-
-    if coin_record.spent_block_index > 0:
-        raise Exception(f"Coin {coin_name} has already been spent")
-
-    return True
-
-
-async def wait_for_unspent_coin(full_node_client: FullNodeRpcClient, coin_name: bytes32) -> None:
-    """
-    Repeatedly poll full node until unspent coin is created.
-
-    Raises an exception if coin has already been spent.
-    """
-    while True:
-        print(f"Waiting for unspent coin {coin_name.hex()}")
-
-        exists = await unspent_coin_exists(full_node_client, coin_name)
-
-        if exists:
-            print(f"Coin {coin_name.hex()} exists and is unspent")
-
-            break
-
-        print(f"Unspent coin {coin_name.hex()} does not exist")
-
-        await asyncio.sleep(3)
-
-
-async def wait_for_coin_spend(full_node_client: FullNodeRpcClient, coin_name: bytes32) -> None:
-    """
-    Repeatedly poll full node until coin is spent.
-
-    This is used to wait for coins spend before spending children.
-    """
-    while True:
-        print(f"Waiting for coin spend {coin_name.hex()}")
-
-        coin_record = await full_node_client.get_coin_record_by_name(coin_name)
-
-        if coin_record is None:
-            print(f"Coin {coin_name.hex()} does not exist")
-
-            continue
-
-        if coin_record.spent_block_index > 0:
-            print(f"Coin {coin_name.hex()} has been spent")
-
-            break
-
-        print(f"Coin {coin_name.hex()} has not been spent")
-
-        await asyncio.sleep(3)
-
-
 async def get_unwind(
     full_node_client: FullNodeRpcClient,
-    genesis_coin_id: bytes32,
+    bag_coin_spends: BagCoinSpends,
     tail_hash_bytes: bytes32,
-    parent_puzzle_lookup: dict[str, TargetCoin],
     target_puzzle_hash: bytes32,
 ) -> list[CoinSpend]:
-    required_coin_spends: list[CoinSpend] = []
-
+    # Every coin between the target and the root is known locally so their states are looked up together
+    path: list[CoinSpend] = []
     current_puzzle_hash = target_puzzle_hash
 
     while True:
-        if current_puzzle_hash is None:
-            break
-
-        coin_spend, _ = parent_of_puzzle_hash(genesis_coin_id, current_puzzle_hash, parent_puzzle_lookup)
+        coin_spend, _ = bag_coin_spends.parent_of_puzzle_hash(current_puzzle_hash)
 
         if coin_spend is None:
             break
 
-        response = await full_node_client.get_coin_record_by_name(coin_spend.coin.name())
+        path.append(coin_spend)
+        current_puzzle_hash = coin_spend.coin.puzzle_hash
+
+    states, _ = await coin_states(full_node_client, [coin_spend.coin.name() for coin_spend in path])
+    required_coin_spends: list[CoinSpend] = []
+
+    for coin_spend in path:
+        state = states[coin_spend.coin.name()]
 
-        if response is None:
+        if state == NodeState.NONEXISTENT:
             # Coin doesn't exist yet so we add to list of required spends and check the parent
             required_coin_spends.append(coin_spend)
-            current_puzzle_hash = coin_spend.coin.puzzle_hash
             continue
 
-        if response.spent_block_index == 0:
+        if state == NodeState.UNSPENT:
             # We have reached the lowest unspent coin
             required_coin_spends.append(coin_spend)
         else:
@@ -153,53 +91,99 @@ async def get_unwind(
     return required_coin_spends
 
 
-async def unwind_coin_spend(
-    full_node_client: FullNodeRpcClient, tail_hash_bytes: bytes32, coin_spend: CoinSpend
-) -> WalletSpendBundle:
-    # Wait for unspent coin to exist before trying to spend it
-    await wait_for_unspent_coin(full_node_client, coin_spend.coin.name())
+async def push_unwind_bundle(
+    wallet_client: WalletRpcClient,
+    wallet_id: int,
+    unwind_fee: int,
+    cat_spends: list[CoinSpend],
+    fee_coin: Coin | None = None,
+    change_puzzle_hash: bytes32 | None = None,
+) -> bytes32:
+    """
+    Pushes unwind spends with a fee of unwind_fee for each spend, returning the id of the spend bundle.
 
-    curried_args = match_cat_puzzle(uncurry_puzzle(coin_spend.puzzle_reveal))
+    The fee is paid from fee_coin when one is passed, with change sent to change_puzzle_hash, otherwise the wallet
+    selects the coins and the change goes to a wallet address.
+    """
+    if unwind_fee <= 0:
+        spend_bundle = WalletSpendBundle(cat_spends, NULL_SIGNATURE)
+        await wallet_client.push_tx(PushTX(spend_bundle=spend_bundle))
+        return spend_bundle.name()
+
+    spend_bundle_fee = len(cat_spends) * unwind_fee
+
+    if fee_coin is None:
+        fee_coins_response = await wallet_client.select_coins(
+            request=SelectCoins.from_coin_selection_config(
+                amount=uint64(spend_bundle_fee),
+                wallet_id=uint32(wallet_id),
+                coin_selection_config=DEFAULT_COIN_SELECTION_CONFIG,
+            )
+        )
+        fee_coins = fee_coins_response.coins
+    else:
+        fee_coins = [fee_coin]
 
-    if curried_args is None:
-        raise Exception("Expected CAT")
+    change_amount = sum([c.amount for c in fee_coins]) - spend_bundle_fee
+    if change_amount < 0:
+        raise Exception(f"Fee coins of {change_amount + spend_bundle_fee} can't pay a fee of {spend_bundle_fee}")
 
-    _, _, inner_puzzle = curried_args
+    if change_puzzle_hash is None:
+        change_address = await wallet_client.get_next_address(
+            request=GetNextAddress(wallet_id=uint32(wallet_id), new_address=False)
+        )
+        change_puzzle_hash = decode_puzzle_hash(change_address.address)
+
+    # Fees depend on announcements made by secure the bag CATs to ensure they can't be seperated
+    cat_announcements: list[AssertCoinAnnouncement] = []
+    for coin_spend in cat_spends:
+        cat_announcements.append(
+            AssertCoinAnnouncement(
+                asserted_id=coin_spend.coin.name(),
+                asserted_msg=b"$",
+            )
+        )
 
-    # Get parent coin info as required for lineage proof when spending this CAT coin
-    parent_r = await full_node_client.get_coin_record_by_name(coin_spend.coin.parent_coin_info)
-    if parent_r is None:
-        raise Exception("Parent coin does not exist")
-    parent = await full_node_client.get_puzzle_and_solution(
-        coin_spend.coin.parent_coin_info, parent_r.spent_block_index
+    # Create signed coin spends and change for fees
+    fees_tx = await wallet_client.create_signed_transactions(
+        CreateSignedTransaction(
+            additions=[Addition(amount=uint64(change_amount), puzzle_hash=change_puzzle_hash)],
+            coins=fee_coins,
+            fee=uint64(spend_bundle_fee),
+        ),
+        extra_conditions=(*cat_announcements,),
+        tx_config=DEFAULT_TX_CONFIG,
     )
-    if parent is None:
-        raise Exception("Parent coin does not exist")
+    if fees_tx.signed_tx.spend_bundle is None:
+        raise Exception("No spend bundle created")
 
-    parent_curried_args = match_cat_puzzle(uncurry_puzzle(parent.puzzle_reveal))
+    spend_bundle = WalletSpendBundle(
+        cat_spends + fees_tx.signed_tx.spend_bundle.coin_spends,
+        fees_tx.signed_tx.spend_bundle.aggregated_signature,
+    )
+    await wallet_client.push_tx(PushTX(spend_bundle=spend_bundle))
 
-    if parent_curried_args is None:
-        raise Exception("Expected parent to be CAT")
+    return spend_bundle.name()
 
-    _, _, parent_inner_puzzle = parent_curried_args
 
-    spendable_cat = SpendableCAT(
-        coin_spend.coin,
-        tail_hash_bytes,
-        inner_puzzle,
-        Program.to([]),
-        lineage_proof=LineageProof(
-            parent_r.coin.parent_coin_info,
-            parent_inner_puzzle.get_tree_hash(),
-            uint64(parent.coin.amount),
-        ),
-    )
-    cat_spend = unsigned_spend_bundle_for_spendable_cats(CAT_MOD, [spendable_cat])
+async def push_fee_pool_bundle(
+    wallet_client: WalletRpcClient,
+    wallet_id: int,
+    cat_spends: list[CoinSpend],
+    fee_coin: Coin,
+    change_coin: Coin,
+) -> bytes32:
+    """
+    Pushes unwind spends paying their fee from a fee pool coin, so the bundle creates exactly change_coin as change.
+
+    The fee is whatever fee_coin holds beyond the change, shared evenly between the spends.
+    """
+    unwind_fee, remainder = divmod(fee_coin.amount - change_coin.amount, len(cat_spends))
 
-    # Throw an error before pushing to full node if spend is invalid
-    _ = run_with_cost(cat_spend.coin_spends[0].puzzle_reveal, 0, cat_spend.coin_spends[0].solution)
+    if change_coin.parent_coin_info != fee_coin.name() or unwind_fee < 0 or remainder != 0:
+        raise Exception(f"Change coin {change_coin.name()} can't be left by {len(cat_spends)} spends paying fees")
 
-    return cat_spend
+    return await push_unwind_bundle(wallet_client, wallet_id, unwind_fee, cat_spends, fee_coin, change_coin.puzzle_hash)
 
 
 async def unwind_the_bag(
@@ -207,20 +191,16 @@ async def unwind_the_bag(
     wallet_client: WalletRpcClient,
     unwind_target_puzzle_hash_bytes: bytes32,
     tail_hash_bytes: bytes32,
-    genesis_coin_id: bytes32,
-    parent_puzzle_lookup: dict[str, TargetCoin],
+    bag_coin_spends: BagCoinSpends,
 ) -> list[CoinSpend]:
-    current_puzzle_hash = construct_cat_puzzle(
-        CAT_MOD, tail_hash_bytes, Program.to(unwind_target_puzzle_hash_bytes)
-    ).get_tree_hash_precalc(unwind_target_puzzle_hash_bytes)
+    current_puzzle_hash = CATOuterPuzzleHasher(tail_hash_bytes).outer_puzzle_hash(unwind_target_puzzle_hash_bytes)
 
     print(f"Getting unwind for {current_puzzle_hash}")
 
     required_coin_spends: list[CoinSpend] = await get_unwind(
         full_node_client,
-        genesis_coin_id,
+        bag_coin_spends,
         tail_hash_bytes,
-        parent_puzzle_lookup,
         current_puzzle_hash,
     )
 
@@ -232,14 +212,23 @@ async def unwind_the_bag(
 async def app(
     chia_config: dict[str, Any],
     chia_root: Path,
-    secure_the_bag_targets_path: str,
-    leaf_width: int,
+    secure_the_bag_targets_path: str | None,
+    merge_duplicates: bool,
+    manifest_path: str | None,
+    proof_path: str | None,
+    widths: list[int],
     tail_hash_bytes: bytes32,
     unwind_target_puzzle_hash_bytes: bytes32 | None,
     genesis_coin_id: bytes32,
     fingerprint: int,
     wallet_id: int,
     unwind_fee: int,
+    progress: BagProgress | None = None,
+    bundle_window: int = BUNDLE_WINDOW,
+    bundle_levels: int = 1,
+    bundle_cost_fraction: float = BUNDLE_COST_FRACTION,
+    workers: int = 1,
+    journal_path: str | None = None,
 ) -> None:
     full_node_client = await FullNodeRpcClient.create(
         chia_config["self_hostname"],
@@ -257,8 +246,34 @@ async def app(
         print(f"Setting fingerprint: {fingerprint}")
         await wallet_client.log_in(LogIn(fingerprint=uint32(fingerprint)))
 
-    targets = read_secure_the_bag_targets(secure_the_bag_targets_path, None)
-    _, parent_puzzle_lookup = secure_the_bag(targets, leaf_width, tail_hash_bytes)
+    # Every wait for a coin to be created or spent shares one poller
+    coin_watcher = CoinWatcher(full_node_client)
+
+    manifest: BagManifest | None = None
+    parent_puzzle_lookup: Mapping[bytes32, TargetCoin]
+
+    if manifest_path is not None:
+        # The manifest already holds the whole tree so nothing needs to be rehashed
+        manifest = BagManifest.open(manifest_path)
+
+        if manifest.asset_id != tail_hash_bytes:
+            raise Exception(f"Manifest {manifest_path} was not secured with asset id {tail_hash_bytes}")
+
+        parent_puzzle_lookup = manifest
+    elif secure_the_bag_targets_path is not None:
+        with open_secure_the_bag_targets(secure_the_bag_targets_path, None, merge_duplicates) as targets:
+            _, parent_puzzle_lookup = secure_the_bag(targets, widths, tail_hash_bytes, progress=progress)
+    elif proof_path is not None and unwind_target_puzzle_hash_bytes is not None:
+        # Only the coins between the target and the root are needed to unwind a single target
+        parent_puzzle_lookup = load_unwind_proof(proof_path, unwind_target_puzzle_hash_bytes, tail_hash_bytes)
+    else:
+        raise Exception("Either a secure the bag targets path, a manifest path or a proof path is required")
+
+    # Shared by every unwind so coins near the root are only hashed once
+    bag_coin_spends = BagCoinSpends(genesis_coin_id, parent_puzzle_lookup)
+    # Lineage proofs come from the bag rather than a lookup of each parent
+    bag_lineage = BagLineage(full_node_client, coin_watcher, bag_coin_spends)
+    spend_builder = UnwindSpendBuilder(tail_hash_bytes, bag_lineage, workers)
 
     if unwind_target_puzzle_hash_bytes is not None:
         # Unwinding to a single target has to be done sequentially as each spend is dependant on the parent being spent
@@ -269,211 +284,164 @@ async def app(
             wallet_client,
             unwind_target_puzzle_hash_bytes,
             tail_hash_bytes,
-            genesis_coin_id,
-            parent_puzzle_lookup,
+            bag_coin_spends,
         )
 
         for coin_spend in coin_spends:
-            cat_spend = await unwind_coin_spend(full_node_client, tail_hash_bytes, coin_spend)
+            cat_spends = await spend_builder.build([coin_spend], MAX_SPEND_BUNDLE_COST)
             await get_wallet(
                 root_path=chia_root,
                 wallet_client=wallet_client,
                 fingerprint=fingerprint,
             )
-
-            if unwind_fee > 0:
-                fee_coins_response = await wallet_client.select_coins(
-                    request=SelectCoins.from_coin_selection_config(
-                        amount=uint64(unwind_fee),
-                        wallet_id=uint32(wallet_id),
-                        coin_selection_config=DEFAULT_COIN_SELECTION_CONFIG,
-                    )
-                )
-
-                fee_coins = fee_coins_response.coins
-                change_amount = sum([c.amount for c in fee_coins]) - unwind_fee
-                change_address = await wallet_client.get_next_address(
-                    request=GetNextAddress(wallet_id=uint32(wallet_id), new_address=False)
-                )
-                change_ph = decode_puzzle_hash(change_address.address)
-
-                # Fees depend on announcements made by secure the bag CATs to ensure they can't be seperated
-                cat_announcements: list[AssertAnnouncement] = []
-                for coin_spend in cat_spend.coin_spends:
-                    cat_announcements.append(
-                        AssertAnnouncement(
-                            coin_not_puzzle=True,
-                            asserted_origin_id=coin_spend.coin.name(),
-                            asserted_msg=b"$",
-                        )
-                    )
-
-                # Create signed coin spends and change for fees
-                fees_tx = await wallet_client.create_signed_transactions(
-                    CreateSignedTransaction(
-                        additions=[Addition(amount=uint64(change_amount), puzzle_hash=change_ph)],
-                        coins=fee_coins,
-                        fee=uint64(unwind_fee),
-                    ),
-                    extra_conditions=(*cat_announcements,),
-                    tx_config=DEFAULT_TX_CONFIG,
-                )
-
-                if fees_tx.signed_tx.spend_bundle is None:
-                    raise Exception("No spend bundle created")
-
-                await wallet_client.push_tx(
-                    PushTX(
-                        spend_bundle=WalletSpendBundle(
-                            cat_spend.coin_spends + fees_tx.signed_tx.spend_bundle.coin_spends,
-                            fees_tx.signed_tx.spend_bundle.aggregated_signature,
-                        )
-                    )
-                )
-            else:
-                await wallet_client.push_tx(
-                    PushTX(spend_bundle=WalletSpendBundle(cat_spend.coin_spends, cat_spend.aggregated_signature))
-                )
+            await push_unwind_bundle(wallet_client, wallet_id, unwind_fee, cat_spends)
 
             print("Transaction pushed to full node")
 
             # Wait for parent coin to be spent before attempting to spend children
-            await wait_for_coin_spend(full_node_client, coin_spend.coin.name())
+            print(f"Waiting for coin spend {coin_spend.coin.name().hex()}")
+            await coin_watcher.wait_for_spend(coin_spend.coin.name())
     else:
         # Unwinding the entire secured bag can involve batching spends together for speed
         # Care must be taken to only batch together spends where the parent has been spent
         # otherwise one invalid spend could invalidate the entire spend bundle
         print("Unwinding entire secured bag")
 
-        batched_targets = batch_the_bag(targets, leaf_width)
+        coin_spends_by_depth = bag_coin_spends.coin_spends_by_depth()
+        journal = None if journal_path is None else UnwindJournal.open(journal_path, genesis_coin_id, tail_hash_bytes)
+        # Bundles an interrupted unwind left waiting to be confirmed, and their spends
+        resumed: list[tuple[JournalBundle, list[CoinSpend]]] = []
+
+        if journal is not None and journal.started:
+            # Everything the journal recorded is known without going back to the chain
+            frontier, resumed = journal.resume(coin_spends_by_depth)
+            print(f"Resuming from journal {journal_path} with {len(resumed)} bundles waiting to be confirmed")
+        else:
+            # Spends grouped into rounds so each round only spends coins created by the round before it. A single
+            # pass from the root finds where a partially unwound bag got to.
+            frontier = await scan_frontier(full_node_client, coin_spends_by_depth)
+
+            print(
+                f"Scanned the bag in {frontier.queries} lookups: {frontier.count(NodeState.SPENT)} coins spent, "
+                f"{frontier.count(NodeState.UNSPENT)} unspent and {frontier.count(NodeState.NONEXISTENT)} not yet "
+                "created"
+            )
 
-        # Dictionary of spends at each level of the tree so they can be batched
-        # based on parents that have already been spent
-        level_coin_spends: dict[int, dict[str, CoinSpend]] = defaultdict(dict)
-        max_depth = 0
-        total_spends = 0
+            if journal is not None:
+                journal.start(frontier)
 
-        # Unwind to the first target coin in each batch
-        for batch_targets in batched_targets:
-            unwound_spends = await unwind_the_bag(
-                full_node_client,
+        total_spends = frontier.remaining_spends()
+        total_fees = total_spends * unwind_fee
+        print(f"{total_spends} total spends required with {total_fees} fees")
+
+        # Children are spent as soon as their own parent is confirmed, with several bundles waiting at once. Bundles
+        # are filled up to a cost rather than a number of spends.
+        scheduler = UnwindScheduler(
+            frontier,
+            bundle_window,
+            max_bundle_cost(bundle_cost_fraction),
+            bundle_levels,
+            fee_spend_cost=fee_spend_cost if unwind_fee > 0 else None,
+        )
+        # Bundles in flight at once each pay their fee from their own coin, split off before unwinding starts
+        fee_pool = journal.fee_pool(coin_watcher) if journal is not None and unwind_fee > 0 else None
+
+        if unwind_fee > 0 and fee_pool is None:
+            fee_coin_count = max(1, min(bundle_window, total_spends))
+            # No bundle holds more spends than fit at the cost of the narrowest spend
+            max_bundle_fee = unwind_fee * min(total_spends, scheduler.max_bundle_cost // unwind_spend_cost(1))
+            fee_coins = await split_fee_coins(
                 wallet_client,
-                batch_targets[0].puzzle_hash,
-                tail_hash_bytes,
-                genesis_coin_id,
-                parent_puzzle_lookup,
+                wallet_id,
+                coin_watcher,
+                fee_coin_count,
+                fee_coin_amount(total_fees, fee_coin_count, max_bundle_fee),
+                unwind_fee,
             )
-            total_spends += len(unwound_spends)
+            fee_pool = FeeCoinPool(coin_watcher, fee_coins[0].puzzle_hash, fee_coins)
 
-            print(f"{len(unwound_spends)} spends to {batch_targets[0].puzzle_hash}")
+            if journal is not None:
+                journal.fee_coins_split(fee_coins)
 
-            for index, coin_spend in enumerate(unwound_spends):
-                level_coin_spends[index][coin_spend.coin.puzzle_hash.hex()] = coin_spend
-                max_depth = max(index, max_depth)
+        spend_builder.build_ahead(list(scheduler.ready))
+        # First coin spent by a bundle -> its id in the journal
+        journal_bundle_ids: dict[bytes32, int] = {}
 
-        total_fees = total_spends * unwind_fee
+        async def push_spends(bundle: list[CoinSpend], fee_coin: Coin | None, change_coin: Coin | None) -> bytes32:
+            bundle_spends = await spend_builder.build(bundle, scheduler.max_bundle_cost)
 
-        print(f"{total_spends} total spends required with {total_fees} fees")
+            await get_wallet(
+                root_path=chia_root,
+                wallet_client=wallet_client,
+                fingerprint=fingerprint,
+            )
 
-        for depth in range(0, max_depth + 1):
-            level = level_coin_spends[depth]
+            if fee_coin is None or change_coin is None:
+                spend_bundle_id = await push_unwind_bundle(wallet_client, wallet_id, 0, bundle_spends)
+            else:
+                spend_bundle_id = await push_fee_pool_bundle(
+                    wallet_client, wallet_id, bundle_spends, fee_coin, change_coin
+                )
 
-            # Larger batch_size e.g. 25 can result in COST_EXCEEDS_MAX
-            batch_size = 10
-            spent_coin_names: list[bytes32] = []
-            bundle_spends: list[CoinSpend] = []
+            print(f"Transaction containing {len(bundle_spends)} coin spends pushed to full node")
 
-            print(f"About to iterate {len(level.values())} times for depth {depth}")
+            # The next level is built while this bundle waits to be confirmed
+            spend_builder.build_ahead(scheduler.created_by(bundle))
 
-            i = 0
-            for coin_spend in level.values():
-                i += 1
-                cat_spend = await unwind_coin_spend(full_node_client, tail_hash_bytes, coin_spend)
-                await get_wallet(
-                    root_path=chia_root,
-                    wallet_client=wallet_client,
-                    fingerprint=fingerprint,
-                )
+            return spend_bundle_id
+
+        async def push_bundle(bundle: list[CoinSpend]) -> None:
+            fee_coin: Coin | None = None
+            change_coin: Coin | None = None
+            if fee_pool is not None:
+                bundle_fee = len(bundle) * unwind_fee
+                fee_coin = await fee_pool.take(bundle_fee)
+                change_coin = fee_pool.change_coin(fee_coin, bundle_fee)
+
+            # Recorded before it is pushed so the fee coin is never lost track of
+            journal_bundle_id = None if journal is None else journal.bundle_planned(bundle, fee_coin, change_coin)
+
+            spend_bundle_id = await push_spends(bundle, fee_coin, change_coin)
+
+            if journal is not None and journal_bundle_id is not None:
+                journal_bundle_ids[bundle[0].coin.name()] = journal_bundle_id
+                journal.bundle_pushed(journal_bundle_id, spend_bundle_id)
+            if fee_pool is not None and change_coin is not None:
+                fee_pool.add_pending(change_coin)
+
+        def bundle_confirmed(bundle: list[CoinSpend]) -> None:
+            if journal is not None:
+                journal.bundle_confirmed(journal_bundle_ids.pop(bundle[0].coin.name()), coin_watcher.peak_height)
 
-                bundle_spends += cat_spend.coin_spends
-                spent_coin_names.append(coin_spend.coin.name())
-
-                if len(bundle_spends) >= batch_size or i == len(level.values()):
-                    if unwind_fee > 0:
-                        spend_bundle_fee = len(bundle_spends) * unwind_fee
-
-                        fee_coins_response = await wallet_client.select_coins(
-                            request=SelectCoins.from_coin_selection_config(
-                                amount=uint64(spend_bundle_fee),
-                                wallet_id=uint32(wallet_id),
-                                coin_selection_config=DEFAULT_COIN_SELECTION_CONFIG,
-                            )
-                        )
-                        fee_coins = fee_coins_response.coins
-                        change_amount = sum([c.amount for c in fee_coins]) - spend_bundle_fee
-                        change_address = await wallet_client.get_next_address(
-                            request=GetNextAddress(wallet_id=uint32(wallet_id), new_address=False)
-                        )
-                        change_ph = decode_puzzle_hash(change_address.address)
-
-                        # Fees depend on announcements made by secure the bag CATs to ensure they can't be seperated
-                        cat_announcements = []
-                        for coin_spend in bundle_spends:
-                            cat_announcements.append(
-                                AssertAnnouncement(
-                                    coin_not_puzzle=True,
-                                    asserted_origin_id=coin_spend.coin.name(),
-                                    asserted_msg=b"$",
-                                )
-                            )
-
-                        # Create signed coin spends and change for fees
-                        fees_tx = await wallet_client.create_signed_transactions(
-                            CreateSignedTransaction(
-                                additions=[Addition(amount=uint64(change_amount), puzzle_hash=change_ph)],
-                                coins=fee_coins,
-                                fee=uint64(spend_bundle_fee),
-                            ),
-                            extra_conditions=(*cat_announcements,),
-                            tx_config=DEFAULT_TX_CONFIG,
-                        )
-                        if fees_tx.signed_tx.spend_bundle is None:
-                            raise Exception("No spend bundle created")
-
-                        await wallet_client.push_tx(
-                            PushTX(
-                                spend_bundle=WalletSpendBundle(
-                                    bundle_spends + fees_tx.signed_tx.spend_bundle.coin_spends,
-                                    fees_tx.signed_tx.spend_bundle.aggregated_signature,
-                                )
-                            )
-                        )
-                    else:
-                        await wallet_client.push_tx(
-                            PushTX(spend_bundle=WalletSpendBundle(bundle_spends, cat_spend.aggregated_signature))
-                        )
-
-                    print(
-                        f"Transaction containing {len(bundle_spends)} coin spends "
-                        f"at tree depth {depth} pushed to full node"
-                    )
-
-                    bundle_spends = []
-
-                    # Wait for this batch to be spent before attempting next spends
-                    # Important for spending children of coins we just created
-                    coin_spend_waits: list[Coroutine[Any, Any, None]] = []
-
-                    for coin_name in spent_coin_names:
-                        coin_spend_waits.append(wait_for_coin_spend(full_node_client, coin_name))
-
-                    await asyncio.gather(*coin_spend_waits)
-
-                    spent_coin_names = []
+        # Bundles that were in flight are pushed again unless they confirmed while the unwind was stopped. The same
+        # spends and fee coin make the same bundle, so one still in the mempool isn't replaced.
+        if journal is not None and len(resumed) > 0:
+            states, _ = await coin_states(full_node_client, [bundle[0].coin.name() for _, bundle in resumed])
 
+            for journal_bundle, bundle in resumed:
+                journal_bundle_ids[bundle[0].coin.name()] = journal_bundle.bundle_id
+
+                if states[bundle[0].coin.name()] != NodeState.SPENT:
+                    spend_bundle_id = await push_spends(bundle, journal_bundle.fee_coin, journal_bundle.change_coin)
+                    journal.bundle_pushed(journal_bundle.bundle_id, spend_bundle_id)
+
+        await scheduler.run(
+            push_bundle, coin_watcher.wait_for_spend, bundle_confirmed, [bundle for _, bundle in resumed]
+        )
+
+        print(f"Unwound the bag in {scheduler.bundles_pushed} spend bundles")
+
+        if journal is not None:
+            journal.close()
+
+    spend_builder.close()
+    await coin_watcher.close()
     full_node_client.close()
     wallet_client.close()
 
+    if manifest is not None:
+        manifest.close()
+
 
 @click.command()
 @click.pass_context
@@ -492,8 +460,27 @@ async def app(
 @click.option(
     "-stbtp",
     "--secure-the-bag-targets-path",
-    required=True,
-    help="Path to CSV file containing targets of secure the bag (inner puzzle hash + amount)",
+    required=False,
+    help="Path to CSV or binary file containing targets of secure the bag (inner puzzle hash + amount)",
+)
+@click.option(
+    "-md",
+    "--merge-duplicates",
+    is_flag=True,
+    default=False,
+    help="Combine the amounts of targets that share a puzzle hash, as when the bag was secured",
+)
+@click.option(
+    "-mp",
+    "--manifest-path",
+    required=False,
+    help="Path to a manifest written by secure_the_bag, used instead of rebuilding the bag from the targets CSV",
+)
+@click.option(
+    "-pp",
+    "--proof-path",
+    required=False,
+    help="Path to an unwind proof shard or directory of shards exported by secure_the_bag, used to unwind one target",
 )
 @click.option(
     "-utph",
@@ -526,23 +513,109 @@ async def app(
     "-lw",
     "--leaf-width",
     required=True,
-    default=100,
+    default="100",
+    show_default=True,
+    help="Secure the bag leaf width, or comma separated widths for each level from the leaves up",
+)
+@click.option(
+    "-bw",
+    "--bundle-window",
+    type=int,
+    default=BUNDLE_WINDOW,
+    show_default=True,
+    help="Number of spend bundles that can be waiting to be confirmed at once when unwinding the entire bag. "
+    "Each fee paying bundle needs its own wallet coins.",
+)
+@click.option(
+    "-bl",
+    "--bundle-levels",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of bag levels each spend bundle can span when unwinding the entire bag. Coins created by a spend "
+    "in the bundle are spent in the same block.",
+)
+@click.option(
+    "-bcf",
+    "--bundle-cost-fraction",
+    type=float,
+    default=BUNDLE_COST_FRACTION,
     show_default=True,
-    help="Secure the bag leaf width",
+    help="Fraction of the maximum block cost each spend bundle can use when unwinding the entire bag, including the "
+    "fee spend. Never more than the mempool accepts.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of processes used to build and validate unwind spends ahead of the bundles that need them",
+)
+@click.option(
+    "-jp",
+    "--journal-path",
+    help="Optional path of a SQLite journal of the bundles pushed when unwinding the entire bag. An interrupted unwind "
+    "run again with the same journal carries on from the next unfinished bundle without scanning the bag.",
+)
+@click.option(
+    "-pg",
+    "--progress",
+    is_flag=True,
+    default=False,
+    help="Show a progress bar while the bag is rebuilt from its targets",
+)
+@click.option(
+    "-mtp",
+    "--metrics-path",
+    help="Optional path of a JSON lines file to append timings and memory use of rebuilding the bag to",
 )
 def cli(
     ctx: click.Context,
     eve_coin_id: str,
     tail_hash: str,
-    secure_the_bag_targets_path: str,
+    secure_the_bag_targets_path: str | None,
+    merge_duplicates: bool,
+    manifest_path: str | None,
+    proof_path: str | None,
     unwind_target_puzzle_hash: str,
     fingerprint: int,
     wallet_id: int,
     unwind_fee: int,
-    leaf_width: int,
+    leaf_width: str,
+    bundle_window: int,
+    bundle_levels: int,
+    bundle_cost_fraction: float,
+    workers: int,
+    journal_path: str | None,
+    progress: bool,
+    metrics_path: str | None,
 ) -> None:
     ctx.ensure_object(dict)
 
+    if [secure_the_bag_targets_path, manifest_path, proof_path].count(None) != 2:
+        raise click.UsageError(
+            "Must specify exactly one of --secure-the-bag-targets-path, --manifest-path or --proof-path"
+        )
+
+    if bundle_window < 1:
+        raise click.UsageError("--bundle-window must be at least 1")
+
+    if bundle_levels < 1:
+        raise click.UsageError("--bundle-levels must be at least 1")
+
+    if not 0 < bundle_cost_fraction <= 1:
+        raise click.UsageError("--bundle-cost-fraction must be greater than 0 and at most 1")
+
+    if workers < 1:
+        raise click.UsageError("--workers must be at least 1")
+
+    if journal_path is not None and unwind_target_puzzle_hash:
+        raise click.UsageError("--journal-path can only be used when unwinding the entire bag")
+
+    if proof_path is not None and not unwind_target_puzzle_hash:
+        raise click.UsageError("Must specify --unwind-target-puzzle-hash when unwinding from a proof")
+
     eve_coin_id_bytes = bytes32.fromhex(eve_coin_id)
     tail_hash_bytes = bytes32.fromhex(tail_hash)
     unwind_target_puzzle_hash_bytes = None
@@ -557,13 +630,22 @@ def cli(
             chia_config,
             chia_root,
             secure_the_bag_targets_path,
-            leaf_width,
+            merge_duplicates,
+            manifest_path,
+            proof_path,
+            parse_level_widths(leaf_width),
             tail_hash_bytes,
             unwind_target_puzzle_hash_bytes,
             eve_coin_id_bytes,
             fingerprint,
             wallet_id,
             unwind_fee,
+            progress_from_options(progress, metrics_path),
+            bundle_window,
+            bundle_levels,
+            bundle_cost_fraction,
+            workers,
+            journal_path,
         )
     )
 
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint64
+
+import cats.secure_the_bag
+from cats.bag_cache import BagCache
+from cats.secure_the_bag import CATOuterPuzzleHasher, Target, secure_batch, secure_the_bag
+from tests.cats.util import ASSET_ID, make_targets
+
+
+def secure_with_cache(
+    cache_path: Path, targets: list[Target], asset_id: bytes32 | None, workers: int
+) -> tuple[bytes32, BagCache]:
+    cache = BagCache.open(cache_path, asset_id)
+    root, parent_puzzle_lookup = secure_the_bag(targets, 3, asset_id, workers=workers, cache=cache)
+    cache.close()
+
+    expected_root, expected_parent_puzzle_lookup = secure_the_bag(targets, 3, asset_id)
+    assert root == expected_root
+    assert list(parent_puzzle_lookup) == list(expected_parent_puzzle_lookup)
+
+    for key, target_coin in parent_puzzle_lookup.items():
+        assert target_coin.puzzle == expected_parent_puzzle_lookup[key].puzzle
+
+    return root, cache
+
+
+@pytest.mark.parametrize("asset_id", [None, ASSET_ID])
+@pytest.mark.parametrize("workers", [1, 2])
+def test_bag_cache(tmp_path: Path, asset_id: bytes32 | None, workers: int) -> None:
+    targets = make_targets(27)
+    cache_path = tmp_path / "bag_cache.sqlite"
+
+    # The 9 batches creating the targets, the 3 batches above those, the batch creating them and the root
+    root, cache = secure_with_cache(cache_path, targets, asset_id, workers)
+    assert (cache.hits, cache.misses) == (0, 14)
+
+    # Editing one target only secures its batch and the batches above it again
+    edited_targets = list(targets)
+    edited_targets[4] = Target(targets[4].puzzle_hash, uint64(100))
+    _, cache = secure_with_cache(cache_path, edited_targets, asset_id, workers)
+    assert (cache.hits, cache.misses) == (10, 4)
+
+    # Appending a target reuses every full batch before it
+    _, cache = secure_with_cache(cache_path, [*targets, Target(bytes32(b"\x01" * 32), uint64(5))], asset_id, workers)
+    assert (cache.hits, cache.misses) == (9 + 3 + 1, 1 + 1 + 1 + 1 + 1)
+
+    # Inserting a target shifts every batch after it in its level, so none of them are found
+    _, cache = secure_with_cache(cache_path, [Target(bytes32(b"\x01" * 32), uint64(5)), *targets], asset_id, workers)
+    assert (cache.hits, cache.misses) == (0, 10 + 4 + 2 + 1 + 1)
+
+    # Back to the original targets without securing anything
+    restored_root, cache = secure_with_cache(cache_path, targets, asset_id, workers)
+    assert restored_root == root
+    assert (cache.hits, cache.misses) == (14, 0)
+
+
+def test_bag_cache_skips_unchanged_batches(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    targets = make_targets(27)
+    cache_path = tmp_path / "bag_cache.sqlite"
+    secure_with_cache(cache_path, targets, ASSET_ID, 1)
+
+    secured_batches: list[list[Target]] = []
+
+    def recording_secure_batch(
+        batch_targets: list[Target], cat_hasher: CATOuterPuzzleHasher | None
+    ) -> tuple[bytes32, list[bytes32]]:
+        secured_batches.append(batch_targets)
+        return secure_batch(batch_targets, cat_hasher)
+
+    monkeypatch.setattr(cats.secure_the_bag, "secure_batch", recording_secure_batch)
+
+    edited_targets = list(targets)
+    edited_targets[4] = Target(targets[4].puzzle_hash, uint64(100))
+    cache = BagCache.open(cache_path, ASSET_ID)
+    secure_the_bag(edited_targets, 3, ASSET_ID, cache=cache)
+    cache.close()
+
+    # Only the batch holding the edited target and the path above it up to the root are hashed again
+    assert [target.amount for target in secured_batches[0]] == [4, 100, 6]
+    assert [len(batch_targets) for batch_targets in secured_batches] == [3, 3, 3, 1]
+
+
+def test_bag_cache_prune(tmp_path: Path) -> None:
+    targets = make_targets(27)
+    cache_path = tmp_path / "bag_cache.sqlite"
+    secure_with_cache(cache_path, targets, None, 1)
+
+    # Removing the first target shifts every batch, so pruning drops all of the original ones
+    cache = BagCache.open(cache_path, None)
+    secure_the_bag(targets[1:], 3, cache=cache)
+    assert cache.prune() == 9 + 3 + 1 + 1
+    cache.close()
+
+    _, cache = secure_with_cache(cache_path, targets[1:], None, 1)
+    assert (cache.hits, cache.misses) == (9 + 3 + 1 + 1, 0)
+
+
+def test_bag_cache_asset_id_mismatch(tmp_path: Path) -> None:
+    cache_path = tmp_path / "bag_cache.sqlite"
+    BagCache.open(cache_path, None).close()
+
+    with pytest.raises(Exception, match="was built for asset id"):
+        BagCache.open(cache_path, ASSET_ID)
+
+    targets = make_targets(3)
+
+    with pytest.raises(Exception, match="Bag cache asset id does not match"):
+        secure_the_bag(targets, 3, ASSET_ID, cache=BagCache.open(cache_path, None))
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any
+
+import pytest
+from chia.types.blockchain_format.program import Program
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint64
+from click.testing import CliRunner
+from clvm_tools.binutils import assemble
+
+import cats.secure_the_bag
+from cats.bag_manifest import BagManifest, ManifestVerifier
+from cats.secure_the_bag import BagCoinSpends, Target, batch_puzzle, cli, secure_the_bag
+from tests.cats.util import ASSET_ID, GENESIS_COIN_NAME, make_targets
+
+
+@pytest.mark.parametrize("leaf_width", [[3], [3, 2]])
+@pytest.mark.parametrize("asset_id", [None, ASSET_ID])
+def test_bag_manifest(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, asset_id: bytes32 | None, leaf_width: list[int]
+) -> None:
+    targets = make_targets(50)
+    manifest_path = tmp_path / "bag.sqlite"
+
+    manifest = BagManifest.create(manifest_path, leaf_width, asset_id)
+    root_hash, parent_puzzle_lookup = secure_the_bag(targets, leaf_width, asset_id, manifest=manifest)
+    manifest.close()
+
+    manifest = BagManifest.open(manifest_path)
+
+    assert manifest.level_widths == leaf_width
+    assert manifest.asset_id == asset_id
+    assert manifest.root().puzzle_hash == root_hash
+    assert manifest.root().amount == sum(target.amount for target in targets)
+
+    # Manifest rebuilds the same parent puzzle lookup
+    assert len(manifest) == len(parent_puzzle_lookup)
+    assert set(manifest) == set(parent_puzzle_lookup)
+
+    for key, target_coin in parent_puzzle_lookup.items():
+        manifest_target_coin = manifest[key]
+        assert manifest_target_coin.puzzle == target_coin.puzzle
+        assert manifest_target_coin.puzzle_hash == target_coin.puzzle_hash
+        assert manifest_target_coin.amount == target_coin.amount
+        assert manifest_target_coin.target.puzzle_hash == target_coin.target.puzzle_hash
+        assert manifest_target_coin.target.amount == target_coin.target.amount
+
+    assert manifest.get(root_hash) is None
+
+    # Walking a fresh manifest in order rebuilds each batch puzzle once
+    built: list[Program] = []
+
+    def counting_batch_puzzle(batch_targets: list[Target]) -> Program:
+        built.append(batch_puzzle(batch_targets))
+        return built[-1]
+
+    monkeypatch.setattr("cats.bag_manifest.batch_puzzle", counting_batch_puzzle)
+    walked = BagManifest.open(manifest_path)
+    assert len(list(walked.items())) == len(parent_puzzle_lookup)
+    assert len(built) == len({target_coin.puzzle_hash for target_coin in parent_puzzle_lookup.values()})
+    walked.close()
+
+    # Unwinding from the manifest spends the same coins as unwinding from the lookup
+    assert (
+        BagCoinSpends(GENESIS_COIN_NAME, manifest).coin_spends_by_depth()
+        == BagCoinSpends(GENESIS_COIN_NAME, parent_puzzle_lookup).coin_spends_by_depth()
+    )
+
+    manifest.close()
+
+
+def test_bag_manifest_asset_id_mismatch(tmp_path: Path) -> None:
+    targets = make_targets(5)
+    manifest = BagManifest.create(tmp_path / "bag.sqlite", 2, ASSET_ID)
+
+    with pytest.raises(Exception, match="asset id"):
+        secure_the_bag(targets, 2, None, manifest=manifest)
+
+    manifest.close()
+
+
+def test_bag_manifest_leaf_width_mismatch(tmp_path: Path) -> None:
+    targets = make_targets(5)
+    manifest = BagManifest.create(tmp_path / "bag.sqlite", [3, 2], None)
+
+    with pytest.raises(Exception, match="leaf widths"):
+        secure_the_bag(targets, 3, None, manifest=manifest)
+
+    manifest.close()
+
+
+def test_manifest_verifier(tmp_path: Path) -> None:
+    targets = make_targets(20)
+    manifest = BagManifest.create(tmp_path / "bag.sqlite", 3, ASSET_ID)
+    secure_the_bag(targets, 3, ASSET_ID, manifest=manifest)
+
+    secure_the_bag(targets, 3, ASSET_ID, progress=ManifestVerifier(manifest))
+
+    # The lowest subtree holding the edited target is reported
+    edited_targets = list(targets)
+    edited_targets[13] = Target(targets[13].puzzle_hash, uint64(100))
+
+    with pytest.raises(Exception, match=r"level 1 position 4 does not match.*level 0 position 13"):
+        secure_the_bag(edited_targets, 3, ASSET_ID, progress=ManifestVerifier(manifest))
+
+    with pytest.raises(Exception, match=r"level 1 position 6 does not match.*level 0 position 19"):
+        secure_the_bag(targets[:19], 3, ASSET_ID, progress=ManifestVerifier(manifest))
+
+    with pytest.raises(Exception, match=r"level 1 position 6 does not match.*level 0 position 20"):
+        secure_the_bag(targets + targets[:2], 3, ASSET_ID, progress=ManifestVerifier(manifest))
+
+    manifest.close()
+
+
+def test_verify(tmp_path: Path) -> None:
+    manifest_path = tmp_path / "bag.sqlite"
+    secure_args = ["-l", "(q)", "-a", "20000032100000000", "-stbtp", "./tests/cats/test.csv", "-lw", "2"]
+
+    result = CliRunner().invoke(cli, [*secure_args, "-mp", str(manifest_path)])
+    assert result.exit_code == 0
+
+    root_puzzle_hash = result.output.split("Secure the bag root puzzle hash: ")[1].split()[0]
+    root_address = result.output.split("Secure the bag root address: ")[1].split()[0]
+    tail_hash = Program.to(assemble("(q)")).get_tree_hash().hex()
+
+    verify_args = ["verify", "-stbtp", "./tests/cats/test.csv", "-a", "20000032100000000", "-th", tail_hash, "-w", "2"]
+
+    for expected in (["-r", root_puzzle_hash], ["-r", root_address], ["-mp", str(manifest_path)]):
+        result = CliRunner().invoke(cli, [*verify_args, "-lw", "2", *expected])
+        assert result.exit_code == 0, result.output
+        assert f"secure to root puzzle hash {root_puzzle_hash}" in result.output
+
+    # Checking nothing is a usage error rather than a pass
+    result = CliRunner().invoke(cli, [*verify_args, "-lw", "2"])
+    assert result.exit_code == 2
+    assert "Must specify at least one of --root or --manifest-path" in result.output
+
+    result = CliRunner().invoke(cli, [*verify_args, "-lw", "3", "-r", root_puzzle_hash])
+    assert result.exit_code == 1
+    assert "does not match" in result.output
+
+    # Malformed roots are rejected before rebuilding the bag
+    for bad_root in ("0x1234", "zz" * 32, "xch1notanaddress"):
+        result = CliRunner().invoke(cli, [*verify_args, "-lw", "2", "-r", bad_root])
+        assert result.exit_code == 2
+        assert f"Invalid value for --root: {bad_root} is not a 32 byte hex root puzzle hash" in result.output
+
+    result = CliRunner().invoke(cli, [*verify_args, "-lw", "3", "-mp", str(manifest_path)])
+    assert result.exit_code == 1
+    assert "different asset id or leaf width" in result.output
+
+    result = CliRunner().invoke(cli, [*verify_args[:4], "1", *verify_args[5:], "-lw", "2", "-r", root_puzzle_hash])
+    assert result.exit_code == 1
+    assert "exceeds expected amount of 1" in result.output
+
+
+def test_cli_only_hashes_cat_puzzles_when_needed(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    secure_args = ["-l", "(q)", "-a", "20000032100000000", "-stbtp", "./tests/cats/test.csv"]
+    asset_ids: list[bytes32 | None] = []
+
+    def recording_secure_the_bag(*args: Any, **kwargs: Any) -> Any:
+        asset_ids.append(args[2])
+        return secure_the_bag(*args, **kwargs)
+
+    monkeypatch.setattr(cats.secure_the_bag, "secure_the_bag", recording_secure_the_bag)
+
+    plain_result = CliRunner().invoke(cli, secure_args)
+    manifest_result = CliRunner().invoke(cli, [*secure_args, "-mp", str(tmp_path / "bag.sqlite")])
+    assert plain_result.exit_code == 0
+    assert manifest_result.exit_code == 0
+
+    # The root is the same CAT either way but only the manifest needs the outer puzzle hashes of the whole bag
+    assert asset_ids == [None, Program.to(assemble("(q)")).get_tree_hash()]
+    assert plain_result.output.splitlines()[-2:] == manifest_result.output.splitlines()[-2:]
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from chia.types.blockchain_format.coin import Coin
+from chia.util.hash import std_hash
+from chia_rs import CoinRecord
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint64
+from clvm.casts import int_to_bytes
+
+from cats.coin_watcher import CoinWatcher
+from tests.cats.util import PUZZLE_HASH, FullNode
+
+
+@pytest.mark.asyncio
+async def test_coin_watcher() -> None:
+    full_node = FullNode()
+    coin_watcher = CoinWatcher(full_node, poll_interval=0.01)
+    coins = [Coin(bytes32(std_hash(int_to_bytes(i))), PUZZLE_HASH, uint64(i + 1)) for i in range(50)]
+
+    for coin in coins:
+        full_node.set_coin(coin, spent=False)
+
+    spends = asyncio.gather(*(coin_watcher.wait_for_spend(coin.name()) for coin in coins))
+
+    # Coins are only looked up again once the peak changes
+    await asyncio.sleep(0.1)
+    calls = full_node.coin_record_calls
+    assert calls <= 2
+    await asyncio.sleep(0.1)
+    assert full_node.coin_record_calls == calls
+
+    full_node.height += 1
+    for coin in coins:
+        full_node.set_coin(coin, spent=True)
+
+    await asyncio.wait_for(spends, 1)
+    assert full_node.coin_record_calls == calls + 1
+
+    # Waiting for a coin to be created fails if it has already been spent
+    with pytest.raises(Exception, match="already been spent"):
+        await asyncio.wait_for(coin_watcher.wait_for_unspent(coins[0].name()), 1)
+
+    created = asyncio.ensure_future(coin_watcher.wait_for_unspent(std_hash(b"new coin")))
+    await asyncio.sleep(0.05)
+    assert not created.done()
+
+    coin = Coin(std_hash(b"new coin parent"), PUZZLE_HASH, uint64(1))
+    created = asyncio.ensure_future(coin_watcher.wait_for_unspent(coin.name()))
+    full_node.height += 1
+    full_node.set_coin(coin, spent=False)
+    await asyncio.wait_for(created, 1)
+
+    await coin_watcher.close()
+
+
+class FlakyFullNode(FullNode):
+    """
+    Full node whose coin record lookups fail a number of times before working again.
+    """
+
+    failures: int
+
+    def __init__(self, failures: int) -> None:
+        super().__init__()
+        self.failures = failures
+
+    async def get_coin_records_by_names(
+        self,
+        names: list[bytes32],
+        include_spent_coins: bool = True,
+        start_height: int | None = None,
+        end_height: int | None = None,
+    ) -> list[CoinRecord]:
+        if self.failures > 0:
+            self.failures -= 1
+            raise Exception("Connection reset")
+
+        return await super().get_coin_records_by_names(names, include_spent_coins, start_height, end_height)
+
+
+@pytest.mark.asyncio
+async def test_coin_watcher_retries_failed_polls() -> None:
+    coin = Coin(std_hash(b"parent"), PUZZLE_HASH, uint64(1))
+
+    # A transient error is retried at the next poll rather than failing the waiter
+    full_node = FlakyFullNode(failures=2)
+    full_node.set_coin(coin, spent=True)
+    coin_watcher = CoinWatcher(full_node, poll_interval=0.01, max_poll_failures=3)
+
+    await asyncio.wait_for(coin_watcher.wait_for_spend(coin.name()), 1)
+    assert full_node.failures == 0
+    await coin_watcher.close()
+
+    # Waiters only fail once the lookups keep failing
+    full_node = FlakyFullNode(failures=3)
+    full_node.set_coin(coin, spent=True)
+    coin_watcher = CoinWatcher(full_node, poll_interval=0.01, max_poll_failures=3)
+
+    with pytest.raises(Exception, match="Connection reset"):
+        await asyncio.wait_for(coin_watcher.wait_for_spend(coin.name()), 1)
+
+    assert full_node.coin_record_calls == 0
+    await coin_watcher.close()
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+from chia.consensus.default_constants import DEFAULT_CONSTANTS
+from click.testing import CliRunner
+
+from cats.fan_out import (
+    MAX_SPEND_BUNDLE_COST,
+    estimated_unwind_spend_cost,
+    fee_spend_cost,
+    max_bundle_cost,
+    max_unwind_width,
+    plan_fan_out,
+    unwind_spend_cost,
+)
+from cats.secure_the_bag import cli
+
+
+def test_unwind_spend_cost() -> None:
+    # Every coin created adds the same cost
+    assert unwind_spend_cost(2) > unwind_spend_cost(1)
+    assert estimated_unwind_spend_cost(10) == unwind_spend_cost(10)
+    assert estimated_unwind_spend_cost(100) == unwind_spend_cost(100)
+
+    width = max_unwind_width(unwind_spend_cost(50) + 1)
+    assert width == 50
+
+    assert max_unwind_width(MAX_SPEND_BUNDLE_COST, 100) == 100
+
+
+def test_plan_fan_out() -> None:
+    plan = plan_fan_out(1000, max_width=10)
+
+    assert plan.widths == [10, 10, 10]
+    assert plan.spends == [100, 10, 1]
+    assert plan.total_spends() == 111
+    assert plan.leaf_width() == "10,10,10"
+    assert plan.total_cost() == 100 * unwind_spend_cost(10) + 10 * unwind_spend_cost(10) + unwind_spend_cost(10)
+
+    block_budget = DEFAULT_CONSTANTS.MAX_BLOCK_COST_CLVM // 2
+    assert plan.blocks == [-(-spends // (block_budget // unwind_spend_cost(10))) for spends in plan.spends]
+
+    # Small bags are unwound from a single spend of the root
+    plan = plan_fan_out(500)
+
+    assert plan.widths == [500]
+    assert plan.total_blocks() == 1
+
+    # Tighter block budgets need narrower spends
+    plan = plan_fan_out(100000, max_block_cost_fraction=0.1)
+
+    assert plan.widths[0] < plan_fan_out(100000).widths[0]
+    assert max(unwind_spend_cost(width) for width in plan.widths) <= DEFAULT_CONSTANTS.MAX_BLOCK_COST_CLVM // 10
+    assert plan.spends[-1] == 1
+
+
+def test_plan_fan_out_leaves_room_for_fee() -> None:
+    # The widest spend of a large bag plus the fee spend of its bundle still fits, as the scheduler requires
+    for target_count in [1_000_000, 10_000_000]:
+        plan = plan_fan_out(target_count, reserved_cost=fee_spend_cost(1))
+
+        assert max(unwind_spend_cost(width) for width in plan.widths) + fee_spend_cost(1) <= max_bundle_cost(0.5)
+
+
+def test_plan_command() -> None:
+    result = CliRunner().invoke(cli, ["plan", "-tc", "1000", "-mw", "10"])
+    assert result.exit_code == 0, result.output
+    assert "Secure the bag with --leaf-width 10,10,10" in result.output
+
+    result = CliRunner().invoke(cli, ["plan"])
+    assert result.exit_code == 2
+    assert "Must specify exactly one of --target-count or --secure-the-bag-targets-path" in result.output
+
+    # Securing without targets fails the same way
+    result = CliRunner().invoke(cli, ["-l", "(q)"])
+    assert result.exit_code == 2
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from chia._tests.util.setup_nodes import SimulatorsAndWalletsServices
+from chia.full_node.full_node_rpc_client import FullNodeRpcClient
+from chia.types.blockchain_format.coin import Coin
+from chia.types.peer_info import PeerInfo
+from chia.util.hash import std_hash
+from chia.wallet.util.tx_config import DEFAULT_TX_CONFIG
+from chia.wallet.wallet_rpc_client import WalletRpcClient
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint16, uint64
+from clvm.casts import int_to_bytes
+
+from cats.coin_watcher import CoinWatcher
+from cats.fee_pool import FeeCoinPool, fee_coin_amount, split_fee_coins
+from cats.secure_the_bag import BagCoinSpends, secure_the_bag
+from cats.unwind_the_bag import push_fee_pool_bundle
+from tests.cats.util import PUZZLE_HASH, FullNode, make_targets
+
+
+@pytest.mark.asyncio
+async def test_fee_coin_pool() -> None:
+    full_node = FullNode()
+    coin_watcher = CoinWatcher(full_node, poll_interval=0.01)
+    coins = [Coin(bytes32(std_hash(int_to_bytes(i))), PUZZLE_HASH, uint64(100 + i)) for i in range(2)]
+    pool = FeeCoinPool(coin_watcher, PUZZLE_HASH, coins)
+
+    # The largest coin is used first
+    first = await pool.take(50)
+    assert first == coins[1]
+    second = await pool.take(50)
+    assert second == coins[0]
+
+    first_change = pool.change_coin(first, 50)
+    assert first_change.parent_coin_info == first.name() and first_change.amount == 51
+    pool.add_pending(first_change)
+    pool.add_pending(pool.change_coin(second, 100))
+    assert len(pool) == 1
+
+    # Change can only be used once the bundle that creates it is confirmed
+    taken = asyncio.ensure_future(pool.take(50))
+    await asyncio.sleep(0.05)
+    assert not taken.done()
+
+    full_node.height += 1
+    full_node.set_coin(first_change, spent=False)
+    assert await asyncio.wait_for(taken, 1) == first_change
+
+    with pytest.raises(Exception, match="No fee coin left in the pool"):
+        await pool.take(1)
+
+    await coin_watcher.close()
+
+
+def test_fee_coin_amount() -> None:
+    total_fees = 1000
+    max_bundle_fee = 30
+    amount = fee_coin_amount(total_fees, 3, max_bundle_fee)
+    remaining = [amount] * 3
+
+    # However bundles draw on them the largest coin can pay the next bundle until every fee is paid
+    paid = 0
+    while paid < total_fees:
+        fee = min(max_bundle_fee, total_fees - paid)
+        largest = remaining.index(max(remaining))
+        assert remaining[largest] >= fee
+        remaining[largest] -= fee
+        paid += fee
+
+
+@pytest.mark.asyncio
+async def test_unwind_with_fee_pool(one_wallet_and_one_simulator_services: SimulatorsAndWalletsServices) -> None:
+    full_nodes, wallets, bt = one_wallet_and_one_simulator_services
+    full_node_service = full_nodes[0]
+    full_node_api = full_node_service._api
+    wallet_service = wallets[0]
+    wallet_node = wallet_service._node
+    wallet = wallet_node.wallet_state_manager.main_wallet
+    assert full_node_service.rpc_server is not None and full_node_service.rpc_server.webserver is not None
+    assert wallet_service.rpc_server is not None and wallet_service.rpc_server.webserver is not None
+
+    wallet_node.config["trusted_peers"] = {
+        full_node_api.full_node.server.node_id.hex(): full_node_api.full_node.server.node_id.hex()
+    }
+    assert full_node_api.full_node.server._port is not None
+    await wallet_node.server.start_client(PeerInfo("127.0.0.1", uint16(full_node_api.full_node.server._port)), None)
+    await full_node_api.farm_blocks_to_wallet(count=1, wallet=wallet)
+    await full_node_api.wait_for_wallet_synced(wallet_node=wallet_node, timeout=20)
+
+    # A bag of XCH makes the same announcements the fee spends assert as a bag of CATs
+    targets = make_targets(8)
+    root_puzzle_hash, parent_puzzle_lookup = secure_the_bag(targets, 2)
+
+    async with wallet.wallet_state_manager.new_action_scope(DEFAULT_TX_CONFIG, push=True) as action_scope:
+        await wallet.generate_signed_transaction(
+            [uint64(sum(target.amount for target in targets))], [root_puzzle_hash], action_scope
+        )
+    [root_coin] = [
+        coin
+        for transaction in action_scope.side_effects.transactions
+        for coin in transaction.additions
+        if coin.puzzle_hash == root_puzzle_hash
+    ]
+    await full_node_api.process_transaction_records(action_scope.side_effects.transactions)
+    await full_node_api.wait_for_wallet_synced(wallet_node=wallet_node, timeout=20)
+
+    # Every transaction pushed from here on is farmed straight away
+    full_node_api.auto_farm = True
+    self_hostname = bt.config["self_hostname"]
+    full_node_client = await FullNodeRpcClient.create(
+        self_hostname, full_node_service.rpc_server.webserver.listen_port, bt.root_path, bt.config
+    )
+    wallet_client = await WalletRpcClient.create(
+        self_hostname, wallet_service.rpc_server.webserver.listen_port, bt.root_path, bt.config
+    )
+    coin_watcher = CoinWatcher(full_node_client, poll_interval=0.1)
+
+    unwind_fee = 7
+    fee_coins = await split_fee_coins(wallet_client, 1, coin_watcher, 2, 1000, 5)
+    assert sorted(coin.amount for coin in fee_coins) == [1000, 1001]
+    assert len({coin.puzzle_hash for coin in fee_coins}) == 1
+
+    pool = FeeCoinPool(coin_watcher, fee_coins[0].puzzle_hash, fee_coins)
+    change_coins: list[Coin] = []
+
+    for coin_spends in BagCoinSpends(root_coin.parent_coin_info, parent_puzzle_lookup).coin_spends_by_depth():
+        fee_coin = await pool.take(len(coin_spends) * unwind_fee)
+        change_coin = pool.change_coin(fee_coin, len(coin_spends) * unwind_fee)
+        await push_fee_pool_bundle(wallet_client, 1, coin_spends, fee_coin, change_coin)
+
+        for coin_spend in coin_spends:
+            await coin_watcher.wait_for_spend(coin_spend.coin.name())
+
+        pool.add_pending(change_coin)
+        change_coins.append(change_coin)
+
+    # The root and the two batches below it are paid for by the split coins, the four batches creating the targets by
+    # the larger change
+    assert [coin.amount for coin in change_coins] == [1001 - 7, 1000 - 14, 1001 - 7 - 28]
+    assert [coin.parent_coin_info for coin in change_coins] == [
+        fee_coins[1].name(),
+        fee_coins[0].name(),
+        change_coins[0].name(),
+    ]
+
+    coin_records = await full_node_client.get_coin_records_by_names(
+        [coin.name() for coin in fee_coins + change_coins], include_spent_coins=True
+    )
+    spent = {coin_record.coin: coin_record.spent for coin_record in coin_records}
+    # Change that paid for a bundle was spent like the split coins, the rest is left in the pool
+    assert spent == {
+        fee_coins[0]: True,
+        fee_coins[1]: True,
+        change_coins[0]: True,
+        change_coins[1]: False,
+        change_coins[2]: False,
+    }
+
+    for target in targets:
+        [coin_record] = await full_node_client.get_coin_records_by_puzzle_hash(target.puzzle_hash)
+        assert coin_record.coin.amount == target.amount
+
+    with pytest.raises(Exception, match="can't be left by"):
+        await push_fee_pool_bundle(wallet_client, 1, coin_spends, change_coins[2], change_coins[0])
+
+    await coin_watcher.close()
+    full_node_client.close()
+    await full_node_client.await_closed()
+    wallet_client.close()
+    await wallet_client.await_closed()
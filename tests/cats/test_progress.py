@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import io
+import json
+from pathlib import Path
+
+import pytest
+
+from cats.progress import BagProgress, CombinedProgress, JsonLinesProgress, ProgressBar
+from cats.secure_the_bag import secure_the_bag
+from tests.cats.util import make_targets
+
+
+def test_progress(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    targets = make_targets(20)
+    metrics_path = tmp_path / "metrics.jsonl"
+    output = io.StringIO()
+
+    root, _ = secure_the_bag(
+        targets, 3, progress=CombinedProgress(ProgressBar(output), JsonLinesProgress(metrics_path))
+    )
+
+    # Nothing is printed when progress hooks are passed
+    assert capsys.readouterr().out == ""
+
+    records = [json.loads(line) for line in metrics_path.read_text().splitlines()]
+    levels, bag = records[:-1], records[-1]
+
+    assert [(level["level"], level["nodes"], level["batches"], level["coins"]) for level in levels] == [
+        (0, 20, 7, 7),
+        (1, 7, 3, 3),
+        (2, 3, 1, 1),
+    ]
+    assert levels[0]["bytes_secured"] == 20 * 40
+    assert bag["root_puzzle_hash"] == root.hex()
+    assert bag["height"] == 3
+
+    # Each level ends with its final counts on their own line
+    lines = output.getvalue().split("\n")
+    assert lines[0].split("\r")[-1].startswith("Level 0: [" + "#" * 30 + "] 100.0% 7 batches")
+    assert lines[0].endswith("-> 7 coins")
+
+    # The default is a line per level
+    secure_the_bag(targets, 3)
+    assert "Secured level 2 of the bag into 1 coins" in capsys.readouterr().out
+
+    secure_the_bag(targets, 3, progress=BagProgress())
+    assert capsys.readouterr().out == ""
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from pathlib import Path
+
 import pytest
 from chia.types.blockchain_format.program import Program
 from chia.types.condition_opcodes import ConditionOpcode
@@ -10,12 +12,21 @@ from chia_rs.sized_ints import uint64
 from clvm.casts import int_to_bytes
 
 from cats.secure_the_bag import (
+    EMPTY_COIN_ANNOUNCEMENT,
+    BagCoinSpends,
+    CATOuterPuzzleHasher,
+    ParentPuzzleLookup,
     Target,
+    batch_puzzle,
+    batch_puzzle_hash,
     batch_the_bag,
+    iter_secure_the_bag_targets,
     parent_of_puzzle_hash,
+    parse_level_widths,
     read_secure_the_bag_targets,
     secure_the_bag,
 )
+from tests.cats.util import make_targets
 
 
 def test_batch_the_bag() -> None:
@@ -207,9 +218,9 @@ def test_secure_the_bag() -> None:
 
     # Parent puzzle lookup (used for puzzle reveals)
 
-    puzzle_create_target_1 = parent_puzzle_lookup.get(target_1_puzzle_hash.hex())
-    puzzle_create_target_2 = parent_puzzle_lookup.get(target_2_puzzle_hash.hex())
-    puzzle_create_target_3 = parent_puzzle_lookup.get(target_3_puzzle_hash.hex())
+    puzzle_create_target_1 = parent_puzzle_lookup.get(target_1_puzzle_hash)
+    puzzle_create_target_2 = parent_puzzle_lookup.get(target_2_puzzle_hash)
+    puzzle_create_target_3 = parent_puzzle_lookup.get(target_3_puzzle_hash)
 
     assert puzzle_create_target_1 is not None
     assert puzzle_create_target_2 is not None
@@ -222,8 +233,8 @@ def test_secure_the_bag() -> None:
     # Target 3 is created by spending node 2
     assert puzzle_create_target_3.puzzle.get_tree_hash().hex() == node_2_puzzle_hash.hex()
 
-    puzzle_create_node_1 = parent_puzzle_lookup.get(node_1_puzzle_hash.hex())
-    puzzle_create_node_2 = parent_puzzle_lookup.get(node_2_puzzle_hash.hex())
+    puzzle_create_node_1 = parent_puzzle_lookup.get(node_1_puzzle_hash)
+    puzzle_create_node_2 = parent_puzzle_lookup.get(node_2_puzzle_hash)
 
     assert puzzle_create_node_1 is not None
     assert puzzle_create_node_2 is not None
@@ -337,9 +348,9 @@ def test_secure_bag_of_cats() -> None:
     assert node_2_puzzle.get_tree_hash().hex() == node_2_inner_puzzle_hash.hex()
 
     # Parent puzzle lookup (used for puzzle reveals)
-    puzzle_create_target_1 = parent_puzzle_lookup.get(target_1_outer_puzzle_hash.hex())
-    puzzle_create_target_2 = parent_puzzle_lookup.get(target_2_outer_puzzle_hash.hex())
-    puzzle_create_target_3 = parent_puzzle_lookup.get(target_3_outer_puzzle_hash.hex())
+    puzzle_create_target_1 = parent_puzzle_lookup.get(target_1_outer_puzzle_hash)
+    puzzle_create_target_2 = parent_puzzle_lookup.get(target_2_outer_puzzle_hash)
+    puzzle_create_target_3 = parent_puzzle_lookup.get(target_3_outer_puzzle_hash)
 
     assert puzzle_create_target_1 is not None
     assert puzzle_create_target_2 is not None
@@ -352,8 +363,8 @@ def test_secure_bag_of_cats() -> None:
     # Target 3 is created by spending node 2
     assert puzzle_create_target_3.puzzle.get_tree_hash().hex() == node_2_outer_puzzle_hash.hex()
 
-    puzzle_create_node_1 = parent_puzzle_lookup.get(node_1_outer_puzzle_hash.hex())
-    puzzle_create_node_2 = parent_puzzle_lookup.get(node_2_outer_puzzle_hash.hex())
+    puzzle_create_node_1 = parent_puzzle_lookup.get(node_1_outer_puzzle_hash)
+    puzzle_create_node_2 = parent_puzzle_lookup.get(node_2_outer_puzzle_hash)
 
     assert puzzle_create_node_1 is not None
     assert puzzle_create_node_2 is not None
@@ -369,6 +380,125 @@ def test_secure_bag_of_cats() -> None:
     )
 
 
+def test_secure_the_bag_streams_targets() -> None:
+    targets = [
+        Target(bytes32.fromhex("4bc6435b409bcbabe53870dae0f03755f6aabb4594c5915ec983acf12a5d1fba"), uint64(1)),
+        Target(bytes32.fromhex("f3d5162330c4d6c8b9a0aba5eed999178dd2bf466a7a0289739acc8209122e2c"), uint64(2)),
+        Target(bytes32.fromhex("7ffdeca4f997bde55d249b4a3adb8077782bc4134109698e95b10ea306a138b4"), uint64(3)),
+    ]
+
+    root_hash, parent_puzzle_lookup = secure_the_bag(targets, 2)
+    streamed_root_hash, streamed_parent_puzzle_lookup = secure_the_bag(iter(targets), 2)
+
+    # Lazily consumed targets produce the same tree
+    assert streamed_root_hash == root_hash
+    assert streamed_parent_puzzle_lookup.keys() == parent_puzzle_lookup.keys()
+
+    # A single target is its own root
+    single_root_hash, single_parent_puzzle_lookup = secure_the_bag(targets[:1], 2)
+    assert single_root_hash == targets[0].puzzle_hash
+    assert len(single_parent_puzzle_lookup) == 0
+
+    with pytest.raises(Exception, match="empty bag"):
+        secure_the_bag([], 2)
+
+    with pytest.raises(Exception, match="Leaf width"):
+        secure_the_bag(targets, 1)
+
+
+def test_secure_the_bag_in_parallel() -> None:
+    asset_id = bytes32.fromhex("6d95dae356e32a71db5ddcb42224754a02524c615c5fc35f568c2af04774e589")
+    targets = make_targets(500)
+
+    for bag_asset_id in [None, asset_id]:
+        root_hash, parent_puzzle_lookup = secure_the_bag(targets, 3, bag_asset_id)
+        parallel_root_hash, parallel_parent_puzzle_lookup = secure_the_bag(targets, 3, bag_asset_id, workers=2)
+
+        # Merging batches from the pool is deterministic
+        assert parallel_root_hash == root_hash
+        assert list(parallel_parent_puzzle_lookup.keys()) == list(parent_puzzle_lookup.keys())
+
+        for key, target_coin in parent_puzzle_lookup.items():
+            parallel_target_coin = parallel_parent_puzzle_lookup[key]
+            assert parallel_target_coin.puzzle == target_coin.puzzle
+            assert parallel_target_coin.puzzle_hash == target_coin.puzzle_hash
+            assert parallel_target_coin.amount == target_coin.amount
+
+
+def test_cat_outer_puzzle_hasher() -> None:
+    asset_id = bytes32.fromhex("6d95dae356e32a71db5ddcb42224754a02524c615c5fc35f568c2af04774e589")
+    hasher = CATOuterPuzzleHasher(asset_id)
+
+    for inner_puzzle_hash in [
+        bytes32.fromhex("4bc6435b409bcbabe53870dae0f03755f6aabb4594c5915ec983acf12a5d1fba"),
+        bytes32.fromhex("f3d5162330c4d6c8b9a0aba5eed999178dd2bf466a7a0289739acc8209122e2c"),
+        bytes32(b"\x00" * 32),
+    ]:
+        expected = construct_cat_puzzle(CAT_MOD, asset_id, Program.to(inner_puzzle_hash)).get_tree_hash_precalc(
+            inner_puzzle_hash
+        )
+
+        assert hasher.outer_puzzle_hash(inner_puzzle_hash) == expected
+
+
+def test_batch_puzzle_hash() -> None:
+    # Amounts whose encodings are empty, need a sign byte or use every byte
+    amounts = [0, 1, 127, 128, 255, 256, 32100000000, 2**63, 2**64 - 1]
+    targets = [Target(bytes32(std_hash(int_to_bytes(i))), uint64(amount)) for i, amount in enumerate(amounts)]
+
+    for width in range(len(targets) + 1):
+        conditions = [EMPTY_COIN_ANNOUNCEMENT] + [target.create_coin_condition() for target in targets[:width]]
+
+        assert batch_puzzle(targets[:width]) == Program.to((1, conditions))
+        assert batch_puzzle_hash(targets[:width]) == batch_puzzle(targets[:width]).get_tree_hash()
+
+
+@pytest.mark.parametrize("asset_id", [None, bytes32(b"\x01" * 32)])
+def test_parent_puzzle_lookup_builds_puzzles_on_demand(asset_id: bytes32 | None) -> None:
+    targets = make_targets(20)
+
+    # A single cached puzzle makes every lookup of a different batch rebuild it
+    parent_puzzle_lookup = ParentPuzzleLookup(asset_id, puzzle_cache_size=1)
+    secure_the_bag(targets, [3, 2], asset_id, parent_puzzle_lookup)
+
+    children: dict[bytes32, list[Target]] = {}
+    for target_coin in parent_puzzle_lookup.values():
+        children.setdefault(target_coin.puzzle_hash, []).append(target_coin.target)
+
+    for key in reversed(list(parent_puzzle_lookup)):
+        target_coin = parent_puzzle_lookup[key]
+        puzzle = batch_puzzle(children[target_coin.puzzle_hash])
+        if asset_id is not None:
+            puzzle = construct_cat_puzzle(CAT_MOD, asset_id, puzzle)
+
+        assert target_coin.puzzle == puzzle
+        assert target_coin.puzzle.get_tree_hash() == target_coin.puzzle_hash
+
+    with pytest.raises(Exception, match="asset id does not match"):
+        secure_the_bag(targets, 3, None, ParentPuzzleLookup(bytes32(b"\x01" * 32)))
+
+
+def test_parent_puzzle_lookup_index() -> None:
+    parent_puzzle_lookup = ParentPuzzleLookup()
+    # Keys sharing their first bytes all probe from the same slot
+    keys = [bytes32(b"\x07" * 8 + std_hash(int_to_bytes(i))[8:]) for i in range(40)]
+    keys += [target.puzzle_hash for target in make_targets(1000)]
+
+    for start in range(0, len(keys), 7):
+        batch_keys = keys[start : start + 7]
+        parent_puzzle_lookup.add_batch(
+            [Target(key, uint64(1)) for key in batch_keys], batch_keys, bytes32(b"\x01" * 32), uint64(len(batch_keys))
+        )
+
+    assert list(parent_puzzle_lookup) == keys
+    assert all(parent_puzzle_lookup[key].target.puzzle_hash == key for key in keys)
+    assert bytes32(b"\x07" * 32) not in parent_puzzle_lookup
+    assert bytes32(b"\x00" * 32) not in parent_puzzle_lookup
+
+    with pytest.raises(KeyError):
+        parent_puzzle_lookup[bytes32(b"\x07" * 8 + b"\x00" * 24)]
+
+
 def test_parent_of_puzzle_hash() -> None:
     target_1_puzzle_hash = bytes32.fromhex("4bc6435b409bcbabe53870dae0f03755f6aabb4594c5915ec983acf12a5d1fba")
     target_1_amount = uint64(10000000000000000)
@@ -395,7 +525,7 @@ def test_parent_of_puzzle_hash() -> None:
     assert coin_spend.coin.name() == expected_node_1_coin_name
     assert coin_name == expected_node_1_coin_name
 
-    pp = parent_puzzle_lookup.get(target_1_puzzle_hash.hex())
+    pp = parent_puzzle_lookup.get(target_1_puzzle_hash)
     assert pp is not None
     node_1_puzzle_hash = pp.puzzle_hash
 
@@ -405,7 +535,7 @@ def test_parent_of_puzzle_hash() -> None:
     assert coin_spend is not None
     assert coin_spend.coin.name() == expected_root_coin_name
     assert coin_name == expected_root_coin_name
-    pp = parent_puzzle_lookup.get(node_1_puzzle_hash.hex())
+    pp = parent_puzzle_lookup.get(node_1_puzzle_hash)
     assert pp is not None
     root_puzzle_hash = pp.puzzle_hash
 
@@ -451,6 +581,33 @@ def test_parent_of_puzzle_hash() -> None:
     assert node_1_coin_name == expected_node_1_coin_name
 
 
+def test_bag_coin_spends() -> None:
+    targets = make_targets(50)
+    genesis_coin_name = bytes32.fromhex("2676b64fab1f562cc4788cb2a9dbbe31da09da9cc23118dfccf6ad741d652328")
+    root_hash, parent_puzzle_lookup = secure_the_bag(targets, 3)
+
+    coin_spends_by_depth = BagCoinSpends(genesis_coin_name, parent_puzzle_lookup).coin_spends_by_depth()
+
+    # Root is created by the genesis coin
+    assert len(coin_spends_by_depth[0]) == 1
+    assert coin_spends_by_depth[0][0].coin.parent_coin_info == genesis_coin_name
+    assert coin_spends_by_depth[0][0].coin.puzzle_hash == root_hash
+
+    # Every internal node is spent once and the deepest ones create the targets
+    assert sum(len(coin_spends) for coin_spends in coin_spends_by_depth) == len(parent_puzzle_lookup) - len(targets) + 1
+    assert len(coin_spends_by_depth[-1]) == 17
+
+    # Breadth first pass agrees with walking up from each node
+    coin_spends_by_name = {
+        coin_spend.coin.name(): coin_spend for coin_spends in coin_spends_by_depth for coin_spend in coin_spends
+    }
+    bag_coin_spends = BagCoinSpends(genesis_coin_name, parent_puzzle_lookup)
+
+    for key in parent_puzzle_lookup.keys():
+        parent_coin_spend, parent_coin_name = bag_coin_spends.parent_of_puzzle_hash(key)
+        assert parent_coin_spend == coin_spends_by_name[parent_coin_name]
+
+
 def test_read_secure_the_bag_targets() -> None:
     targets = read_secure_the_bag_targets("./tests/cats/test.csv", 20000032100000000)
 
@@ -469,3 +626,92 @@ def test_read_secure_the_bag_targets() -> None:
 def test_read_secure_the_bag_targets_invalid_net_amount() -> None:
     with pytest.raises(Exception):
         read_secure_the_bag_targets("test.csv", 5000000)
+
+
+def write_targets(path: Path, rows: list[str]) -> str:
+    path.write_text("\n".join(rows) + "\n")
+    return str(path)
+
+
+def test_iter_secure_the_bag_targets_in_chunks(tmp_path: Path) -> None:
+    puzzle_hashes = [bytes32(std_hash(int_to_bytes(i))) for i in range(7)]
+    targets_path = write_targets(
+        tmp_path / "targets.csv", [f"{ph.hex()},{i + 1}" for i, ph in enumerate(puzzle_hashes)]
+    )
+
+    chunks = list(iter_secure_the_bag_targets(targets_path, 28, chunk_size=3))
+
+    assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+    assert [target.puzzle_hash for chunk in chunks for target in chunk] == puzzle_hashes
+    assert [target.amount for chunk in chunks for target in chunk] == list(range(1, 8))
+
+
+@pytest.mark.parametrize(
+    "row, error",
+    [
+        ("00" * 32, "line 2.*got 1 columns"),
+        ("00" * 31 + ",1", "line 2.*not 32 bytes of hex"),
+        ("00" * 32 + ",-1", "line 2.*not a valid number of mojos"),
+        ("00" * 32 + ",one", "line 2.*not a valid number of mojos"),
+    ],
+)
+def test_iter_secure_the_bag_targets_malformed_row(tmp_path: Path, row: str, error: str) -> None:
+    targets_path = write_targets(tmp_path / "targets.csv", ["11" * 32 + ",1", row])
+
+    with pytest.raises(Exception, match=error):
+        list(iter_secure_the_bag_targets(targets_path))
+
+
+def test_iter_secure_the_bag_targets_duplicates(tmp_path: Path) -> None:
+    targets_path = write_targets(tmp_path / "targets.csv", ["11" * 32 + ",1", "22" * 32 + ",2", "11" * 32 + ",3"])
+
+    with pytest.raises(Exception, match="Duplicate target on line 3"):
+        list(iter_secure_the_bag_targets(targets_path))
+
+    # Merged amounts go to the first occurrence
+    targets = read_secure_the_bag_targets(targets_path, 6, merge_duplicates=True)
+
+    assert [(target.puzzle_hash, target.amount) for target in targets] == [
+        (bytes32(b"\x11" * 32), 4),
+        (bytes32(b"\x22" * 32), 2),
+    ]
+
+
+def test_iter_secure_the_bag_targets_running_total(tmp_path: Path) -> None:
+    targets_path = write_targets(tmp_path / "targets.csv", ["11" * 32 + ",5", "22" * 32 + ",5", "33" * 32 + ",5"])
+
+    # Stops as soon as the running total passes the expected amount
+    with pytest.raises(Exception, match="exceeds expected amount of 8 by line 2"):
+        list(iter_secure_the_bag_targets(targets_path, 8, chunk_size=1))
+
+    with pytest.raises(Exception, match="Expected 20 but got 15"):
+        list(iter_secure_the_bag_targets(targets_path, 20))
+
+
+def test_secure_the_bag_level_widths() -> None:
+    targets = make_targets(20)
+
+    genesis_coin_name = bytes32.fromhex("2676b64fab1f562cc4788cb2a9dbbe31da09da9cc23118dfccf6ad741d652328")
+
+    # Widths of 3 then 2 from the leaves up, the last width is reused for every level above
+    root_hash, parent_puzzle_lookup = secure_the_bag(targets, [3, 2])
+    coin_spends_by_depth = BagCoinSpends(genesis_coin_name, parent_puzzle_lookup).coin_spends_by_depth()
+
+    assert [len(coin_spends) for coin_spends in coin_spends_by_depth] == [1, 2, 4, 7]
+
+    # Every spend at the bottom creates up to 3 targets and every spend above it up to 2 coins
+    assert len(parent_puzzle_lookup) == 20 + 7 + 4 + 2
+
+    # A single width is the same as a list with just that width
+    assert secure_the_bag(targets, [3])[0] == secure_the_bag(targets, 3)[0]
+    assert secure_the_bag(targets, [3, 3, 3])[0] == secure_the_bag(targets, 3)[0]
+    assert secure_the_bag(targets, [3, 2])[0] == root_hash
+
+    assert parse_level_widths("100") == [100]
+    assert parse_level_widths("100,50,20") == [100, 50, 20]
+
+    with pytest.raises(Exception, match="at least 2"):
+        parse_level_widths("100,1")
+
+    with pytest.raises(Exception, match="Invalid leaf width"):
+        parse_level_widths("wide")
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+from collections.abc import Iterable
+from pathlib import Path
+
+import pytest
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint64
+from click.testing import CliRunner
+
+from cats.secure_the_bag import Target, cli, read_secure_the_bag_targets, secure_the_bag
+from cats.target_file import (
+    TARGET_FILE_HEADER,
+    MappedTargets,
+    is_target_file,
+    open_secure_the_bag_targets,
+    write_target_file,
+)
+from tests.cats.util import make_targets
+
+
+def pairs(targets: Iterable[Target]) -> list[tuple[bytes32, uint64]]:
+    return [(target.puzzle_hash, target.amount) for target in targets]
+
+
+def test_target_file(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # Write records in several chunks
+    monkeypatch.setattr("cats.target_file.TARGET_FILE_WRITE_CHUNK_SIZE", 4)
+
+    targets = make_targets(10)
+    target_file_path = tmp_path / "targets.bin"
+
+    assert write_target_file(target_file_path, targets) == (10, 55)
+    assert is_target_file(target_file_path)
+    assert not is_target_file("./tests/cats/test.csv")
+
+    with MappedTargets.open(target_file_path) as mapped_targets:
+        assert len(mapped_targets) == 10
+        assert mapped_targets.total_amount == 55
+        assert pairs(mapped_targets) == pairs(targets)
+        assert pairs([mapped_targets[-1]]) == pairs(targets[-1:])
+        assert pairs(mapped_targets[2:5]) == pairs(targets[2:5])
+
+        # Bag secured from the mapped file is the same as from the targets themselves
+        assert secure_the_bag(mapped_targets, 3)[0] == secure_the_bag(targets, 3)[0]
+
+
+def test_target_file_corrupt(tmp_path: Path) -> None:
+    targets = make_targets(3)
+    target_file_path = tmp_path / "targets.bin"
+    write_target_file(target_file_path, targets)
+
+    data = bytearray(target_file_path.read_bytes())
+
+    # Flip a bit in the amount of the last target
+    data[-1] ^= 1
+    target_file_path.write_bytes(data)
+
+    # Records are only read back against the checksum when asked to
+    MappedTargets.open(target_file_path).close()
+
+    with pytest.raises(Exception, match="checksum"):
+        MappedTargets.open(target_file_path, verify_checksum=True)
+
+    target_file_path.write_bytes(data[:-1])
+
+    with pytest.raises(Exception, match="truncated"):
+        MappedTargets.open(target_file_path)
+
+    target_file_path.write_bytes(data[: TARGET_FILE_HEADER.size - 1])
+
+    with pytest.raises(Exception, match="too short"):
+        MappedTargets.open(target_file_path)
+
+
+def test_convert(tmp_path: Path) -> None:
+    target_file_path = tmp_path / "targets.bin"
+
+    result = CliRunner().invoke(
+        cli,
+        ["convert", "-stbtp", "./tests/cats/test.csv", "-o", str(target_file_path), "-a", "20000032100000000"],
+    )
+
+    assert result.exit_code == 0
+    assert "Converted 3 targets" in result.output
+
+    with open_secure_the_bag_targets(str(target_file_path), 20000032100000000) as targets:
+        assert pairs(targets) == pairs(read_secure_the_bag_targets("./tests/cats/test.csv", 20000032100000000))
+
+    with pytest.raises(Exception, match="Expected 5000000"):
+        with open_secure_the_bag_targets(str(target_file_path), 5000000):
+            pass
+
+
+def test_target_file_failed_write(tmp_path: Path) -> None:
+    target_file_path = tmp_path / "targets.bin"
+    write_target_file(target_file_path, make_targets(3))
+    data = target_file_path.read_bytes()
+
+    # Overflowing the total amount fails after every record was written, the earlier file is left as it was
+    with pytest.raises(Exception, match="does not fit in a single coin"):
+        write_target_file(target_file_path, [Target(bytes32(b"\x01" * 32), uint64(uint64.MAXIMUM))] * 2)
+
+    assert target_file_path.read_bytes() == data
+    assert [path.name for path in tmp_path.iterdir()] == ["targets.bin"]
@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import pytest
+from chia_rs import CoinRecord
+from chia_rs.sized_ints import uint32, uint64
+
+from cats.unwind_frontier import NodeState, scan_frontier
+from tests.cats.util import FullNode, make_coin_spends_by_depth
+
+
+@pytest.mark.asyncio
+async def test_scan_frontier() -> None:
+    root, middle, leaves = make_coin_spends_by_depth(27)
+
+    # The root and the first middle coin have been spent, so the rest of the middle coins and the leaf batches
+    # created by the first middle coin are unspent
+    spent = [root[0].coin, middle[0].coin]
+    unspent = [*(coin_spend.coin for coin_spend in middle[1:]), *(coin_spend.coin for coin_spend in leaves[:3])]
+    coin_records = FullNode(
+        [CoinRecord(coin, uint32(1), uint32(2), False, uint64(0)) for coin in spent]
+        + [CoinRecord(coin, uint32(2), uint32(0), False, uint64(0)) for coin in unspent]
+    )
+
+    frontier = await scan_frontier(coin_records, [root, middle, leaves], chunk_size=2)
+
+    assert frontier.count(NodeState.SPENT) == 2
+    assert frontier.count(NodeState.UNSPENT) == 5
+    assert frontier.count(NodeState.NONEXISTENT) == 6
+
+    # Leaf batches below unspent coins are never looked up
+    assert coin_records.names_looked_up == 1 + 3 + 3
+    assert frontier.queries == 1 + 2 + 2
+
+    assert [{coin_spend.coin for coin_spend in coin_spends} for coin_spends in frontier.rounds] == [
+        set(unspent),
+        {coin_spend.coin for coin_spend in leaves[3:]},
+    ]
+
+    # Nothing exists before the bag is launched, so the root is the only coin to wait for first
+    frontier = await scan_frontier(FullNode(), [root, middle, leaves])
+
+    assert frontier.count(NodeState.NONEXISTENT) == 13
+    assert [len(coin_spends) for coin_spends in frontier.rounds] == [1, 3, 9]
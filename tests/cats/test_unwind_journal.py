@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+from chia.types.blockchain_format.coin import Coin
+from chia.util.hash import std_hash
+from chia_rs import CoinRecord
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint32, uint64
+from clvm.casts import int_to_bytes
+
+from cats.coin_watcher import CoinWatcher
+from cats.unwind_frontier import NodeState, scan_frontier
+from cats.unwind_journal import UnwindJournal
+from cats.unwind_scheduler import UnwindScheduler
+from tests.cats.util import ASSET_ID, GENESIS_COIN_NAME, PUZZLE_HASH, FullNode, make_coin_spends_by_depth
+
+
+@pytest.mark.asyncio
+async def test_unwind_journal(tmp_path: Path) -> None:
+    coin_spends_by_depth = make_coin_spends_by_depth(27)
+    root, middle, leaves = coin_spends_by_depth
+    journal_path = tmp_path / "journal.sqlite"
+
+    # The root was spent before the journal was started
+    coin_records = FullNode([CoinRecord(root[0].coin, uint32(1), uint32(2), False, uint64(0))])
+    journal = UnwindJournal.open(journal_path, GENESIS_COIN_NAME, ASSET_ID)
+    assert not journal.started
+    journal.start(await scan_frontier(coin_records, coin_spends_by_depth))
+
+    fee_coins = [Coin(bytes32(std_hash(int_to_bytes(i))), PUZZLE_HASH, uint64(100 + i)) for i in range(2)]
+    journal.fee_coins_split(fee_coins)
+    change_coin = Coin(fee_coins[0].name(), PUZZLE_HASH, uint64(40))
+
+    # The first middle coin has been confirmed, the second pushed and the third only planned
+    first = journal.bundle_planned(middle[:1], fee_coins[0], change_coin)
+    journal.bundle_pushed(first, bytes32(b"\x01" * 32))
+    journal.bundle_confirmed(first, 3)
+    second = journal.bundle_planned(middle[1:2], None, None)
+    journal.bundle_pushed(second, bytes32(b"\x02" * 32))
+    third = journal.bundle_planned(middle[2:], None, None)
+    journal.close()
+
+    with pytest.raises(Exception, match="Journal is for the bag created by"):
+        UnwindJournal.open(journal_path, bytes32(b"\x00" * 32), ASSET_ID)
+
+    journal = UnwindJournal.open(journal_path, GENESIS_COIN_NAME, ASSET_ID)
+    assert journal.started
+
+    bundles = journal.bundles()
+    assert [bundle.bundle_id for bundle in bundles] == [first, second, third]
+    assert bundles[0].coin_ids == [middle[0].coin.name()]
+    assert bundles[0].fee_coin == fee_coins[0] and bundles[0].change_coin == change_coin
+    assert bundles[0].confirmed and bundles[0].height == 3
+    assert bundles[1].spend_bundle_id == bytes32(b"\x02" * 32) and not bundles[1].confirmed
+    assert bundles[2].spend_bundle_id is None
+
+    # Pushing a resumed bundle again keeps the id it was first pushed with
+    journal.bundle_pushed(second, bytes32(b"\x03" * 32))
+    assert journal.bundles()[1].spend_bundle_id == bytes32(b"\x02" * 32)
+
+    frontier, resumed = journal.resume(coin_spends_by_depth)
+    assert [bundle.bundle_id for bundle, _ in resumed] == [second, third]
+    assert [coin_spends for _, coin_spends in resumed] == [middle[1:2], middle[2:]]
+    assert frontier.states[root[0].coin.name()] == NodeState.SPENT
+    assert frontier.states[middle[0].coin.name()] == NodeState.SPENT
+    assert frontier.states[leaves[0].coin.name()] == NodeState.UNSPENT
+    assert frontier.states[leaves[3].coin.name()] == NodeState.NONEXISTENT
+
+    # Only the leaves are left, the ones created by the confirmed middle coin can be spent straight away
+    assert frontier.remaining_spends() == len(leaves)
+    scheduler = UnwindScheduler(frontier, max_bundle_cost=len(leaves), spend_cost=lambda _: 1)
+    assert list(scheduler.ready) == leaves[:3]
+    assert scheduler.created_by(middle[1:]) == leaves[3:]
+
+    # The unused split coin and the change are left in the pool
+    fee_pool = journal.fee_pool(CoinWatcher(coin_records))
+    assert fee_pool is not None
+    assert fee_pool.puzzle_hash == PUZZLE_HASH
+    assert len(fee_pool) == 2
+
+    journal.close()
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint64
+
+from cats.secure_the_bag import BagCoinSpends, CATOuterPuzzleHasher, Target, secure_the_bag
+from cats.unwind_proof import (
+    BATCHES_DIRECTORY,
+    PROOFS_METADATA,
+    export_unwind_proofs,
+    load_unwind_proof,
+    parent_puzzle_lookup_from_proof,
+    proof_shard_path,
+    read_unwind_proof,
+)
+from tests.cats.util import ASSET_ID, GENESIS_COIN_NAME, make_targets
+
+
+@pytest.mark.parametrize("asset_id", [None, ASSET_ID])
+def test_unwind_proofs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, asset_id: bytes32 | None) -> None:
+    # Append to shards several times
+    monkeypatch.setattr("cats.unwind_proof.PROOF_WRITE_CHUNK_SIZE", 7)
+
+    targets = make_targets(40)
+    _, parent_puzzle_lookup = secure_the_bag(targets, 3, asset_id)
+
+    proofs_path = tmp_path / "proofs"
+    assert export_unwind_proofs(proofs_path, targets, parent_puzzle_lookup, asset_id, prefix_length=1) == 40
+    assert len(list(proofs_path.glob("*.jsonl"))) <= 16
+
+    # Every batch is written once however many proofs share it
+    batch_lines = [line for shard in (proofs_path / BATCHES_DIRECTORY).glob("*.jsonl") for line in open(shard)]
+    assert len(batch_lines) == len({target_coin.puzzle_hash for target_coin in parent_puzzle_lookup.values()})
+
+    bag_coin_spends = BagCoinSpends(GENESIS_COIN_NAME, parent_puzzle_lookup)
+
+    for target in targets:
+        proof_lookup = load_unwind_proof(proofs_path, target.puzzle_hash, asset_id)
+
+        # Only the path from the target to the root is kept
+        assert len(proof_lookup) == 4
+
+        key = target.puzzle_hash
+        if asset_id is not None:
+            key = CATOuterPuzzleHasher(asset_id).outer_puzzle_hash(target.puzzle_hash)
+
+        # Spends along the path match those from the whole bag
+        proof_coin_spends = BagCoinSpends(GENESIS_COIN_NAME, proof_lookup)
+
+        while key in proof_lookup:
+            proof_coin_spend, proof_parent_coin_name = proof_coin_spends.parent_of_puzzle_hash(key)
+            coin_spend, parent_coin_name = bag_coin_spends.parent_of_puzzle_hash(key)
+            assert proof_coin_spend == coin_spend
+            assert proof_parent_coin_name == parent_coin_name
+            key = proof_lookup[key].puzzle_hash
+
+        # A single shard can be loaded directly
+        shard_path = proof_shard_path(proofs_path, target.puzzle_hash, 1)
+        assert set(load_unwind_proof(shard_path, target.puzzle_hash, asset_id)) == set(proof_lookup)
+
+
+def test_unwind_proofs_sorted(tmp_path: Path) -> None:
+    targets = make_targets(40)
+    _, parent_puzzle_lookup = secure_the_bag(targets, 3, ASSET_ID)
+
+    # Every proof in one shard, and the same proofs spread over many
+    export_unwind_proofs(tmp_path / "one", targets, parent_puzzle_lookup, ASSET_ID, prefix_length=0)
+    export_unwind_proofs(tmp_path / "many", targets, parent_puzzle_lookup, ASSET_ID, prefix_length=2)
+
+    shard_lines = (tmp_path / "one" / ".jsonl").read_text().splitlines()
+    assert len(shard_lines) == 40
+    assert shard_lines == sorted(shard_lines)
+
+    # The prefix length is read back rather than guessed from the shards that exist
+    for target in targets:
+        assert read_unwind_proof(tmp_path / "one", target.puzzle_hash) == read_unwind_proof(
+            tmp_path / "many", target.puzzle_hash
+        )
+
+    (tmp_path / "many" / PROOFS_METADATA).unlink()
+
+    with pytest.raises(Exception, match="does not hold unwind proofs"):
+        read_unwind_proof(tmp_path / "many", targets[0].puzzle_hash)
+
+
+def test_unwind_proof_invalid(tmp_path: Path) -> None:
+    targets = make_targets(10)
+    _, parent_puzzle_lookup = secure_the_bag(targets, 3, ASSET_ID)
+
+    export_unwind_proofs(tmp_path / "proofs", targets, parent_puzzle_lookup, ASSET_ID)
+    proof = read_unwind_proof(tmp_path / "proofs", targets[4].puzzle_hash)
+
+    with pytest.raises(Exception, match="asset id"):
+        parent_puzzle_lookup_from_proof(proof, None)
+
+    with pytest.raises(Exception, match="is not created by its parent"):
+        parent_puzzle_lookup_from_proof({**proof, "amount": 6}, ASSET_ID)
+
+    ancestors = [dict(ancestor) for ancestor in proof["ancestors"]]
+    ancestors[1]["amount"] += 1
+
+    with pytest.raises(Exception, match="parent amount does not match"):
+        parent_puzzle_lookup_from_proof({**proof, "ancestors": ancestors}, ASSET_ID)
+
+    with pytest.raises(Exception, match="not in the secured bag"):
+        export_unwind_proofs(tmp_path, [Target(bytes32(b"\x00" * 32), uint64(1))], parent_puzzle_lookup, ASSET_ID)
+
+    export_unwind_proofs(tmp_path, targets[:1], parent_puzzle_lookup, ASSET_ID)
+
+    with pytest.raises(Exception, match="No unwind proof"):
+        load_unwind_proof(tmp_path, targets[1].puzzle_hash, ASSET_ID)
+
+    for shard in (tmp_path / BATCHES_DIRECTORY).glob("*.jsonl"):
+        shard.unlink()
+
+    with pytest.raises(Exception, match="is missing the batch"):
+        load_unwind_proof(tmp_path, targets[0].puzzle_hash, ASSET_ID)
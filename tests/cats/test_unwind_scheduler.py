@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from chia_rs import CoinSpend
+from chia_rs.sized_bytes import bytes32
+
+from cats.fan_out import cat_unwind_spend_cost, fee_spend_cost
+from cats.unwind_frontier import BagFrontier, scan_frontier
+from cats.unwind_scheduler import UnwindScheduler
+from tests.cats.util import FullNode, make_coin_spends_by_depth
+
+
+class Chain:
+    """
+    Confirms every pushed spend in the next block, checking each spend's coin has been created first or is created
+    by another spend in the same bundle.
+    """
+
+    def __init__(self, root_coin_name: bytes32) -> None:
+        self.created = {root_coin_name}
+        self.pending: list[CoinSpend] = []
+        self.spent: set[bytes32] = set()
+        self.new_block = asyncio.Event()
+
+    async def push_bundle(self, bundle: list[CoinSpend]) -> None:
+        in_bundle = {coin_spend.coin.name() for coin_spend in bundle}
+
+        for coin_spend in bundle:
+            assert coin_spend.coin.name() in self.created or coin_spend.coin.parent_coin_info in in_bundle
+
+        self.pending += bundle
+
+    async def wait_for_spend(self, coin_name: bytes32) -> None:
+        while coin_name not in self.spent:
+            await self.new_block.wait()
+
+    def farm_block(self, children: dict[bytes32, list[bytes32]]) -> bool:
+        if len(self.pending) == 0:
+            return False
+
+        for coin_spend in self.pending:
+            self.spent.add(coin_spend.coin.name())
+            self.created.update(children.get(coin_spend.coin.name(), []))
+
+        self.pending = []
+        new_block, self.new_block = self.new_block, asyncio.Event()
+        new_block.set()
+
+        return True
+
+
+async def unwind(window: int, bundle_size: int, levels: int = 1, pushed: int = 0) -> tuple[UnwindScheduler, int]:
+    coin_spends_by_depth = make_coin_spends_by_depth(27)
+    children: dict[bytes32, list[bytes32]] = {}
+
+    for coin_spends in coin_spends_by_depth:
+        for coin_spend in coin_spends:
+            children.setdefault(coin_spend.coin.parent_coin_info, []).append(coin_spend.coin.name())
+
+    chain = Chain(coin_spends_by_depth[0][0].coin.name())
+    frontier = await scan_frontier(FullNode(), coin_spends_by_depth)
+    # The first pushed bundles of single spends were pushed by an earlier run that stopped
+    pushed_bundles = [[coin_spend] for coin_spend in frontier.rounds[0][:pushed]]
+    frontier.rounds[0] = frontier.rounds[0][pushed:]
+    for bundle in pushed_bundles:
+        await chain.push_bundle(bundle)
+
+    # Every spend costs the same so bundle_size spends fit in a bundle
+    scheduler = UnwindScheduler(frontier, window, bundle_size, levels, spend_cost=lambda _: 1)
+    task = asyncio.create_task(scheduler.run(chain.push_bundle, chain.wait_for_spend, pushed=pushed_bundles))
+    blocks = 0
+
+    while not task.done():
+        await asyncio.sleep(0.01)
+        if chain.farm_block(children):
+            blocks += 1
+
+    await task
+    assert len(chain.spent) == 13
+
+    return scheduler, blocks
+
+
+@pytest.mark.asyncio
+async def test_unwind_scheduler() -> None:
+    # Each level confirms in one block when the window holds all of its bundles
+    scheduler, blocks = await unwind(window=5, bundle_size=2)
+    assert blocks == 3
+    assert scheduler.bundles_pushed == 1 + 2 + 5
+    assert scheduler.max_in_flight == 5
+
+    # The last leaf bundle waits for a free slot
+    scheduler, blocks = await unwind(window=4, bundle_size=2)
+    assert blocks == 4
+    assert scheduler.max_in_flight == 4
+
+    # One bundle at a time takes a block per bundle, but bundles aren't held back by the rest of their level
+    scheduler, blocks = await unwind(window=1, bundle_size=10)
+    assert blocks == 1 + 1 + 1
+    scheduler, blocks = await unwind(window=1, bundle_size=2)
+    assert blocks == 7
+    assert scheduler.bundles_pushed == 7
+
+
+@pytest.mark.asyncio
+async def test_ephemeral_bundles() -> None:
+    # The whole bag is created and spent in a single bundle
+    scheduler, blocks = await unwind(window=1, bundle_size=13, levels=3)
+    assert blocks == 1
+    assert scheduler.bundles_pushed == 1
+
+    # The root and middle coins fill the first bundle, then the leaves are spent a bundle at a time
+    scheduler, blocks = await unwind(window=1, bundle_size=4, levels=3)
+    assert blocks == 1 + 3
+    assert scheduler.bundles_pushed == 4
+
+    # A middle coin and some of its leaves share a bundle, the rest of its leaves wait for it to be confirmed
+    scheduler, blocks = await unwind(window=3, bundle_size=2, levels=2)
+    assert blocks == 1 + 2
+
+
+@pytest.mark.asyncio
+async def test_resume_pushed_bundles() -> None:
+    # The root bundle from before the restart confirms and its children follow
+    scheduler, blocks = await unwind(window=5, bundle_size=2, pushed=1)
+    assert blocks == 3
+    assert scheduler.bundles_pushed == 2 + 5
+
+
+def test_cost_bounded_bundles() -> None:
+    _, _, leaves = make_coin_spends_by_depth(27)
+    frontier = BagFrontier()
+
+    for leaf in leaves:
+        frontier.add_remaining(0, leaf)
+
+    leaf_costs = [cat_unwind_spend_cost(leaf) for leaf in leaves]
+    max_bundle_cost = sum(leaf_costs[:4])
+
+    scheduler = UnwindScheduler(frontier, max_bundle_cost=max_bundle_cost)
+    assert scheduler.next_bundle() == leaves[:4]
+    assert scheduler.next_bundle() == leaves[4:8]
+
+    # The fee spend takes its share of the bundle
+    scheduler = UnwindScheduler(frontier, max_bundle_cost=max_bundle_cost, fee_spend_cost=fee_spend_cost)
+    assert scheduler.next_bundle() == leaves[:3]
+
+    with pytest.raises(Exception, match="does not fit in a spend bundle"):
+        UnwindScheduler(frontier, max_bundle_cost=leaf_costs[0] - 1).next_bundle()
+
+    # The spend that doesn't fit in a bundle is not run again when it heads the next one
+    costed: list[bytes32] = []
+
+    def counting_spend_cost(coin_spend: CoinSpend) -> int:
+        costed.append(coin_spend.coin.name())
+        return cat_unwind_spend_cost(coin_spend)
+
+    scheduler = UnwindScheduler(frontier, max_bundle_cost=max_bundle_cost, spend_cost=counting_spend_cost)
+    while len(scheduler.ready) > 0:
+        scheduler.next_bundle()
+
+    assert sorted(costed) == sorted(leaf.coin.name() for leaf in leaves)
+    assert scheduler.spend_costs == {}
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import pytest
+from chia.types.blockchain_format.coin import Coin
+from chia.types.blockchain_format.program import Program, run_with_cost
+from chia.types.coin_spend import make_spend
+from chia.types.condition_opcodes import ConditionOpcode
+from chia.util.hash import std_hash
+from chia.wallet.cat_wallet.cat_utils import CAT_MOD, construct_cat_puzzle
+from chia_rs import CoinRecord
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint32, uint64
+
+from cats.coin_watcher import CoinWatcher
+from cats.fan_out import MAX_SPEND_BUNDLE_COST, cat_unwind_spend_cost
+from cats.secure_the_bag import BagCoinSpends, secure_the_bag
+from cats.unwind_spends import BagLineage, UnwindSpendBuilder, build_unwind_spend, validate_unwind_spends
+from tests.cats.util import ASSET_ID, FullNode, make_coin_spends_by_depth, make_targets
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("workers", [1, 2])
+async def test_unwind_spend_builder(workers: int) -> None:
+    targets = make_targets(27)
+    _, parent_puzzle_lookup = secure_the_bag(targets, 3, ASSET_ID)
+
+    eve_puzzle = construct_cat_puzzle(CAT_MOD, ASSET_ID, Program.to(1))
+    eve_coin = Coin(bytes32(std_hash(b"eve parent")), eve_puzzle.get_tree_hash(), uint64(sum(range(1, 28))))
+    root, middle, leaves = BagCoinSpends(eve_coin.name(), parent_puzzle_lookup).coin_spends_by_depth()
+
+    eve_coin_spend = make_spend(eve_coin, eve_puzzle, Program.to([]))
+    full_node = FullNode(
+        [
+            CoinRecord(eve_coin, uint32(1), uint32(1), False, uint64(0)),
+            CoinRecord(root[0].coin, uint32(1), uint32(0), False, uint64(0)),
+        ],
+        [eve_coin_spend],
+    )
+    coin_watcher = CoinWatcher(full_node, poll_interval=0.01)
+    bag_lineage = BagLineage(full_node, coin_watcher, BagCoinSpends(eve_coin.name(), parent_puzzle_lookup))
+    spend_builder = UnwindSpendBuilder(ASSET_ID, bag_lineage, workers)
+
+    # Leaves are built ahead while their parents are still to be spent
+    spend_builder.build_ahead(leaves)
+
+    for bundle in [leaves[:5], leaves[5:], middle, root]:
+        cat_spends = await spend_builder.build(bundle, MAX_SPEND_BUNDLE_COST)
+        assert [cat_spend.coin for cat_spend in cat_spends] == [coin_spend.coin for coin_spend in bundle]
+
+        for cat_spend in cat_spends:
+            _, conditions = run_with_cost(cat_spend.puzzle_reveal, 11_000_000_000, cat_spend.solution)
+
+            # The CAT only asserts its own coin id if the lineage proof matches its parent
+            assert [
+                condition.at("rf").as_atom()
+                for condition in conditions.as_iter()
+                if condition.first().as_int() == ConditionOpcode.ASSERT_MY_COIN_ID[0]
+            ] == [cat_spend.coin.name()]
+
+    # Only the root's lineage came from the chain
+    assert full_node.coin_spend_lookups == 1
+
+    # A bundle is validated against its cost as a whole
+    with pytest.raises(Exception, match="Unwind spends are invalid"):
+        await spend_builder.build(leaves, sum(cat_unwind_spend_cost(leaf) for leaf in leaves) // 2)
+
+    spend_builder.close()
+    await coin_watcher.close()
+
+
+def test_validate_unwind_spends() -> None:
+    root, leaves = make_coin_spends_by_depth(9)
+
+    cat_spend = build_unwind_spend(ASSET_ID, leaves[0], root[0])
+
+    # The measured cost used to pack bundles is never below the real cost
+    assert 0 < validate_unwind_spends([cat_spend], MAX_SPEND_BUNDLE_COST) <= cat_unwind_spend_cost(leaves[0])
+
+    # A lineage proof from the wrong parent fails the CAT's own coin id assertion
+    wrong_parent = build_unwind_spend(ASSET_ID, leaves[0], leaves[1])
+    with pytest.raises(Exception, match="Unwind spends are invalid"):
+        validate_unwind_spends([wrong_parent], MAX_SPEND_BUNDLE_COST)
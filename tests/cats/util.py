@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from types import SimpleNamespace
+from typing import Any
+
+from chia.types.blockchain_format.coin import Coin
+from chia.util.hash import std_hash
+from chia_rs import CoinRecord, CoinSpend
+from chia_rs.sized_bytes import bytes32
+from chia_rs.sized_ints import uint32, uint64
+from clvm.casts import int_to_bytes
+
+from cats.secure_the_bag import BagCoinSpends, Target, secure_the_bag
+
+ASSET_ID = bytes32.fromhex("6d95dae356e32a71db5ddcb42224754a02524c615c5fc35f568c2af04774e589")
+GENESIS_COIN_NAME = bytes32.fromhex("2676b64fab1f562cc4788cb2a9dbbe31da09da9cc23118dfccf6ad741d652328")
+PUZZLE_HASH = bytes32(b"\x00" * 32)
+
+
+def make_targets(count: int) -> list[Target]:
+    """
+    Targets with distinct puzzle hashes and amounts from 1 to count.
+    """
+    return [Target(bytes32(std_hash(int_to_bytes(i))), uint64(i + 1)) for i in range(count)]
+
+
+def make_coin_spends_by_depth(count: int, leaf_width: int = 3) -> list[list[CoinSpend]]:
+    """
+    Spends unwinding a bag of count targets of ASSET_ID created by GENESIS_COIN_NAME, from the root down.
+    """
+    _, parent_puzzle_lookup = secure_the_bag(make_targets(count), leaf_width, ASSET_ID)
+
+    return BagCoinSpends(GENESIS_COIN_NAME, parent_puzzle_lookup).coin_spends_by_depth()
+
+
+class FullNode:
+    """
+    Coin records, coin spends and a peak height served the way FullNodeRpcClient does, counting lookups.
+    """
+
+    height: int
+    coin_records: dict[bytes32, CoinRecord]
+    coin_spends: dict[bytes32, CoinSpend]
+    coin_record_calls: int
+    names_looked_up: int
+    coin_spend_lookups: int
+
+    def __init__(self, coin_records: Sequence[CoinRecord] = (), coin_spends: Sequence[CoinSpend] = ()) -> None:
+        self.height = 1
+        self.coin_records = {coin_record.coin.name(): coin_record for coin_record in coin_records}
+        self.coin_spends = {coin_spend.coin.name(): coin_spend for coin_spend in coin_spends}
+        self.coin_record_calls = 0
+        self.names_looked_up = 0
+        self.coin_spend_lookups = 0
+
+    def set_coin(self, coin: Coin, spent: bool) -> None:
+        self.coin_records[coin.name()] = CoinRecord(
+            coin, uint32(1), uint32(self.height if spent else 0), False, uint64(0)
+        )
+
+    async def get_blockchain_state(self) -> dict[str, Any]:
+        return {"peak": SimpleNamespace(height=self.height)}
+
+    async def get_coin_records_by_names(
+        self,
+        names: list[bytes32],
+        include_spent_coins: bool = True,
+        start_height: int | None = None,
+        end_height: int | None = None,
+    ) -> list[CoinRecord]:
+        self.coin_record_calls += 1
+        self.names_looked_up += len(names)
+
+        return [self.coin_records[name] for name in names if name in self.coin_records]
+
+    async def get_coin_record_by_name(self, coin_id: bytes32) -> CoinRecord | None:
+        return self.coin_records.get(coin_id)
+
+    async def get_puzzle_and_solution(self, coin_id: bytes32, height: uint32) -> CoinSpend | None:
+        self.coin_spend_lookups += 1
+
+        return self.coin_spends.get(coin_id)